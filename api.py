@@ -0,0 +1,346 @@
+"""
+Headless HTTP API for the agent pipeline, for load balancers and other services.
+
+Endpoints:
+    POST /query         {"query", "user_name"?, "session_id"?, "has_bill"?, "stream"?}
+                        -> {"session_id", "response", "source", "timings", "trace_id"}
+                        With "stream": true the reply is NDJSON, one handle_query_stream event per line.
+    POST /upload        a bill PDF as multipart field "file" or as an application/pdf body
+                        -> 202 {"job_id", "status"}, ingested in the background
+    GET  /jobs/{job_id} -> the ingestion job, as in utility_functions.ingest_jobs
+    GET  /health        -> {"status", "in_flight", "capacity"}, 503 while draining
+    GET  /metrics       -> this worker's metrics in the Prometheus text format
+
+A request without a session_id gets a new one, returned in the response so
+the caller can continue the conversation; one without a user_name is
+answered as "guest". At most API_MAX_CONCURRENCY turns run at once per
+worker; a request that cannot get a slot within API_QUEUE_TIMEOUT seconds
+is answered 503 with Retry-After. Turns of one session run one at a time
+across all workers, through a lease in the session database; requests of
+one session queue for it before they take a slot, and one that waits
+longer than API_QUEUE_TIMEOUT in all is answered 503 too. On SIGTERM or
+SIGINT the worker reports unhealthy, stops accepting connections and gives
+in-flight turns API_SHUTDOWN_TIMEOUT seconds to finish.
+
+With --workers N, N processes serve the same port through SO_REUSEPORT and
+the kernel spreads connections between them.
+
+Usage:
+    python api.py [--host 0.0.0.0] [--port 8000] [--workers 1]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import time
+import uuid
+import weakref
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from utility_functions import log_generator, metrics
+from utility_functions.clients import startup_report, startup_stage, warm_up
+
+load_dotenv()
+
+API_HOST = os.getenv('API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('API_PORT', '8000'))
+API_WORKERS = int(os.getenv('API_WORKERS', '1'))
+API_MAX_CONCURRENCY = int(os.getenv('API_MAX_CONCURRENCY', '8'))
+API_QUEUE_TIMEOUT = float(os.getenv('API_QUEUE_TIMEOUT', '30'))
+API_SHUTDOWN_TIMEOUT = float(os.getenv('API_SHUTDOWN_TIMEOUT', '30'))
+API_MAX_UPLOAD_MB = float(os.getenv('API_MAX_UPLOAD_MB', '20'))
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.:-]{1,128}$')
+
+log = logging.getLogger('api')
+
+_requests = metrics.counter('rag_api_requests_total', 'HTTP requests by route and status.', ['route', 'status'])
+_request_seconds = metrics.histogram('rag_api_request_seconds', 'HTTP request handling seconds by route.', ['route'])
+_in_flight = metrics.gauge('rag_api_turns_in_flight', 'Turns holding a slot in this worker.')
+
+manager_key = web.AppKey('manager', object)
+sessions_key = web.AppKey('sessions', object)
+ingest_key = web.AppKey('ingest', object)
+state_key = web.AppKey('state', dict)
+
+
+def _unavailable(message):
+    return web.json_response({'error': message}, status=503, headers={'Retry-After': '1'})
+
+
+class _TurnSlots:
+    """
+    Bounded concurrency for agent turns, plus one lock per session so requests
+    of one conversation in this worker queue here rather than polling the
+    cross-process session lease.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(capacity)
+        self._session_locks = weakref.WeakValueDictionary()
+
+    def session_lock(self, session_id):
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = self._session_locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def acquire(self, timeout):
+        try:
+            if self._semaphore.locked():
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            else:
+                # free now; wait_for with a spent timeout would refuse it anyway
+                await self._semaphore.acquire()
+        except asyncio.TimeoutError:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+async def _read_query(request):
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise web.HTTPBadRequest(text='Body must be JSON')
+    if not isinstance(body, dict) or not isinstance(body.get('query'), str) or not body['query'].strip():
+        raise web.HTTPBadRequest(text='"query" is required and must be a string')
+    session_id = body.get('session_id') or uuid.uuid4().hex
+    if not SESSION_ID_PATTERN.match(str(session_id)):
+        raise web.HTTPBadRequest(text='"session_id" must be 1-128 letters, digits or _.:-')
+    user_name = body.get('user_name') or 'guest'
+    if not isinstance(user_name, str):
+        raise web.HTTPBadRequest(text='"user_name" must be a string')
+    body['user_name'] = user_name
+    for flag in ('has_bill', 'stream'):
+        if not isinstance(body.get(flag, False), bool):
+            raise web.HTTPBadRequest(text=f'"{flag}" must be true or false')
+    return body, str(session_id)
+
+
+def _open_session(store, session_id):
+    from utility_functions.session_history import CompactingSession
+
+    # opening a shard and the summary table are blocking SQLite calls
+    return CompactingSession(store.session(session_id))
+
+
+async def _answer(request, session_id, body, session):
+    manager = request.app[manager_key]
+    kwargs = dict(user_query=body['query'], user_name=body['user_name'], has_bill=bool(body.get('has_bill')),
+                  session=session)
+    if not body.get('stream'):
+        result = await manager.handle_query(**kwargs)
+        return web.json_response({'session_id': session_id, **result})
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    try:
+        await response.write((json.dumps({'type': 'session', 'session_id': session_id}) + '\n').encode())
+        # closed here rather than whenever it is collected, so the turn is written before the lease is released
+        async with contextlib.aclosing(manager.handle_query_stream(**kwargs)) as events:
+            async for event in events:
+                await response.write((json.dumps(event) + '\n').encode())
+    except ConnectionResetError:
+        # the client went away (aiohttp's ClientConnectionResetError is a subclass); there is nobody left to tell
+        log.info('client of %s disconnected mid-stream', session_id)
+        return response
+    except asyncio.CancelledError:
+        # shutdown or handler cancellation; run_app's drain has to see it
+        log.info('streamed turn of %s cancelled', session_id)
+        raise
+    except Exception as e:
+        # the status line is already sent, so the failure becomes the last event
+        log.warning('streamed turn failed for %s: %r', session_id, e)
+        await response.write((json.dumps({'type': 'error', 'message': str(e)}) + '\n').encode())
+    await response.write_eof()
+    return response
+
+
+async def query(request):
+    app = request.app
+    state = app[state_key]
+    body, session_id = await _read_query(request)
+    if state['draining']:
+        return _unavailable('Shutting down')
+
+    from utility_functions.session_store import SessionBusy
+
+    slots = state['slots']
+    deadline = time.monotonic() + API_QUEUE_TIMEOUT
+    # queued behind its own conversation before taking a slot, so a burst on one
+    # session cannot hold every slot while other sessions are turned away
+    session_lock = slots.session_lock(session_id)
+    try:
+        await asyncio.wait_for(session_lock.acquire(), API_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return _unavailable('Another turn of this session is in progress')
+    try:
+        if not await slots.acquire(max(deadline - time.monotonic(), 0)):
+            return _unavailable('Too many requests in flight')
+        try:
+            session = await asyncio.to_thread(_open_session, app[sessions_key], session_id)
+            try:
+                async with session.exclusive(max(deadline - time.monotonic(), 0)):
+                    return await _answer(request, session_id, body, session)
+            except SessionBusy:
+                return _unavailable('Another turn of this session is in progress')
+        finally:
+            slots.release()
+    finally:
+        session_lock.release()
+
+
+async def upload(request):
+    if request.content_type.startswith('multipart/'):
+        form = await request.post()
+        field = form.get('file')
+        if not isinstance(field, web.FileField):
+            raise web.HTTPBadRequest(text='Expected a multipart field "file"')
+        file_name, pdf_bytes = field.filename, field.file.read()
+    else:
+        file_name, pdf_bytes = request.query.get('name'), await request.read()
+    if not pdf_bytes.startswith(b'%PDF'):
+        raise web.HTTPBadRequest(text='Not a PDF')
+
+    queue = request.app[ingest_key]
+    job_id = await asyncio.to_thread(queue.submit, pdf_bytes, file_name)
+    job = await asyncio.to_thread(queue.status, job_id)
+    return web.json_response({'job_id': job_id, 'status': job['status']}, status=202)
+
+
+async def job_status(request):
+    job = await asyncio.to_thread(request.app[ingest_key].status, request.match_info['job_id'])
+    if job is None:
+        raise web.HTTPNotFound(text='Unknown job')
+    return web.json_response(job)
+
+
+async def health(request):
+    state = request.app[state_key]
+    slots = state['slots']
+    body = {'status': 'draining' if state['draining'] else 'ok',
+            'in_flight': slots.in_flight, 'capacity': slots.capacity}
+    return web.json_response(body, status=503 if state['draining'] else 200)
+
+
+async def metrics_text(request):
+    _in_flight.set(request.app[state_key]['slots'].in_flight)
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@web.middleware
+async def _measure(request, handler):
+    # by route pattern rather than path, so job ids do not become label values
+    route = request.match_info.route.resource.canonical if request.match_info.route.resource else 'unmatched'
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        _requests.inc(route=route, status=status)
+        _request_seconds.observe(time.perf_counter() - start, route=route)
+
+
+async def _start(app):
+    from our_agents.manager_agent import Manager_Agent
+    from utility_functions.ingest_jobs import IngestJobQueue
+    from utility_functions.session_store import SessionStore
+
+    primary = app[state_key]['primary']
+    with startup_stage('manager'):
+        app[manager_key] = Manager_Agent()
+    app[sessions_key] = SessionStore()
+    app[ingest_key] = IngestJobQueue()
+    # maintenance and interrupted jobs are handled by one worker, not by every process
+    if primary:
+        app[sessions_key].start_maintenance()
+        app[ingest_key].resume()
+    await asyncio.to_thread(warm_up)
+    startup_report()
+
+
+async def _drain(app):
+    # new turns are refused and /health fails, so the load balancer stops routing here
+    app[state_key]['draining'] = True
+    log.info('worker %d draining, %d turns in flight', os.getpid(), app[state_key]['slots'].in_flight)
+
+
+async def _stop(app):
+    app[sessions_key].stop_maintenance()
+    app[ingest_key].shutdown(wait=False)
+
+
+def make_app(primary=True):
+    app = web.Application(client_max_size=int(API_MAX_UPLOAD_MB * 1024 * 1024), middlewares=[_measure])
+    app[state_key] = {'draining': False, 'primary': primary, 'slots': _TurnSlots(API_MAX_CONCURRENCY)}
+    app.on_startup.append(_start)
+    app.on_shutdown.append(_drain)
+    app.on_cleanup.append(_stop)
+    app.add_routes([
+        web.post('/query', query),
+        web.post('/upload', upload),
+        web.get('/jobs/{job_id}', job_status),
+        web.get('/health', health),
+        web.get('/metrics', metrics_text),
+    ])
+    return app
+
+
+def run_worker(host, port, index=0, reuse_port=False):
+    # one log file per worker, since rotation cannot be shared between processes;
+    # the console copy is what container runtimes collect
+    log_generator.setup(f'api-{index}', console=True)
+    log.info('worker %d listening on %s:%d', os.getpid(), host, port)
+    web.run_app(make_app(primary=index == 0), host=host, port=port, reuse_port=reuse_port,
+                shutdown_timeout=API_SHUTDOWN_TIMEOUT, print=None)
+
+
+def serve(host=API_HOST, port=API_PORT, workers=API_WORKERS):
+    if workers <= 1:
+        run_worker(host, port)
+        return
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(host, port, index, True), name=f'api-worker-{index}')
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    # Ctrl-C already reaches every worker through the process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the agent pipeline over HTTP.")
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('--workers', type=int, default=API_WORKERS)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers)
@@ -1,50 +1,118 @@
 import asyncio
+import logging
 import os
+import time
 import base64
+from contextlib import contextmanager
 import streamlit as st
 from dotenv import load_dotenv
-from pinecone import Pinecone
-import utility_functions.rag as rag
-import utility_functions.log_generator as log_gen
-from our_agents.manager_agent import Manager_Agent
-from openai import OpenAI
-from agents import SQLiteSession # type:ignore
+from utility_functions.clients import startup_stage, startup_report, warm_up
+with startup_stage('imports'):
+    import utility_functions.rag as rag
+    import utility_functions.log_generator as log_gen
+    import utility_functions.metrics as metrics
+    from our_agents.manager_agent import Manager_Agent
+    from utility_functions.ingest_jobs import FINISHED, IngestJobQueue
+    from utility_functions.session_history import CompactingSession
+    from utility_functions.session_store import SessionStore
  
 load_dotenv()
+
+# logs go through a background queue to logs/frontend.log; started before anything else logs
+log_gen.start_log('frontend')
+log = logging.getLogger('frontend')
+
+# render time allowed per rerun, and chat messages drawn per page of history
+RERUN_BUDGET_MS = int(os.getenv('RERUN_BUDGET_MS', '150'))
+CHAT_PAGE_SIZE = int(os.getenv('CHAT_PAGE_SIZE', '20'))
  
-PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT")
-PINECONE_INDEX_NAME = "retrieval-augmented-generation"
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+@st.cache_resource
+def get_manager():
+    # built once per server process rather than on every rerun
+    with startup_stage('manager'):
+        manager = Manager_Agent()
+    warm_up()
+    startup_report()
+    return manager
+
+manager = get_manager()
  
-client = OpenAI(api_key=OPENAI_API_KEY)
-pc = Pinecone(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
-index = pc.Index(PINECONE_INDEX_NAME)
-manager = Manager_Agent()
+@st.cache_resource
+def start_metrics_server():
+    # GET /metrics for this Streamlit process, when METRICS_PORT is set
+    return metrics.serve() if metrics.METRICS_PORT else None
+
+start_metrics_server()
  
+@st.cache_resource
+def get_session_store():
+    store = SessionStore()
+    store.start_maintenance()
+    return store
+
 @st.cache_resource
 def make_session(name):
-    print("SESSION MADE")
-    return SQLiteSession(name, 'session_history.sqlite')
+    log.info('session made for %s', name)
+    return CompactingSession(get_session_store().session(name))
+
+@st.cache_resource
+def get_ingest_queue():
+    queue = IngestJobQueue()
+    queue.resume()
+    return queue
+
+def submit_upload(pdf_upload):
+    # one job per uploaded file, instead of one per rerun while it stays attached
+    jobs = st.session_state.setdefault("ingest_jobs", {})
+    if pdf_upload.file_id not in jobs:
+        jobs[pdf_upload.file_id] = get_ingest_queue().submit(pdf_upload.getbuffer(), pdf_upload.name)
+    return jobs[pdf_upload.file_id]
+
+def show_ingest_progress(job_id, was_pending):
+    job = get_ingest_queue().status(job_id) or {"status": "failed", "error": "unknown job"}
+    if job["status"] == "done":
+        st.success("Bill uploaded and processed!")
+    elif job["status"] == "duplicate":
+        st.warning("File already uploaded")
+    elif job["status"] == "failed":
+        st.error(f"Could not process the bill: {job['error']}")
+    else:
+        st.info(f"Processing your bill ({job['stage'] or job['status']})... you can keep chatting meanwhile.")
+    if was_pending and job["status"] in FINISHED:
+        # a full rerun so the chat picks up has_bill
+        st.rerun()
  
-saved_stdout = log_gen.start_log()
  
 if "show_modal" not in st.session_state:
     st.session_state.show_modal = False
 if "show_company_modal" not in st.session_state:
     st.session_state.show_company_modal = False
  
+@st.cache_data(max_entries=8)
+def _pdf_base64(pdf_path, mtime):
+    with open(pdf_path, "rb") as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
 def show_pdf_in_modal(pdf_path):
     """Return a base64 iframe for inline PDF rendering."""
-    with open(pdf_path, "rb") as f:
-        base64_pdf = base64.b64encode(f.read()).decode('utf-8')
-    return base64_pdf
+    # encoded once per file version rather than on every rerun while the modal is open
+    return _pdf_base64(pdf_path, os.path.getmtime(pdf_path))
+
+@contextmanager
+def render_budget(name):
+    """Logs reruns (or fragment runs) that take longer than RERUN_BUDGET_MS, excluding agent calls."""
+    start = time.perf_counter()
+    yield
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    st.session_state.setdefault("render_ms", {})[name] = elapsed_ms
+    if elapsed_ms > RERUN_BUDGET_MS:
+        log.warning('%s took %.0fms, budget %dms', name, elapsed_ms, RERUN_BUDGET_MS)
  
 # --- Page config ---
 st.set_page_config(page_title="Electricity Bills Visual QA", layout="wide")
  
-# --- Main async app ---
-async def main():
+# --- Main app ---
+def main():
  
     # --- Sidebar ---
     with st.sidebar:
@@ -64,13 +132,16 @@ async def main():
         with col2:
              if st.button("?", key="info_button"):
                 st.session_state.show_modal = True
-                print("Info button clicked, modal shown")
+                log.debug("info button clicked, modal shown")
  
         has_bill = False
         if pdf_upload:
-            rag.file_to_upsert(pdf_upload)
-            has_bill = True
-            st.success("Bill uploaded and processed!")
+            job_id = submit_upload(pdf_upload)
+            status = get_ingest_queue().status(job_id)["status"]
+            pending = status not in FINISHED
+            # only the progress note polls while the bill is processed, the chat stays usable
+            st.fragment(show_ingest_progress, run_every=1 if pending else None)(job_id, pending)
+            has_bill = status in ("done", "duplicate")
  
         user_name = st.text_input("Full Name:")
  
@@ -79,7 +150,7 @@ async def main():
             pdf_base64 = show_pdf_in_modal("data/sample_bill.pdf")
         except Exception as e:
             pdf_base64 = ""
-            print(f"Error loading PDF: {e}")
+            log.warning("error loading PDF: %r", e)
  
         modal_container = st.container()
         with modal_container:
@@ -90,7 +161,7 @@ async def main():
             with close_col:
                 if st.button("×", key="modal_close"):
                     st.session_state.show_modal = False
-                    print("Modal closed via X")
+                    log.debug("modal closed via X")
                     st.rerun()  
  
             with pdf_col:
@@ -126,7 +197,7 @@ async def main():
             company_pdf_base64 = show_pdf_in_modal("data/company_overview.pdf")
         except Exception as e:
             company_pdf_base64 = ""
-            print(f"Error loading company PDF: {e}")
+            log.warning("error loading company PDF: %r", e)
  
         company_modal_container = st.container()
         with company_modal_container:
@@ -158,41 +229,80 @@ async def main():
  
     if "messages" not in st.session_state:
         st.session_state.messages = []
- 
-    chat_container = st.container()
-    for message in st.session_state.messages:
+        st.session_state.chat_pages = 1
+ 
+    chat(user_name, has_bill)
+
+def render_message(message):
+    with st.chat_message(message["role"]):
+        st.write(message["content"])
+        if message.get("source"):
+            st.caption(f"Response generated by: {message['source']}")
+
+def show_earlier_messages():
+    st.session_state.chat_pages += 1
+
+async def stream_reply(user_query, user_name, has_bill, session):
+    """Writes the reply into an assistant message as tokens arrive and returns the final result."""
+    result = None
+    with st.chat_message("assistant"):
+        status = st.status("Thinking...")
+        answer = st.empty()
+        text = ""
+        try:
+            async for event in manager.handle_query_stream(
+                user_query=user_query,
+                user_name=user_name,
+                has_bill=has_bill,
+                session=session
+            ):
+                if event["type"] == "status":
+                    status.update(label=event["message"])
+                elif event["type"] == "token":
+                    text += event["text"]
+                    answer.markdown(text + "▌")
+                elif event["type"] == "done":
+                    result = event
+            status.update(label="Done", state="complete")
+        except Exception as e:
+            result = {"response": f"Error: {str(e)}", "source": "System"}
+            status.update(label="Error", state="error")
+        answer.markdown(result["response"])
+    return result
+
+@st.fragment
+def chat(user_name, has_bill):
+    # sending a message reruns only this fragment, and only the latest pages of history are drawn
+    with render_budget("chat"):
+        messages = st.session_state.messages
+        shown = CHAT_PAGE_SIZE * st.session_state.chat_pages
+        if len(messages) > shown:
+            st.button(f"Show earlier messages ({len(messages) - shown} more)", key="chat_earlier",
+                      on_click=show_earlier_messages)
+        chat_container = st.container()
         with chat_container:
-            with st.chat_message(message["role"]):
-                st.write(message["content"])
-                if message.get("source"):
-                    st.caption(f"Response generated by: {message['source']}")
+            for message in messages[-shown:]:
+                render_message(message)
  
     user_query = st.chat_input("Ask a question or say hi...")
  
     if user_query and user_query.strip():
-        st.session_state.messages.append({"role": "user", "content": user_query})
+        user_message = {"role": "user", "content": user_query}
+        st.session_state.messages.append(user_message)
         session = make_session(user_name or "guest")
-        print(f'[{user_name}] ', user_query)
- 
-        with st.spinner("Thinking..."):
-            try:
-                result = await manager.handle_query(
-                    user_query=user_query,
-                    user_name=user_name,
-                    has_bill=has_bill,
-                    session=session
-                )
-            except Exception as e:
-                result = {"response": f"Error: {str(e)}", "source": "System"}
- 
-        if result:
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": result["response"],
-                "source": result.get("source")
-            })
- 
-        st.rerun()
+        log.debug('[%s] %s', user_name, user_query)
+        with chat_container:
+            render_message(user_message)
+            result = get_or_create_event_loop().run_until_complete(
+                stream_reply(user_query, user_name, has_bill, session)
+            )
+ 
+        # already drawn above, so no rerun is needed to show it
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": result["response"],
+            "source": result.get("source")
+        })
  
 # --- Async event loop fix for Streamlit ---
 def get_or_create_event_loop():
@@ -207,8 +317,8 @@ def get_or_create_event_loop():
             raise
  
 if __name__ == "__main__":
-    loop = get_or_create_event_loop()
-    loop.run_until_complete(main())
+    with render_budget("rerun"):
+        main()
  
  
  
\ No newline at end of file
@@ -1,33 +1,35 @@
 import os
+import logging
+import functools
 
-import pandas as pd
-import json
-from pinecone import Pinecone
 from dotenv import load_dotenv
-from openai import OpenAI
 
 from agents import Agent, Runner, function_tool, FunctionTool # type: ignore
 
 import utility_functions.rag as rag
+from utility_functions.clients import agent_model, model_name
+from utility_functions.stages import stage
 import asyncio
-import streamlit
 
 
 
 load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
 
+log = logging.getLogger(__name__)
 
 
 @function_tool
-def get_bills(name: str):
+async def get_bills(name: str):
     """ Retrieves bills with the given name from a databse
     Args: 
         name: A string containing the name to be searched for
     """
     # print('NAME: ', name)
-    return rag.retrieve_bill_embeddings(name)
+    with stage('billing_tool', kind='tool', tool='get_bills') as current:
+        # retrieval uses blocking clients, keep it off the event loop
+        contexts = await asyncio.to_thread(rag.retrieve_bill_embeddings, name, customer=name)
+        current.set(contexts=len(contexts))
+    return contexts
 
 # @function_tool
 # def upload_bills(bill: streamlit.runtime.uploaded_file_manager.UploadedFile):
@@ -39,10 +41,12 @@ def get_bills(name: str):
 #     return rag.file_to_upsert(bill)
 
 
+@functools.lru_cache(maxsize=None)
 def get_agent():
+    """Built once per process; Agent holds only configuration, so runs can share it."""
     billing_agent = Agent(
         name="Billing agent",
-        model='gpt-4o-mini',
+        model=agent_model('gpt-4o-mini'),
         instructions=(
             "Handle uploading and retrieving utility bills."
             "Call the relevant tools when needed."
@@ -53,23 +57,18 @@ def get_agent():
     return billing_agent
 
 async def get_info(name, question, session=None):
+    # callers without a known customer (an anonymous API request) still get an answer
+    name = name or 'guest'
     query = 'Using the bill belonging to "' + name + '", answer the following question: ' + question
     
-    result = await Runner.run(get_agent(), query, session=session)    
-    print('[billing] ', result.final_output, end='\n\n')
+    agent = get_agent()
+    with stage('billing_run', kind='agent', agent=agent.name, model=model_name(agent)) as current:
+        result = await Runner.run(agent, query, session=session)
+        current.add_usage(result.context_wrapper.usage)
+    log.debug('billing answer: %s', result.final_output)
     return result.final_output
 
 if __name__ == '__main__':
+    from utility_functions.evaluate import main
 
-    test_dir = os.path.join(os.getcwd(), 'tests/billing_agent/')
-    test_questions_df = pd.read_csv(os.path.join(test_dir, 'questions.csv'))
-
-    answers_path = os.path.join(test_dir, 'answers.csv')
-    with open(answers_path, 'w') as f:
-        for i in range(len(test_questions_df)):
-            name = test_questions_df.loc[i]['Name']
-            question = test_questions_df.loc[i]['Question']
-            response = asyncio.run(get_info(name,question))
-            answer = '"' + response.replace('\n', ' ').replace('"', "'") +'"'
-            content = ','.join([name,question,answer]) + '\n'
-            f.write(content)
+    main(get_info, target='billing', default_output=os.path.join('tests', 'billing_agent', 'answers.csv'))
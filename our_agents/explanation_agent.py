@@ -1,19 +1,25 @@
 import os
 import json
-import pandas as pd
+import logging
 import asyncio
+import functools
 from dotenv import load_dotenv
-from openai import OpenAI
 from agents import Agent, Runner, function_tool # type: ignore
+from openai.types.responses import ResponseTextDeltaEvent
+
+from utility_functions.clients import agent_model, async_openai_client, model_name
+from utility_functions.stages import stage
 
 
 load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+log = logging.getLogger(__name__)
+
+EXPLANATION_TOOL_MODEL = 'gpt-4o-mini'
 
 
 @function_tool
-def explain_bill_details(name: str, question: str, relevant_contexts: list[str] | None = None) -> str:
+async def explain_bill_details(name: str, question: str, relevant_contexts: list[str] | None = None) -> str:
     """
     Generates clear, factual explanations about the contents of a user's electricity bill.
     Args:
@@ -32,23 +38,27 @@ def explain_bill_details(name: str, question: str, relevant_contexts: list[str]
     if relevant_contexts:
         prompt += "\nRelevant context:\n" + "\n".join(relevant_contexts)
 
-    response = client.responses.create(
-        model='gpt-4o-mini',
-        input=[
-            {"role": "system", "content": "You are an expert at explaining electricity bills clearly and factually."},
-            {"role": "user", "content": prompt}
-        ]
-    )
+    with stage('explanation_tool', kind='tool', tool='explain_bill_details', model=EXPLANATION_TOOL_MODEL,
+               contexts=len(relevant_contexts or [])) as current:
+        response = await async_openai_client().responses.create(
+            model=EXPLANATION_TOOL_MODEL,
+            input=[
+                {"role": "system", "content": "You are an expert at explaining electricity bills clearly and factually."},
+                {"role": "user", "content": prompt}
+            ]
+        )
+        current.add_usage(response.usage)
     return response.output_text
 
 
+@functools.lru_cache(maxsize=None)
 def get_agent():
     """
-    Creates and returns the Explanation Agent.
+    Creates the Explanation Agent once per process and returns it.
     """
     explanation_agent = Agent(
         name="Explanation agent",
-        model='gpt-4o-mini',
+        model=agent_model('gpt-4o-mini'),
         instructions=(
             "Provide detailed and factual explanations about electricity bills."
             "Help the user understand their charges, consumption, and other components."
@@ -64,25 +74,46 @@ async def get_explanation(name: str, question: str, session=None):
     Runs the Explanation Agent asynchronously to generate an explanation.
     """
     query = f'For the customer "{name}", explain the following question: {question}'
-    result = await Runner.run(get_agent(), query, session=session)
-    print('[explanation] ', result.final_output, end='\n\n')
+    agent = get_agent()
+    with stage('explanation_run', kind='agent', agent=agent.name, model=model_name(agent)) as current:
+        result = await Runner.run(agent, query, session=session)
+        current.add_usage(result.context_wrapper.usage)
+    log.debug('explanation answer: %s', result.final_output)
     return result.final_output
 
 
+async def stream_explanation(name: str, question: str, session=None):
+    """
+    Streamed get_explanation. Yields {"type": "token", "text": ...} for every
+    text delta of the answer and {"type": "status", "message": ...} when the
+    agent calls its tool.
+    """
+    query = f'For the customer "{name}", explain the following question: {question}'
+    agent = get_agent()
+    result = Runner.run_streamed(agent, query, session=session)
+    streamed = False
+    with stage('explanation_run', kind='agent', agent=agent.name, model=model_name(agent), streamed=True) as current:
+        try:
+            async for event in result.stream_events():
+                if event.type == 'raw_response_event' and isinstance(event.data, ResponseTextDeltaEvent):
+                    streamed = True
+                    yield {"type": "token", "text": event.data.delta}
+                elif event.type == 'run_item_stream_event' and event.name == 'tool_called':
+                    yield {"type": "status", "message": "Looking up the bill details..."}
+        finally:
+            # stops the run if the consumer goes away before the answer is complete
+            if not result.is_complete:
+                result.cancel()
+            current.add_usage(result.context_wrapper.usage)
+    if not streamed and result.final_output:
+        yield {"type": "token", "text": str(result.final_output)}
+
+
 if __name__ == "__main__":
-    test_dir = os.path.join(os.getcwd(), "tests/explanation_agent/")
-    os.makedirs(test_dir, exist_ok=True)
-    test_questions_path = os.path.join(test_dir, "questions.csv")
-
-    if os.path.exists(test_questions_path):
-        test_questions_df = pd.read_csv(test_questions_path)
-        answers_path = os.path.join(test_dir, "answers.csv")
-
-        with open(answers_path, "w") as f:
-            for i in range(len(test_questions_df)):
-                name = test_questions_df.loc[i]["Name"]
-                question = test_questions_df.loc[i]["Question"]
-                response = asyncio.run(get_explanation(name, question))
-                answer = '"' + response.replace("\n", " ").replace('"', "'") + '"'
-                content = ",".join([name, question, answer]) + "\n"
-                f.write(content)
+    from utility_functions.evaluate import DEFAULT_QUESTIONS, main
+
+    # its own test set when there is one, the billing questions otherwise
+    questions_path = os.path.join("tests", "explanation_agent", "questions.csv")
+    main(get_explanation, target="explanation",
+         default_output=os.path.join("tests", "explanation_agent", "answers.csv"),
+         default_questions=[questions_path] if os.path.exists(questions_path) else DEFAULT_QUESTIONS)
@@ -1,18 +1,56 @@
 import os
+import time
+import logging
 import asyncio
+import contextlib
 from dotenv import load_dotenv
-from openai import OpenAI
-from langchain_openai import ChatOpenAI
 from agents import Agent, Runner, function_tool, FunctionTool
 
 import our_agents.billing_agent as billing_agent
 import our_agents.sentiment_agent as sentiment_agent
 import our_agents.explanation_agent as explanation_agent
+from our_agents.router import IntentRouter
+import utility_functions.rag as rag
+import utility_functions.sentiment_stats as sentiment_stats
+from utility_functions.bill_fields import normalize_customer
+from utility_functions import metrics
+from utility_functions.clients import agent_model, openai_client
+from utility_functions.response_cache import query_entities
+from utility_functions.stages import stage
 
 
 load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+log = logging.getLogger(__name__)
+
+_turns = metrics.counter('rag_turns_total', 'Finished user turns by answer source.', ['source'])
+_first_token = metrics.histogram('rag_first_token_seconds', 'Seconds from the start of a turn to its first token.',
+                                 ['source'])
+
+
+def _response_cache_key(user_name, user_query, has_bill):
+    """(scope, query embedding) for the response cache; the embedding is shared with the router."""
+    scope = (normalize_customer(user_name or ''), rag.bill_facts.fingerprint(user_name), has_bill,
+             query_entities(user_query))
+    return scope, rag.embedding_cache.embed(openai_client(), user_query, rag.EMBEDDING_MODEL)
+
+
+async def _timed(stage, timings, awaitable):
+    """Awaits awaitable and records its wall-clock duration in timings[stage]."""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+async def _cancel(task):
+    """Cancels task and waits until it has stopped, so it no longer writes to the session."""
+    task.cancel()
+    # wait() rather than awaiting the task, which would also swallow a cancellation of the caller
+    await asyncio.wait([task])
+    if not task.cancelled() and task.exception():
+        log.debug('cancelled task had failed: %r', task.exception())
 
 
 class Manager_Agent:
@@ -23,7 +61,7 @@ class Manager_Agent:
         """
         self.manager_agent = Agent(
             name="Manager agent",
-            model='gpt-4o-mini',
+            model=agent_model('gpt-4o-mini'),
             instructions=(
                 "You are the manager agent overseeing user interactions."
                 "Your job is to interpret what the user wants, route queries "
@@ -45,60 +83,237 @@ class Manager_Agent:
                 ),
             ],
         )
+        # routes queries by embedding similarity; the LLM manager above is only a fallback
+        self.router = IntentRouter()
+
+    @staticmethod
+    def get_sentiment_stats(session):
+        """Running count, mean, EWMA and recent scores of the session's sentiment."""
+        return sentiment_stats.for_session(session).get(session.session_id)
 
-    sentiment_scores = []
-    def get_average_sentiment_score(self):
-        if self.sentiment_scores:
-            return sum(self.sentiment_scores) / len(self.sentiment_scores)
-        return 0.0
+    def get_average_sentiment_score(self, session):
+        return self.get_sentiment_stats(session)['mean']
 
     async def run(self, query):
-        result = await Runner.run(self.manager_agent, query)
-        print('[manager] ', result.final_output, end='\n\n')
-        return result.final_output
+        return await self.run_manager_agent(query)
 
     async def run_manager_agent(self, query: str) -> str:
-        result = await Runner.run(self.manager_agent, query)
-        print('[manager] ', result.final_output, end='\n\n')
-        return result.final_output
+        """
+        Dispatches straight to the specialist picked by the router, and only
+        pays for the LLM manager hop when the router is not confident.
+        """
+        route = await asyncio.to_thread(self.router.route, query)
+        if route.confident and route.name == 'greeting':
+            output = "Hello there! Thanks for your friendly message. How can I help you today?"
+        elif route.confident:
+            agent = billing_agent.get_agent() if route.name == 'billing' else explanation_agent.get_agent()
+            output = (await Runner.run(agent, query)).final_output
+        else:
+            with stage('manager_run', kind='agent', agent=self.manager_agent.name, route=route.name) as current:
+                result = await Runner.run(self.manager_agent, query)
+                current.add_usage(result.context_wrapper.usage)
+            output = result.final_output
+        log.debug('manager answer (%s): %s', route.name, output)
+        return output
+
+    async def _greet(self, user_query, user_name, session):
+        greeting_reply = f"Hello {user_name or 'there'}! Thanks for your friendly message. How can I help you today?"
+        await session.add_items([
+            {"role": "user", "content": user_query},
+            {"role": "assistant", "content": greeting_reply}
+        ])
+        return greeting_reply
+
+    async def _history_is_small_talk(self, session):
+        """
+        True when the history the agents would see holds nothing an answer can
+        depend on: no summary of earlier turns, and only confident greetings
+        from the user. The greetings were routed on their own turns, so their
+        embeddings are cached.
+        """
+        if not await session.get_items(limit=1):
+            return True
+        for item in await session.get_items():
+            if item.get('role') == 'system':
+                return False
+            if item.get('role') == 'user':
+                content = item.get('content')
+                if not isinstance(content, str):
+                    return False
+                route = await asyncio.to_thread(self.router.route, content, record=False)
+                if not (route.confident and route.name == 'greeting'):
+                    return False
+        return True
+
+    @staticmethod
+    def _done(response, source, timings, turn_start):
+        timings["total"] = time.perf_counter() - turn_start
+        timings.setdefault("first_token", timings["total"])
+        return {"type": "done", "response": response, "source": source, "timings": timings}
 
     async def handle_query(self, user_query: str, user_name: str = None, has_bill: bool = False, session=None) -> dict:
-        full_query = f"{user_name or 'User'}: {user_query}"
-        billing_keywords = ["bill", "amount", "usage", "charge", "due date", "balance", "month", "monthly", "payment", "cost"]
-        is_billing_related = any(kw in user_query.lower() for kw in billing_keywords)
+        """
+        Runs one user turn and returns the complete answer. The router picks
+        greeting, billing or explanation from the query embedding; sentiment
+        analysis and bill retrieval run concurrently, so the critical path is
+        the slower of the two plus the explanation.
+        The result carries per-stage wall-clock seconds under "timings".
+        """
+        result = None
+        async for event in self.handle_query_stream(user_query, user_name, has_bill, session):
+            if event["type"] == "done":
+                result = event
+        return {"response": result["response"], "source": result["source"], "timings": result["timings"],
+                "trace_id": result["trace_id"]}
 
-        # Analyze sentiment synchronously because the existing function is sync.
-        sentiment_result = sentiment_agent.analyze_sentiment_and_intent(user_query)
-        sentiment = sentiment_result.get("sentiment", "neutral")
-        intent = sentiment_result.get("intent", "unknown")
-        score = sentiment_result.get("score", 0.0)
-        self.sentiment_scores.append(score)
-        print(f'[Sentiment Agent] Sentiment: {sentiment}, Score: {score:.3f}, Intent: {intent}')
-        
-        print('Sentiment scores so far:', self.sentiment_scores)
-        avg_score = self.get_average_sentiment_score()
-        print(f"[Avg_Score] Average Sentiment Score: {avg_score:.3f}")
+    async def handle_query_stream(self, user_query: str, user_name: str = None, has_bill: bool = False, session=None):
+        """
+        Same turn as handle_query, as an async generator of events:
+            {"type": "status", "message": ...}   a new stage started
+            {"type": "token", "text": ...}       the next piece of the answer
+            {"type": "done", "response", "source", "timings", "trace_id"}
+        timings["first_token"] is the time from the start of the turn to the first token.
+        The turn is one trace; every span below it carries trace_id.
+        """
+        # sessions that support it write the whole turn in one transaction when it ends
+        batch = session.batch() if hasattr(session, 'batch') else contextlib.nullcontext()
+        with stage('turn', kind='turn', user=user_name or 'guest', has_bill=has_bill,
+                   session=getattr(session, 'session_id', None)) as turn:
+            async with batch:
+                async for event in self._turn_events(turn, user_query, user_name, has_bill, session):
+                    if event["type"] == "done":
+                        event["trace_id"] = turn.trace_id
+                        timings = event["timings"]
+                        turn.set(source=event["source"],
+                                 timings={name: round(seconds, 6) for name, seconds in timings.items()})
+                        _turns.inc(source=event["source"])
+                        _first_token.observe(timings["first_token"], source=event["source"])
+                    yield event
 
-        greeting_intents = [
-        'greeting', 'greet', 'hello', 'hi', 'salutation', 'checking in', 'well-being', 'asking how you are', 'saying hi', 'friendly approach', 'welcoming', 'greeting the assistant']
-        if any(intent.lower().startswith(greet) or intent.lower() == greet for greet in greeting_intents):
-            greeting_reply = f"Hello {user_name or 'there'}! Thanks for your friendly message. How can I help you today?"
+    async def _turn_events(self, turn, user_query, user_name, has_bill, session):
+        turn_start = time.perf_counter()
+        timings = {}
+        # fold turns that left the history window into the session summary, off the critical path
+        if hasattr(session, 'compact_in_background'):
+            session.compact_in_background()
+
+        # Direct field lookups (amount due, due date, usage, billing period) are answered
+        # from the bill fact table without any LLM call.
+        fact_answer = await _timed('bill_facts', timings, asyncio.to_thread(rag.bill_facts.answer, user_name, user_query))
+        if fact_answer:
+            turn.set(cache_hit='bill_facts')
+            log.debug('answered from bill facts: %s', fact_answer)
             await session.add_items([
                 {"role": "user", "content": user_query},
-                {"role": "assistant", "content": greeting_reply}
+                {"role": "assistant", "content": fact_answer}
             ])
-            return {"response": greeting_reply, "source": "manager_greeting"}
+            yield {"type": "token", "text": fact_answer}
+            yield self._done(fact_answer, "bill facts", timings, turn_start)
+            # after the answer, so the fast path stays fast but the session's sentiment still counts the turn
+            local = await asyncio.to_thread(sentiment_agent.classify_local, user_query)
+            await asyncio.to_thread(sentiment_stats.record, session, local["score"])
+            return
 
-        output = f'[Sentiment Agent] Sentiment: {sentiment}, Intent: {intent}'
-        await session.add_items([
-            {"role": "user", "content": user_query},
-            {"role": "assistant", "content": output}
-        ])
+        # Near-identical questions against the same bills reuse the earlier answer. Only a
+        # question the history cannot change qualifies: later ones ("why?", "explain that")
+        # depend on it, which the cache key does not capture.
+        cache_key = None
+        try:
+            if session is None or await self._history_is_small_talk(session):
+                cache_key = await _timed('response_cache', timings, asyncio.to_thread(_response_cache_key, user_name, user_query, has_bill))
+        except Exception as e:
+            log.warning('response cache lookup failed: %r', e)
+        cached = rag.response_cache.get(*cache_key) if cache_key else None
+        if cached:
+            local = await asyncio.to_thread(sentiment_agent.classify_local, user_query)
+            await asyncio.to_thread(sentiment_stats.record, session, local["score"])
+            await session.add_items([
+                {"role": "user", "content": user_query},
+                {"role": "assistant", "content": cached.response}
+            ])
+            yield {"type": "token", "text": cached.response}
+            done = self._done(cached.response, f"response cache ({cached.source})", timings, turn_start)
+            turn.set(cache_hit='response', saved_seconds=round(cached.seconds - timings["total"], 6))
+            log.debug('response cache hit; %s', rag.response_cache.stats())
+            yield done
+            return
+
+        # Retrieval does not depend on sentiment, so sentiment starts first and
+        # billing starts as soon as the router has decided.
+        sentiment_task = asyncio.create_task(
+            _timed('sentiment', timings, sentiment_agent.analyze_sentiment_and_intent_async(user_query)))
+
+        try:
+            route = await _timed('routing', timings, asyncio.to_thread(self.router.route, user_query))
+        except BaseException:
+            # failed, cancelled or closed by the consumer: the sentiment task must not outlive the turn
+            sentiment_task.cancel()
+            raise
+        turn.set(route=route.name, route_margin=round(route.confidence, 4), route_confident=route.confident)
+        if route.confident and route.name == 'greeting':
+            # the reply does not wait for sentiment, which may be an LLM escalation; it is recorded afterwards
+            try:
+                reply = await self._greet(user_query, user_name, session)
+                yield {"type": "token", "text": reply}
+                yield self._done(reply, "manager_greeting", timings, turn_start)
+            except BaseException:
+                sentiment_task.cancel()
+                raise
+            sentiment_result = await sentiment_task
+            await asyncio.to_thread(sentiment_stats.record, session, sentiment_result.get("score", 0.0))
+            return
+
+        if route.confident:
+            is_billing_related = route.name == 'billing'
+        else:
+            billing_keywords = ["bill", "amount", "usage", "charge", "due date", "balance", "month", "monthly", "payment", "cost"]
+            is_billing_related = any(kw in user_query.lower() for kw in billing_keywords)
+
+        billing_task = None
+        if is_billing_related:
+            try:
+                yield {"type": "status", "message": "Retrieving your bill..."}
+            except BaseException:
+                sentiment_task.cancel()
+                raise
+            billing_task = asyncio.create_task(
+                _timed('billing', timings, billing_agent.get_info(user_name, user_query, session=session)))
+
+        try:
+            sentiment_result = await sentiment_task
+        except BaseException:
+            if billing_task:
+                billing_task.cancel()
+            raise
 
-        result = {}
+        sentiment = sentiment_result.get("sentiment", "neutral")
+        intent = sentiment_result.get("intent", "unknown")
+        score = sentiment_result.get("score", 0.0)
+        turn.set(sentiment=sentiment, sentiment_score=round(score, 3), intent=intent,
+                 sentiment_tier=sentiment_result.get("tier"))
+
+        stats = await asyncio.to_thread(sentiment_stats.record, session, score)
+        turn.set(sentiment_mean=round(stats['mean'], 3), sentiment_ewma=round(stats['ewma'], 3))
+        log.debug('recent sentiment scores: %s', stats['window'])
+
+        # Without a confident route, fall back to the sentiment agent's intent for greetings.
+        greeting_intents = [
+        'greeting', 'greet', 'hello', 'hi', 'salutation', 'checking in', 'well-being', 'asking how you are', 'saying hi', 'friendly approach', 'welcoming', 'greeting the assistant']
+        if not route.confident and any(intent.lower().startswith(greet) or intent.lower() == greet for greet in greeting_intents):
+            if billing_task:
+                # the billing run shares the session; it must be gone before the greeting writes to it
+                await _cancel(billing_task)
+            reply = await self._greet(user_query, user_name, session)
+            yield {"type": "token", "text": reply}
+            yield self._done(reply, "manager_greeting", timings, turn_start)
+            return
 
         if is_billing_related:
-            bill_response = await billing_agent.get_info(user_name, user_query, session=session)
+            try:
+                bill_response = await billing_task
+            finally:
+                # the billing task must not outlive an abandoned stream
+                billing_task.cancel()
 
             explanation_prompt = (
                 f"The user asked about their bill.\n\n"
@@ -106,9 +321,7 @@ class Manager_Agent:
                 f"Sentiment noted: {sentiment}. Intent noted: {intent}\n\n"
                 "Now explain this clearly to the user."
             )
-
-            result["response"] = await explanation_agent.get_explanation(user_name, explanation_prompt, session=session)
-            result["source"] = "billing + explanation + sentiment"
+            source = "billing + explanation + sentiment"
 
         else:
             if not has_bill:
@@ -116,9 +329,22 @@ class Manager_Agent:
                 explanation_prompt = f"{user_query}\n\n{no_bill_message}\n\nSentiment noted: {sentiment}. Intent noted: {intent}"
             else:
                 explanation_prompt = f"{user_query}\n\nSentiment noted: {sentiment}. Intent noted: {intent}"
+            source = "explanation + sentiment"
 
-            result["response"] = await explanation_agent.get_explanation(user_name, explanation_prompt, session=session)
-            result["source"] = "explanation + sentiment"
-
-        return result
+        yield {"type": "status", "message": "Explaining..."}
+        explanation_start = time.perf_counter()
+        pieces = []
+        async for event in explanation_agent.stream_explanation(user_name, explanation_prompt, session=session):
+            if event["type"] == "token":
+                if not pieces:
+                    timings["first_token"] = time.perf_counter() - turn_start
+                pieces.append(event["text"])
+            yield event
+        timings["explanation"] = time.perf_counter() - explanation_start
+        response = ''.join(pieces)
+        log.debug('answer: %s', response)
 
+        done = self._done(response, source, timings, turn_start)
+        if cache_key:
+            rag.response_cache.put(*cache_key, response, source, timings["total"])
+        yield done
@@ -0,0 +1,124 @@
+"""
+Embedding-similarity intent router.
+
+Routes a query to 'greeting', 'billing' or 'explanation' by comparing its
+embedding with one centroid per route. The centroids are built from the
+labeled examples in data/intent_examples.csv and stored as a NumPy matrix
+under data/cache, so after the first run startup only loads a small .npy
+file. Query embeddings go through rag.embedding_cache, so repeated
+questions need no network call either.
+"""
+import csv
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+import utility_functions.rag as rag
+from utility_functions.clients import openai_client
+from utility_functions.intent_classifier import INTENT_EXAMPLES_PATH
+
+log = logging.getLogger(__name__)
+
+ROUTES = ['billing', 'explanation', 'greeting']
+# intents in data/intent_examples.csv that need the customer's bill go to billing
+ROUTE_FOR_INTENT = {
+    'greeting': 'greeting',
+    'billing inquiry': 'billing',
+    'bill explanation': 'billing',
+    'complaint': 'billing',
+}
+# minimum lead of the best route's cosine similarity over the runner-up
+ROUTER_MIN_MARGIN = float(os.getenv('ROUTER_MIN_MARGIN', '0.03'))
+ROUTER_CACHE_DIR = os.path.join('data', 'cache')
+
+
+@dataclass
+class Route:
+    name: str
+    confidence: float
+    confident: bool
+    scores: dict = field(default_factory=dict)
+
+
+class IntentRouter:
+    def __init__(self, examples_path=INTENT_EXAMPLES_PATH, embed_model=rag.EMBEDDING_MODEL,
+                 min_margin=ROUTER_MIN_MARGIN):
+        self.examples_path = examples_path
+        self.embed_model = embed_model
+        self.min_margin = min_margin
+        self._centroids = None
+        self._lock = threading.Lock()
+        self.counts = {name: 0 for name in ROUTES}
+        self.counts['fallback'] = 0
+        self.total_seconds = 0.0
+
+    def _examples(self):
+        with open(self.examples_path, newline='', encoding='utf-8') as f:
+            return [(row['text'], ROUTE_FOR_INTENT.get(row['intent'], 'explanation')) for row in csv.DictReader(f)]
+
+    def _build_centroids(self):
+        examples = self._examples()
+        digest = hashlib.sha256(repr((self.embed_model, examples)).encode('utf-8')).hexdigest()[:16]
+        cache_path = os.path.join(ROUTER_CACHE_DIR, f'route_centroids_{digest}.npy')
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+        vectors = np.asarray(rag.embedding_cache.embed(openai_client(), [text for text, _ in examples], self.embed_model),
+                             dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        centroids = np.stack([vectors[[route == name for _, route in examples]].mean(axis=0) for name in ROUTES])
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+        os.makedirs(ROUTER_CACHE_DIR, exist_ok=True)
+        np.save(cache_path, centroids)
+        return centroids
+
+    @property
+    def centroids(self):
+        if self._centroids is None:
+            with self._lock:
+                if self._centroids is None:
+                    self._centroids = self._build_centroids()
+        return self._centroids
+
+    def route(self, query, record=True):
+        """
+        Scores query against every route centroid. Returns a Route whose
+        `confident` flag is False when the margin is below min_margin or the
+        embedding call failed; callers should then use their fallback rule.
+        With record=False the call is left out of metrics(), for re-routing
+        earlier messages rather than a new turn.
+        """
+        start = time.perf_counter()
+        try:
+            query_vector = np.asarray(rag.embedding_cache.embed(openai_client(), query, self.embed_model), dtype=np.float32)
+            scores = self.centroids @ (query_vector / np.linalg.norm(query_vector))
+        except Exception as e:
+            log.warning('embedding failed, using fallback: %r', e)
+            if record:
+                self.counts['fallback'] += 1
+            return Route('unknown', 0.0, False)
+        finally:
+            if record:
+                self.total_seconds += time.perf_counter() - start
+
+        order = np.argsort(-scores)
+        margin = float(scores[order[0]] - scores[order[1]])
+        route = Route(ROUTES[order[0]], margin, margin >= self.min_margin,
+                      dict(zip(ROUTES, scores.tolist())))
+        if record:
+            self.counts[route.name if route.confident else 'fallback'] += 1
+        return route
+
+    def metrics(self):
+        routed = sum(self.counts.values())
+        return {
+            'counts': dict(self.counts),
+            'fallback_rate': self.counts['fallback'] / routed if routed else 0.0,
+            'avg_route_ms': 1000 * self.total_seconds / routed if routed else 0.0,
+        }
@@ -1,19 +1,54 @@
+import argparse
+import asyncio
+import csv
+import functools
 import json
 import os
-from openai import OpenAI
 from agents import Agent  # type: ignore
 
-import nltk
-nltk.download('vader_lexicon')
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-_sentiment_analyzer = SentimentIntensityAnalyzer()
-
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-
-def analyze_sentiment_and_intent(text: str) -> dict:
-    prompt = (
+from utility_functions.clients import agent_model, async_openai_client, openai_client, startup_stage
+from utility_functions.intent_classifier import CentroidIntentClassifier
+from utility_functions.stages import stage
+
+# VADER lexicon location; the Docker image downloads it here at build time
+NLTK_DATA_DIR = os.getenv('NLTK_DATA_DIR', os.path.join('data', 'nltk_data'))
+
+# 'tiered' answers confident messages locally and escalates the rest to the LLM,
+# 'local' never calls the LLM, 'llm' always does
+SENTIMENT_TIER = os.getenv('SENTIMENT_TIER', 'tiered').lower()
+SENTIMENT_MODEL = 'gpt-4o-mini'
+# VADER compound at or beyond this is a confident positive/negative
+SENTIMENT_CONFIDENT_SCORE = 0.4
+# VADER compound within this of zero is a confident neutral
+SENTIMENT_NEUTRAL_SCORE = 0.05
+INTENT_MIN_SCORE = 0.25
+INTENT_MIN_MARGIN = 0.15
+
+
+@functools.lru_cache(maxsize=None)
+def _sentiment_analyzer():
+    """VADER, loaded on first use. The lexicon is only downloaded when no NLTK data path has it."""
+    with startup_stage('vader'):
+        import nltk
+        from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+        if NLTK_DATA_DIR not in nltk.data.path:
+            nltk.data.path.insert(0, NLTK_DATA_DIR)
+        try:
+            nltk.data.find('sentiment/vader_lexicon.zip')
+        except LookupError:
+            nltk.download('vader_lexicon', download_dir=NLTK_DATA_DIR, quiet=True)
+        return SentimentIntensityAnalyzer()
+
+
+@functools.lru_cache(maxsize=None)
+def _intent_classifier():
+    with startup_stage('intent_classifier'):
+        return CentroidIntentClassifier.from_csv()
+
+
+def _sentiment_prompt(text: str) -> str:
+    return (
         "You are an assistant that analyzes customer queries for sentiment and intent.\n"
         "Regardless of input, always respond ONLY in valid JSON format with keys:\n"
         "  - sentiment: one of 'positive', 'negative', or 'neutral'\n"
@@ -22,131 +57,154 @@ def analyze_sentiment_and_intent(text: str) -> dict:
         "Respond strictly ONLY with this JSON format:\n"
         '{"sentiment": "sentiment_value", "intent": "customer_intent"}'
     )
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-        )
-        content = response.choices[0].message.content.strip()
-        result = json.loads(content)
-        sentiment = result.get("sentiment", "neutral")
-        intent = result.get("intent", "unknown")
-    except Exception:
-        text_lower = text.lower()
-        if any(w in text_lower for w in ["happy", "glad", "good", "positive"]):
-            sentiment = "positive"
-            intent = "expressing happiness"
-        elif any(w in text_lower for w in ["angry", "mad", "upset", "negative"]):
-            sentiment = "negative"
-            intent = "expressing anger"
-        else:
-            sentiment = "neutral"
-            intent = "unknown"
-
-    scores = _sentiment_analyzer.polarity_scores(text)
-    compound = scores['compound']
-    return {
-        "sentiment": sentiment,  
-        "intent": intent,        
-        "score": compound        
-    }
-
-
-def get_agent():
-    def sentiment_intent_tool(query: str) -> str:
-        result = analyze_sentiment_and_intent(query)
-        return json.dumps(result)
-
-    sentiment_agent = Agent(
-        name="Sentiment and Intent Agent",
-        instructions="Judge customer's query's sentiment and intent.",
-        tools=[sentiment_intent_tool],
-        handoff_description="Handles sentiment and intent understanding of queries."
-    )
-    return sentiment_agent
-
-
-
 
 
+def _keyword_sentiment(text: str) -> tuple[str, str]:
+    text_lower = text.lower()
+    if any(w in text_lower for w in ["happy", "glad", "good", "positive"]):
+        return "positive", "expressing happiness"
+    if any(w in text_lower for w in ["angry", "mad", "upset", "negative"]):
+        return "negative", "expressing anger"
+    return "neutral", "unknown"
 
 
+def _build_result(sentiment: str, intent: str, compound: float, tier: str, confident: bool = True) -> dict:
+    return {
+        "sentiment": sentiment,  
+        "intent": intent,        
+        "score": compound,
+        "tier": tier,
+        "confident": confident
+    }
 
 
+def classify_local(text: str) -> dict:
+    """
+    Local tier: VADER for sentiment and the centroid intent model for intent.
+    "confident" is False when either one is ambiguous.
+    """
+    with stage('vader', kind='local'):
+        compound = _sentiment_analyzer().polarity_scores(text)['compound']
+    if compound >= SENTIMENT_CONFIDENT_SCORE:
+        sentiment, sentiment_confident = "positive", True
+    elif compound <= -SENTIMENT_CONFIDENT_SCORE:
+        sentiment, sentiment_confident = "negative", True
+    elif abs(compound) <= SENTIMENT_NEUTRAL_SCORE:
+        sentiment, sentiment_confident = "neutral", True
+    else:
+        sentiment, sentiment_confident = ("positive" if compound > 0 else "negative"), False
 
+    with stage('intent_local', kind='local'):
+        intent, intent_score, margin = _intent_classifier().classify(text)
+    intent_confident = intent_score >= INTENT_MIN_SCORE and margin >= INTENT_MIN_MARGIN
+    return _build_result(sentiment, intent, compound, "local", sentiment_confident and intent_confident)
 
 
+def _parse_llm_response(content: str) -> tuple[str, str]:
+    result = json.loads(content.strip())
+    return result.get("sentiment", "neutral"), result.get("intent", "unknown")
 
 
+def _answer_locally(local: dict) -> bool:
+    return SENTIMENT_TIER == 'local' or (SENTIMENT_TIER == 'tiered' and local["confident"])
 
 
+def analyze_sentiment_and_intent(text: str) -> dict:
+    local = classify_local(text)
+    if _answer_locally(local):
+        return local
 
+    try:
+        with stage('sentiment_llm', kind='llm', model=SENTIMENT_MODEL) as current:
+            response = openai_client().chat.completions.create(
+                model=SENTIMENT_MODEL,
+                messages=[{"role": "user", "content": _sentiment_prompt(text)}],
+                temperature=0,
+            )
+            current.add_usage(response.usage)
+        sentiment, intent = _parse_llm_response(response.choices[0].message.content)
+    except Exception:
+        sentiment, intent = _keyword_sentiment(text)
 
-# import os
+    return _build_result(sentiment, intent, local["score"], "llm")
 
-# import pandas as pd
-# import json
 
-# from dotenv import load_dotenv
-# from openai import OpenAI
-# from agents import Agent # type: ignore
-# import rag
+async def analyze_sentiment_and_intent_async(text: str) -> dict:
+    """
+    Same as analyze_sentiment_and_intent, without blocking the event loop: the
+    local models (and their first-use lexicon download) run in a worker thread.
+    """
+    local = await asyncio.to_thread(classify_local, text)
+    if _answer_locally(local):
+        return local
+    return await _classify_llm_async(text, local)
 
-# load_dotenv()
 
-# OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-# client = OpenAI(api_key=OPENAI_API_KEY)
+async def _classify_llm_async(text: str, local: dict) -> dict:
+    try:
+        with stage('sentiment_llm', kind='llm', model=SENTIMENT_MODEL) as current:
+            response = await async_openai_client().chat.completions.create(
+                model=SENTIMENT_MODEL,
+                messages=[{"role": "user", "content": _sentiment_prompt(text)}],
+                temperature=0,
+            )
+            current.add_usage(response.usage)
+        sentiment, intent = _parse_llm_response(response.choices[0].message.content)
+    except Exception:
+        sentiment, intent = _keyword_sentiment(text)
 
+    return _build_result(sentiment, intent, local["score"], "llm")
 
 
-# def get_agent():
-#     sentiment_agent = Agent(
-#         name="Sentiment agent",
-#         instructions=(
-#             "You are in charge of judging a query's emotional sentiment in terms of positive or negative."
-#         ),
-#         handoff_description="Judges the sentiment value of a query."
-#     )
-#     return sentiment_agent
+async def analyze_batch(texts: list[str], concurrency: int = 8) -> list[dict]:
+    """
+    Scores many texts: all of them locally, then only the ambiguous ones through
+    the LLM with at most `concurrency` requests in flight.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
 
+    async def analyze(text):
+        local = await asyncio.to_thread(classify_local, text)
+        if _answer_locally(local):
+            return local
+        async with semaphore:
+            return await _classify_llm_async(text, local)
 
-# import json
-# from openai import OpenAI
-# from dotenv import load_dotenv
-# from agents import function_tool
+    return await asyncio.gather(*(analyze(text) for text in texts))
 
-# load_dotenv()
-# OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-# client = OpenAI(api_key=OPENAI_API_KEY)
 
-# @function_tool
-# def analyze_sentiment(chat_content: str) -> dict:
-#     """
-#     Analyze chat content and classify customer satisfaction.
-#     Returns a dictionary with 'sentiment' and 'reason'.
-#     """
-#     prompt = f"""
-#     You are a sentiment analysis expert for customer service chats.
-#     Analyze the following chat transcript and classify the customer's satisfaction as one of:
-#     Satisfied, Neutral, Unsatisfied.
-#     Respond in strict JSON format like:
-#     {{ "sentiment": "<Satisfied/Neutral/Unsatisfied>", "reason": "<brief justification>" }}
-    
-#     Chat transcript:
-#     {chat_content}
-#     """
+@functools.lru_cache(maxsize=None)
+def get_agent():
+    def sentiment_intent_tool(query: str) -> str:
+        result = analyze_sentiment_and_intent(query)
+        return json.dumps(result)
 
-#     response = client.chat.completions.create(
-#         model="gpt-4o-mini",
-#         messages=[{"role": "user", "content": prompt}],
-#         temperature=0.0,
-#     )
+    sentiment_agent = Agent(
+        name="Sentiment and Intent Agent",
+        model=agent_model(),
+        instructions="Judge customer's query's sentiment and intent.",
+        tools=[sentiment_intent_tool],
+        handoff_description="Handles sentiment and intent understanding of queries."
+    )
+    return sentiment_agent
 
-#     text = response.choices[0].message["content"]
-#     try:
-#         return json.loads(text)
-#     except Exception:
-#         return {"sentiment": None, "reason": text}
 
-# SentimentTool = analyze_sentiment
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score a CSV of messages for sentiment and intent.")
+    parser.add_argument('input_csv')
+    parser.add_argument('output_csv')
+    parser.add_argument('--column', default='text', help="Column holding the message text.")
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    with open(args.input_csv, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    results = asyncio.run(analyze_batch([row[args.column] for row in rows], args.concurrency))
+
+    with open(args.output_csv, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) + list(results[0].keys()) if rows else [])
+        writer.writeheader()
+        for row, result in zip(rows, results):
+            writer.writerow({**row, **result})
+    escalated = sum(result["tier"] == "llm" for result in results)
+    print(f"Scored {len(results)} messages, {escalated} escalated to the LLM")
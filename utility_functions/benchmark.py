@@ -0,0 +1,265 @@
+"""
+Per-stage latency benchmark of the query path.
+
+Runs every question of the given CSV files through Manager_Agent.handle_query
+and records, per turn, the manager's own stage timings and the finer stages
+reported through utility_functions.stages (VADER, sentiment LLM, query
+embedding, vector query, billing and explanation agent runs, session writes).
+The report has p50/p95/p99 per stage and end to end, plus request and token
+counts per stage, as JSON. Stage percentiles are over the turns in which the
+stage ran; nested stages report inclusive time.
+
+Questions come from Name,Question files (tests/billing_agent/questions.csv)
+or ragas files with a question column (tests/billing_agent/ragas_ready.csv),
+where the customer is the "First Last's" named in the question. Each
+customer gets one conversation, so follow-up questions see their history.
+With --concurrency above 1 the conversations run side by side, but the
+turns of one conversation still run one after another, in file order.
+
+With --baseline, the report is compared with a stored one and the command
+exits with status 1 when a p50 or p95 grew by more than --tolerance (and
+--min-delta-ms), or a stage started using more requests or tokens per turn.
+Combine with OFFLINE_MODE and OFFLINE_LATENCY for runs that are reproducible
+without network.
+
+Usage:
+    python -m utility_functions.benchmark [--questions FILE ...] [--repeat 1] [--concurrency 1]
+        [--output bench.json] [--baseline data/benchmarks/baseline.json]
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import re
+import subprocess
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+from utility_functions import stages
+
+load_dotenv()
+
+DEFAULT_QUESTIONS = [os.path.join('tests', 'billing_agent', 'questions.csv'),
+                     os.path.join('tests', 'billing_agent', 'ragas_ready.csv')]
+BENCHMARK_SESSION_DB = os.path.join('data', 'cache', 'benchmark_sessions.sqlite')
+PERCENTILES = [50, 95, 99]
+_POSSESSIVE_NAME = re.compile(r"\b([A-Z][a-z]+ [A-Z][a-z]+)'s\b")
+
+
+def _read_rows(path):
+    # the ragas export is cp1252, the other files UTF-8
+    for encoding in ('utf-8-sig', 'cp1252'):
+        try:
+            with open(path, newline='', encoding=encoding) as f:
+                return list(csv.DictReader(f))
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f'Cannot decode {path}')
+
+
+def load_questions(path):
+    """[{'name', 'question', 'row'}] from a Name,Question or a ragas question file."""
+    questions, name = [], 'guest'
+    for row in _read_rows(path):
+        if 'Question' in row:
+            name, question = row['Name'].strip(), row['Question'].strip()
+        else:
+            question = row['question'].strip()
+            match = _POSSESSIVE_NAME.search(question)
+            # follow-ups like "that bill" belong to the customer of the previous question
+            name = match.group(1) if match else name
+        if question:
+            questions.append({'name': name, 'question': question, 'row': row})
+    return questions
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {}
+    summary = {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+    summary.update(mean=float(values.mean()), max=float(values.max()))
+    return summary
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_turn(manager, store, question, has_bill=True, session_prefix='benchmark'):
+    """One handle_query call, as {'seconds', 'source', 'stages', 'error'}."""
+    from utility_functions.session_history import CompactingSession
+
+    session = CompactingSession(store.session(f"{session_prefix}:{question['name']}"))
+    start = time.perf_counter()
+    with stages.recording() as recorder:
+        try:
+            result = await manager.handle_query(question['question'], question['name'], has_bill, session)
+            error, source, timings = None, result['source'], result['timings']
+        except Exception as e:
+            error, source, timings = repr(e), None, {}
+    seconds = time.perf_counter() - start
+
+    turn_stages = recorder.summary()
+    for name, value in timings.items():
+        # the manager's coarse stages, next to the finer ones recorded inside them
+        if name != 'total':
+            turn_stages.setdefault(f'turn.{name}', {'count': 1, 'seconds': value, 'requests': 0,
+                                                    'input_tokens': 0, 'output_tokens': 0})
+    return {'name': question['name'], 'question': question['question'], 'seconds': seconds, 'source': source,
+            'stages': turn_stages, 'error': error}
+
+
+def summarize(turns):
+    ok = [turn for turn in turns if turn['error'] is None]
+    stage_names = sorted({name for turn in ok for name in turn['stages']})
+    report_stages = {}
+    for name in stage_names:
+        per_turn = [turn['stages'][name] for turn in ok if name in turn['stages']]
+        report_stages[name] = {
+            'turns': len(per_turn),
+            'count': sum(value['count'] for value in per_turn),
+            'requests': sum(value['requests'] for value in per_turn),
+            'input_tokens': sum(value['input_tokens'] for value in per_turn),
+            'output_tokens': sum(value['output_tokens'] for value in per_turn),
+            'seconds': percentiles([value['seconds'] for value in per_turn]),
+        }
+    sources = {}
+    for turn in ok:
+        sources[turn['source']] = sources.get(turn['source'], 0) + 1
+    return {
+        'turns': len(turns),
+        'errors': len(turns) - len(ok),
+        'end_to_end': percentiles([turn['seconds'] for turn in ok]),
+        'stages': report_stages,
+        'sources': sources,
+    }
+
+
+async def run_benchmark(question_files=DEFAULT_QUESTIONS, repeat=1, concurrency=1, warmup=1,
+                        keep_response_cache=False, session_db=BENCHMARK_SESSION_DB):
+    import utility_functions.rag as rag
+    from our_agents.manager_agent import Manager_Agent
+    from utility_functions.clients import OFFLINE_MODE, warm_up
+    from utility_functions.session_store import SessionStore
+
+    for path in (session_db, session_db + '-wal', session_db + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    store = SessionStore(session_db, shards=1)
+    manager = Manager_Agent()
+    warm_up()
+
+    questions = [question for path in question_files for question in load_questions(path)]
+    for question in questions[:warmup]:
+        # a session of its own, so measured turns start without the warm-up turn in their history
+        await run_turn(manager, store, question, session_prefix='benchmark-warmup')
+
+    semaphore = asyncio.Semaphore(concurrency)
+    # one session per customer, so a customer's turns must not overlap
+    conversations = {}
+    for position, question in enumerate(question for _ in range(repeat) for question in questions):
+        conversations.setdefault(question['name'], []).append((position, question))
+    turns = [None] * (repeat * len(questions))
+
+    async def converse(conversation):
+        for position, question in conversation:
+            async with semaphore:
+                if not keep_response_cache:
+                    # measures the agent path rather than cached answers to repeated questions
+                    rag.response_cache.invalidate()
+                turns[position] = await run_turn(manager, store, question)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(converse(conversation) for conversation in conversations.values()))
+    wall_seconds = time.perf_counter() - start
+
+    report = summarize(turns)
+    report['meta'] = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': _git_revision(),
+        'offline': OFFLINE_MODE,
+        'question_files': list(question_files),
+        'questions': len(questions),
+        'repeat': repeat,
+        'concurrency': concurrency,
+        'wall_seconds': wall_seconds,
+    }
+    report['errors_detail'] = [{'name': turn['name'], 'question': turn['question'], 'error': turn['error']}
+                               for turn in turns if turn['error']]
+    return report
+
+
+def compare(report, baseline, tolerance=0.2, min_delta_ms=5.0):
+    """Regressions of report against baseline, as human-readable lines."""
+    regressions = []
+
+    def check_latency(label, current, previous):
+        for key in ('p50', 'p95'):
+            if key not in current or key not in previous:
+                continue
+            delta_ms = (current[key] - previous[key]) * 1000
+            if current[key] > previous[key] * (1 + tolerance) and delta_ms > min_delta_ms:
+                regressions.append(f'{label} {key}: {previous[key] * 1000:.1f}ms -> {current[key] * 1000:.1f}ms')
+
+    check_latency('end_to_end', report['end_to_end'], baseline.get('end_to_end', {}))
+    for name, current in report['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous is None:
+            continue
+        check_latency(name, current['seconds'], previous['seconds'])
+        for key in ('requests', 'input_tokens', 'output_tokens'):
+            now = current[key] / max(current['turns'], 1)
+            before = previous[key] / max(previous['turns'], 1)
+            if now > before * (1 + tolerance) and now - before >= 1:
+                regressions.append(f'{name} {key} per turn: {before:.1f} -> {now:.1f}')
+    if report['errors'] > baseline.get('errors', 0):
+        regressions.append(f"errors: {baseline.get('errors', 0)} -> {report['errors']}")
+    return regressions
+
+
+def print_report(report):
+    def row(label, seconds, extra=''):
+        values = ' '.join(f"{key}={seconds.get(key, 0) * 1000:8.1f}ms" for key in ('p50', 'p95', 'p99'))
+        print(f'{label:<24} {values} {extra}')
+
+    print(f"{report['turns']} turns, {report['errors']} errors, sources {report['sources']}")
+    row('end_to_end', report['end_to_end'])
+    for name, value in report['stages'].items():
+        row(name, value['seconds'], f"turns={value['turns']} requests={value['requests']} "
+                                    f"tokens={value['input_tokens']}/{value['output_tokens']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark per-stage latency of Manager_Agent.handle_query.")
+    parser.add_argument('--questions', nargs='+', default=DEFAULT_QUESTIONS)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=1, help="Questions run first and left out of the report.")
+    parser.add_argument('--keep-response-cache', action='store_true')
+    parser.add_argument('--output', help="Write the JSON report here.")
+    parser.add_argument('--baseline', help="Compare with this JSON report; exit 1 on regressions.")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--min-delta-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args.questions, args.repeat, args.concurrency, args.warmup,
+                                       args.keep_response_cache))
+    print_report(report)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.min_delta_ms)
+        for line in regressions:
+            print(f'[regression] {line}')
+        raise SystemExit(1 if regressions else 0)
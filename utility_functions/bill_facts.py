@@ -0,0 +1,197 @@
+"""
+Local fact table of ingested bills, and a no-LLM answer path for direct
+field lookups ("what is my amount due", "when is my bill due", ...).
+
+Rows are written when a bill is upserted (see rag.record_bill_facts).
+`answer` only handles questions that map to exactly one stored field for one
+bill; it returns None for everything else so the agent chain can take over.
+
+Usage:
+    python -m utility_functions.bill_facts rebuild
+"""
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import date
+
+from dotenv import load_dotenv
+
+from utility_functions.bill_fields import extract_bill_fields, normalize_customer
+
+load_dotenv()
+
+BILL_FACTS_PATH = os.getenv('BILL_FACTS_PATH', os.path.join('data', 'bill_facts.sqlite'))
+COLUMNS = ['vector_id', 'customer', 'customer_name', 'account_number', 'meter_number',
+           'period_start', 'period_end', 'amount_due', 'due_date', 'usage_kwh']
+
+# checked in order, the first match decides which field is asked for
+QUESTION_PATTERNS = [
+    ('account_number', re.compile(r'\baccount (?:number|#|no)')),
+    ('meter_number', re.compile(r'\bmeter (?:number|#|no)')),
+    ('due_date', re.compile(r'\bdue date\b|\bwhen\b.*\b(?:due|pay)\b|\bpayment due\b|\bdeadline\b')),
+    ('usage_kwh', re.compile(r'\bhow much (?:electricity|energy|power)\b|\bkwh\b|\busage\b|\bconsum')),
+    ('amount_due', re.compile(r'\bamount due\b|\btotal (?:bill|amount|due)\b|\bhow much\b.*\b(?:bill|pay|owe)\b'
+                              r'|\bbalance\b')),
+    ('period', re.compile(r'\bbilling (?:period|cycle)\b')),
+]
+# questions that need reasoning or aggregation go to the agents
+ESCALATE_PATTERN = re.compile(r'\b(?:why|reduce|lower|save|average|avg|compare|increase|decrease|trend|explain|'
+                              r'difference|change|year|past|previous|history|all)\b')
+MONTH_NAMES = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+               'november', 'december']
+MONTHS = {name: i for i, name in enumerate(MONTH_NAMES, start=1)}
+MONTHS.update({name[:3]: i for name, i in MONTHS.items() if name != 'may'}, sept=9)
+# full names and standard abbreviations only, so "marked" or "decide" are not months;
+# "may" is too common a word and only counts next to a day or a year ("may 2024", "3rd of may")
+_MONTH_PATTERN = re.compile(r'\b(' + '|'.join(name for name in MONTHS if name != 'may') + r')\b')
+_MAY_PATTERN = re.compile(r'\bmay,?\s+\d|\b\d{1,2}(?:st|nd|rd|th)?\s+(?:of\s+)?may\b')
+_YEAR_PATTERN = re.compile(r'\b(20\d{2}|19\d{2})\b')
+
+
+def _format_date(iso):
+    return date.fromisoformat(iso).strftime('%B %d, %Y').replace(' 0', ' ')
+
+
+class BillFactStore:
+    def __init__(self, path=BILL_FACTS_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS bills ('
+            'vector_id TEXT PRIMARY KEY, customer TEXT, customer_name TEXT, account_number TEXT, '
+            'meter_number TEXT, period_start TEXT, period_end TEXT, amount_due REAL, due_date TEXT, '
+            'usage_kwh INTEGER, ingested_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS bills_customer ON bills (customer, period_end)')
+        self._conn.commit()
+
+    def add(self, vector_id, fields):
+        values = [vector_id] + [fields.get(column) for column in COLUMNS[1:]]
+        with self._lock:
+            self._conn.execute(
+                f'INSERT OR REPLACE INTO bills ({", ".join(COLUMNS)}, ingested_at) '
+                f'VALUES ({", ".join("?" * len(COLUMNS))}, ?)',
+                (*values, time.time())
+            )
+            self._conn.commit()
+
+    def bills(self, customer):
+        """All bills for a customer, latest billing period first."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM bills WHERE customer = ? ORDER BY period_end DESC, ingested_at DESC',
+                (normalize_customer(customer),)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def fingerprint(self, customer):
+        """Hash of the customer's bill set; it changes whenever a bill is added or replaced."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT vector_id, ingested_at FROM bills WHERE customer = ? ORDER BY vector_id',
+                (normalize_customer(customer or ''),)
+            ).fetchall()
+        return hashlib.sha256(repr([tuple(row) for row in rows]).encode('utf-8')).hexdigest()[:16]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM bills')
+            self._conn.commit()
+
+    @staticmethod
+    def _select_bill(bills, question):
+        """
+        Picks the bill a question refers to by any month/year it mentions, else
+        the latest. A bill belongs to the month its period ends in; the start
+        month is only used when no period ends in the month asked about.
+        """
+        months = {MONTHS[m] for m in _MONTH_PATTERN.findall(question)}
+        if _MAY_PATTERN.search(question):
+            months.add(MONTHS['may'])
+        years = set(_YEAR_PATTERN.findall(question))
+        if not months and not years:
+            return bills[0]
+
+        def mentioned(bill, column):
+            if not bill[column]:
+                return False
+            day = date.fromisoformat(bill[column])
+            return (not months or day.month in months) and (not years or str(day.year) in years)
+
+        for column in ('period_end', 'period_start'):
+            candidates = [bill for bill in bills if mentioned(bill, column)]
+            if candidates:
+                return candidates[0] if len(candidates) == 1 else None
+        return None
+
+    def answer(self, customer, question):
+        """Returns a direct answer from the fact table, or None when the agents should handle it."""
+        if not customer:
+            return None
+        text = question.lower()
+        if ESCALATE_PATTERN.search(text):
+            return None
+        field = next((name for name, pattern in QUESTION_PATTERNS if pattern.search(text)), None)
+        if field is None:
+            return None
+
+        bills = self.bills(customer)
+        if not bills:
+            return None
+        bill = self._select_bill(bills, text)
+        if bill is None:
+            return None
+
+        name = bill['customer_name'] or customer
+        period = (f"{_format_date(bill['period_start'])} to {_format_date(bill['period_end'])}"
+                  if bill['period_start'] and bill['period_end'] else None)
+        for_period = f" for the billing period {period}" if period else ""
+
+        if field == 'amount_due' and bill['amount_due'] is not None:
+            return f"The amount due on {name}'s bill{for_period} is ${bill['amount_due']:.2f}."
+        if field == 'due_date' and bill['due_date']:
+            return f"{name}'s bill{for_period} is due on or before {_format_date(bill['due_date'])}."
+        if field == 'usage_kwh' and bill['usage_kwh'] is not None:
+            return f"{name} used {bill['usage_kwh']} kWh{' from ' + period if period else ''}."
+        if field == 'period' and period:
+            which = 'latest bill' if bill is bills[0] else f"bill ending {_format_date(bill['period_end'])}"
+            return f"The billing period on {name}'s {which} is {period}."
+        if field == 'account_number' and bill['account_number']:
+            return f"The account number on {name}'s bill is {bill['account_number']}."
+        if field == 'meter_number' and bill['meter_number']:
+            return f"The meter number on {name}'s bill is {bill['meter_number']}."
+        return None
+
+
+def rebuild(store, index):
+    """Repopulates the fact table from the captions stored in the vector index."""
+    from utility_functions.vector_store import list_ids
+
+    ids = list_ids(index)
+    added = 0
+    for start in range(0, len(ids), 100):
+        for vector_id, vector in index.fetch(ids=ids[start:start + 100]).vectors.items():
+            caption = (vector.metadata or {}).get('caption')
+            if caption:
+                store.add(vector_id, extract_bill_fields(caption))
+                added += 1
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the bill fact table.")
+    parser.add_argument('command', choices=['rebuild'])
+    args = parser.parse_args()
+
+    import utility_functions.rag as rag
+    from utility_functions.clients import vector_index
+
+    rag.bill_facts.clear()
+    print(f"Added {rebuild(rag.bill_facts, vector_index())} bills")
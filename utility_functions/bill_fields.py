@@ -0,0 +1,156 @@
+"""
+Structured fields pulled out of bill captions at ingestion time.
+
+The fields are stored as vector metadata so retrieval can filter on them
+exactly (see rag.retrieve_bill_embeddings). Extraction is regex-based over
+the caption text; when a client is given and the customer name or amount is
+missing, a small JSON-mode completion fills the gaps.
+
+Usage:
+    python -m utility_functions.bill_fields backfill
+"""
+import argparse
+import json
+import logging
+import re
+from datetime import datetime
+
+FIELD_NAMES = ['customer', 'customer_name', 'account_number', 'meter_number', 'period_start', 'period_end',
+               'amount_due', 'due_date', 'usage_kwh']
+EXTRACTION_MODEL = 'gpt-4o-mini'
+
+log = logging.getLogger(__name__)
+
+_DATE = r'(?:[A-Z][a-z]+\.? \d{1,2},? \d{4}|\d{1,2}/\d{1,2}/\d{4})'
+_NAME_PATTERN = re.compile(r"(?i:service address(?: of)?|customer address|customer name|account holder|"
+                           r"addressed to|under the name|customer|name)(?: is)?:?\s+"
+                           r"([A-Z][A-Za-z'.-]+(?: [A-Z][A-Za-z'.-]+)+)(?:,| at\b|\.)")
+_ACCOUNT_PATTERN = re.compile(r'(?i:account(?: #| number| no\.?)?):?\s*(\d[\d-]{5,}\d)')
+_METER_PATTERN = re.compile(r'(?i:meter(?: #| number| no\.?)?):?\s*(\d{6,})')
+_AMOUNT_PATTERN = re.compile(r'(?i:amount due)[^$\n]{0,20}\$([\d,]+\.\d{2})')
+_DUE_PATTERN = re.compile(rf'(?i:on or before|due date:?|due by|due)\s+({_DATE})')
+_PERIOD_PATTERN = re.compile(rf'(?i:billing period|covers the period)(?i: is)?(?i: from)?:?\s*(?i:from\s+)?'
+                             rf'({_DATE}),?\s*(?:to|through|-)\s*({_DATE})')
+_USAGE_PATTERNS = [re.compile(r'(?i:supply charge) (?:\(|for )([\d,]+)\s*kWh'),
+                   re.compile(r'(?i:usage)(?: of| for the billing period)?:?\s*([\d,]+)\s*kWh')]
+
+
+def normalize_customer(name):
+    """Filter key for a customer name: case-folded with whitespace collapsed."""
+    return ' '.join(name.casefold().split())
+
+
+def parse_date(text):
+    """Returns an ISO date string, or None when text is not a recognised date."""
+    text = text.replace('.', '').strip()
+    for fmt in ('%B %d, %Y', '%B %d %Y', '%b %d, %Y', '%b %d %Y', '%m/%d/%Y'):
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def _number(text):
+    return float(text.replace(',', ''))
+
+
+def parse_caption(caption):
+    fields = {}
+    match = _NAME_PATTERN.search(caption)
+    if match:
+        fields['customer_name'] = match.group(1)
+    match = _ACCOUNT_PATTERN.search(caption)
+    if match:
+        fields['account_number'] = match.group(1)
+    match = _METER_PATTERN.search(caption)
+    if match:
+        fields['meter_number'] = match.group(1)
+    match = _AMOUNT_PATTERN.search(caption)
+    if match:
+        fields['amount_due'] = _number(match.group(1))
+    match = _DUE_PATTERN.search(caption)
+    if match:
+        fields['due_date'] = parse_date(match.group(1))
+    match = _PERIOD_PATTERN.search(caption)
+    if match:
+        fields['period_start'] = parse_date(match.group(1))
+        fields['period_end'] = parse_date(match.group(2))
+    for pattern in _USAGE_PATTERNS:
+        match = pattern.search(caption)
+        if match:
+            fields['usage_kwh'] = int(_number(match.group(1)))
+            break
+    return fields
+
+
+def _llm_fields(caption, client):
+    response = client.chat.completions.create(
+        model=EXTRACTION_MODEL,
+        response_format={'type': 'json_object'},
+        temperature=0,
+        messages=[{
+            'role': 'user',
+            'content': (
+                "Extract these fields from the electricity bill description below and respond only with JSON: "
+                "customer_name, account_number, meter_number, period_start (YYYY-MM-DD), period_end (YYYY-MM-DD), "
+                "amount_due (number), due_date (YYYY-MM-DD), usage_kwh (number). Use null when a field is absent.\n\n"
+                + caption
+            )
+        }]
+    )
+    return json.loads(response.choices[0].message.content)
+
+
+def extract_bill_fields(caption, client=None):
+    """
+    Returns the structured fields found in a caption. Missing fields are left
+    out rather than set to None, since vector metadata cannot hold nulls.
+    """
+    fields = parse_caption(caption)
+    if client is not None and not {'customer_name', 'amount_due'} <= fields.keys():
+        try:
+            for key, value in _llm_fields(caption, client).items():
+                if key in FIELD_NAMES and value is not None and key not in fields:
+                    fields[key] = value
+        except Exception as e:
+            log.warning('extraction fallback failed: %r', e)
+
+    if fields.get('customer_name'):
+        fields['customer'] = normalize_customer(fields['customer_name'])
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def backfill(index, client=None, batch_size=100):
+    """
+    Adds structured fields to every vector in the index that has a caption but
+    no customer field. Returns the number of vectors updated.
+    """
+    from utility_functions.vector_store import list_ids
+
+    ids = list_ids(index)
+    updated = 0
+    for start in range(0, len(ids), batch_size):
+        vectors = index.fetch(ids=ids[start:start + batch_size]).vectors
+        records = []
+        for vector_id, vector in vectors.items():
+            metadata = dict(vector.metadata or {})
+            if 'customer' in metadata or not metadata.get('caption'):
+                continue
+            metadata.update(extract_bill_fields(metadata['caption'], client))
+            records.append((vector_id, list(vector.values), metadata))
+        if records:
+            index.upsert(records)
+            updated += len(records)
+    return updated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Structured bill field tools.")
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--no-llm', action='store_true', help="Only use regex extraction.")
+    args = parser.parse_args()
+
+    from utility_functions.clients import openai_client, vector_index
+
+    print(f"Updated {backfill(vector_index(), None if args.no_llm else openai_client())} vectors")
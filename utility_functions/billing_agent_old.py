@@ -133,17 +133,16 @@ def ask_gpt(name, query, model='gpt-5-chat-latest'):
 
 
 if __name__ == '__main__':
-    test_dir = os.path.join(os.getcwd(), 'tests/billing_agent/')
-    test_questions_df = pd.read_csv(os.path.join(test_dir, 'questions.csv'))
-
-    answers_path = os.path.join(test_dir, 'answers.csv')
-    with open(answers_path, 'w') as f:
-        for i in range(len(test_questions_df)):
-            name = test_questions_df.loc[i]['Name']
-            question = test_questions_df.loc[i]['Question']
-            answer = '"' + ask_gpt(name,question).replace('\n', ' ').replace('"', "'") +'"'
-            content = ','.join([name,question,answer]) + '\n'
-            f.write(content)
+    import asyncio
+
+    # run as a script from utility_functions/, like the `import rag` above expects
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utility_functions.evaluate import main
+
+    async def answer(name, question):
+        return await asyncio.to_thread(ask_gpt, name, question)
+
+    main(answer, target='billing_old', default_output=os.path.join('tests', 'billing_agent', 'answers_old.csv'))
             
 
 
@@ -0,0 +1,233 @@
+"""
+Batch ingestion of historical bills.
+
+Streams PDFs and images out of zip archives and directories without
+extracting them, renders PDF pages in a process pool, captions with bounded
+async concurrency, embeds captions in batched requests and upserts in
+batches. Finished sources are appended to a checkpoint file, so an
+interrupted run picks up where it stopped.
+
+Usage:
+    python -m utility_functions.bulk_ingest [paths ...] [--workers 4] [--concurrency 8] [--batch-size 32]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+import utility_functions.rag as rag
+from utility_functions.clients import async_openai_client, vector_index
+from utility_functions.render_profile import RenderProfile, reencode_image
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOURCES = [os.path.join('data', 'Electricity_bills.zip'),
+                   os.path.join('data', 'pdf'),
+                   os.path.join('data', 'jpeg')]
+CHECKPOINT_PATH = os.path.join('data', 'cache', 'bulk_ingest_checkpoint.jsonl')
+PDF_EXTENSIONS = ('.pdf',)
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png')
+UPSERT_BATCH_SIZE = 100
+
+
+def _kind(name):
+    lower = name.lower()
+    if lower.endswith(PDF_EXTENSIONS):
+        return 'pdf'
+    if lower.endswith(IMAGE_EXTENSIONS):
+        return 'image'
+    return None
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def iter_sources(paths):
+    """
+    Yields (source_name, kind, read) for each bill under the given zip files
+    and directories. `read` loads the bytes lazily, so nothing is extracted
+    to disk and only the current batch is held in memory.
+    """
+    for path in paths:
+        if zipfile.is_zipfile(path):
+            archive = zipfile.ZipFile(path)
+            for member in sorted(archive.namelist()):
+                kind = _kind(member)
+                if kind:
+                    yield f'{path}:{member}', kind, (lambda m=member, a=archive: a.read(m))
+        elif os.path.isdir(path):
+            for file_name in sorted(os.listdir(path)):
+                kind = _kind(file_name)
+                if kind:
+                    file_path = os.path.join(path, file_name)
+                    yield file_path, kind, (lambda p=file_path: _read_file(p))
+        else:
+            log.warning('skipping %s: not a zip file or directory', path)
+
+
+def load_checkpoint(path):
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    done[entry['source']] = entry['id']
+    return done
+
+
+def write_checkpoint(path, entries):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        for source, vector_id in entries:
+            f.write(json.dumps({'source': source, 'id': vector_id}) + '\n')
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def caption_image(image_bytes, file_name, semaphore, multi_modal_model=rag.CAPTION_MODEL):
+    """Captions one image, following rag's VISION_UPLOAD_MODE and VISION_FILE_RETENTION."""
+    async with semaphore:
+        mime_type = mimetypes.guess_type(file_name)[0] or 'image/png'
+        file_id = None
+        if rag.VISION_UPLOAD_MODE == 'upload':
+            uploaded = await async_openai_client().files.create(file=(file_name, image_bytes, mime_type), purpose='vision')
+            file_id = uploaded.id
+        try:
+            response = await async_openai_client().responses.create(
+                model=multi_modal_model,
+                input=rag.caption_input(rag.image_input(image_bytes, mime_type, file_id))
+            )
+        finally:
+            if file_id and rag.VISION_FILE_RETENTION == 'delete':
+                await async_openai_client().files.delete(file_id)
+        if rag.VISION_FILE_RETENTION == 'delete':
+            file_id = None
+        return response.output_text, file_id
+
+
+async def _prepare(source, kind, read, pool, semaphore):
+    """
+    Renders and captions one source. Returns (source, vector_id, embed_result);
+    the embedding is None until the batch is embedded, unless it came from the
+    ingest cache. The caption is cached before it is embedded, so a failed
+    embedding request does not lose it.
+    """
+    loop = asyncio.get_running_loop()
+    data = read()
+    profile = rag.render_profile
+    if kind == 'pdf':
+        image = await loop.run_in_executor(pool, rag.render_pdf_page, data, 0, profile)
+        file_name = f'bill.{profile.extension}'
+    elif profile != RenderProfile():
+        image = await loop.run_in_executor(pool, reencode_image, data, profile)
+        file_name = f'bill.{profile.extension}'
+    else:
+        image = data
+        file_name = os.path.basename(source.split(':')[-1])
+
+    vector_id = hashlib.sha256(image).hexdigest()
+    cached = rag.ingest_cache.get(vector_id, rag.INGEST_VERSION)
+    if cached is not None:
+        return source, vector_id, cached
+
+    caption, file_id = await caption_image(image, file_name, semaphore)
+    embed_result = {'image_caption': caption, 'file_id': file_id, 'embedding': None}
+    await asyncio.to_thread(rag.ingest_cache.put, vector_id, rag.INGEST_VERSION, embed_result)
+    return source, vector_id, embed_result
+
+
+async def _make_record(vector_id, embed_result, semaphore):
+    """rag.make_record, whose bill field extraction is a blocking LLM call, off the event loop."""
+    async with semaphore:
+        return await asyncio.to_thread(rag.make_record, vector_id, embed_result)
+
+
+async def ingest(paths, workers=4, concurrency=8, batch_size=32, checkpoint_path=CHECKPOINT_PATH,
+                 embedding_model=rag.EMBEDDING_MODEL):
+    done = load_checkpoint(checkpoint_path)
+    seen_ids = set(done.values())
+    pending = ((source, kind, read) for source, kind, read in iter_sources(paths) if source not in done)
+    semaphore = asyncio.Semaphore(concurrency)
+    totals = {'upserted': 0, 'cached': 0, 'duplicates': 0, 'failed': 0, 'skipped': len(done)}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for batch in _batched(pending, batch_size):
+            results = await asyncio.gather(*(_prepare(*item, pool, semaphore) for item in batch),
+                                           return_exceptions=True)
+
+            prepared, finished = [], []
+            for item, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    totals['failed'] += 1
+                    log.warning('%s failed: %r', item[0], result)
+                    continue
+                source, vector_id, embed_result = result
+                finished.append((source, vector_id))
+                if vector_id in seen_ids:
+                    totals['duplicates'] += 1
+                    continue
+                seen_ids.add(vector_id)
+                prepared.append((vector_id, embed_result))
+
+            to_embed = [(vector_id, embed_result) for vector_id, embed_result in prepared
+                        if embed_result['embedding'] is None]
+            totals['cached'] += len(prepared) - len(to_embed)
+            if to_embed:
+                response = await async_openai_client().embeddings.create(
+                    input=[embed_result['image_caption'] for _, embed_result in to_embed], model=embedding_model)
+                for (vector_id, embed_result), item in zip(to_embed, response.data):
+                    embed_result['embedding'] = item.embedding
+                    rag.ingest_cache.put(vector_id, rag.INGEST_VERSION, embed_result)
+
+            records = await asyncio.gather(*(_make_record(vector_id, embed_result, semaphore)
+                                             for vector_id, embed_result in prepared))
+            for upsert_batch in _batched(records, UPSERT_BATCH_SIZE):
+                vector_index().upsert(upsert_batch)
+            rag.record_bill_facts(records)
+            totals['upserted'] += len(records)
+
+            write_checkpoint(checkpoint_path, finished)
+            log.info('%s', totals)
+
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk-ingest bills from zip archives and directories.")
+    parser.add_argument('paths', nargs='*', default=DEFAULT_SOURCES)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="Render processes.")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent caption requests.")
+    parser.add_argument('--batch-size', type=int, default=32, help="Sources per embedding/upsert batch.")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--reset', action='store_true', help="Ignore and clear the existing checkpoint.")
+    args = parser.parse_args()
+    logging.basicConfig(format='[bulk_ingest] %(message)s')
+    log.setLevel(logging.INFO)
+
+    if args.reset and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    totals = asyncio.run(ingest(args.paths, workers=args.workers, concurrency=args.concurrency,
+                                batch_size=args.batch_size, checkpoint_path=args.checkpoint))
+    print(json.dumps(totals, indent=2))
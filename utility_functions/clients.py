@@ -0,0 +1,130 @@
+"""
+Shared API clients and the vector index, built on first use.
+
+Importing this module (and the modules that use it) makes no network calls
+and constructs nothing; every process gets a single OpenAI client, a single
+AsyncOpenAI client and a single index handle, created the first time they
+are asked for.
+
+With OFFLINE_MODE=true they are the stand-ins from utility_functions.offline,
+so everything runs without credentials or network.
+
+Cold-start cost is recorded per stage with `startup_stage` and logged by
+`startup_report`. To measure a fresh process:
+    python -m utility_functions.clients
+"""
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OFFLINE_MODE = os.getenv('OFFLINE_MODE', 'false').lower() in ('1', 'true', 'yes')
+
+log = logging.getLogger(__name__)
+
+PROCESS_START = time.perf_counter()
+startup_timings = {}
+
+
+@contextmanager
+def startup_stage(name):
+    """Adds the wall-clock seconds spent inside the block to startup_timings[name]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = startup_timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def startup_report():
+    report = dict(startup_timings)
+    report['since_process_start'] = time.perf_counter() - PROCESS_START
+    log.info('startup %s', ', '.join(f'{stage}: {seconds:.3f}s' for stage, seconds in report.items()))
+    return report
+
+
+@functools.lru_cache(maxsize=None)
+def openai_client():
+    with startup_stage('openai_client'):
+        if OFFLINE_MODE:
+            from utility_functions.offline import OfflineOpenAI
+            return OfflineOpenAI()
+        from openai import OpenAI
+        return OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+
+@functools.lru_cache(maxsize=None)
+def async_openai_client():
+    with startup_stage('async_openai_client'):
+        if OFFLINE_MODE:
+            from utility_functions.offline import OfflineAsyncOpenAI
+            return OfflineAsyncOpenAI()
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+
+@functools.lru_cache(maxsize=None)
+def vector_index():
+    """Pinecone or the in-process NumPy index, selected by VECTOR_BACKEND."""
+    with startup_stage('vector_index'):
+        if OFFLINE_MODE:
+            from utility_functions.offline import offline_index
+            return offline_index()
+        import utility_functions.vector_store as vector_store
+        return vector_store.get_index()
+
+
+def agent_model(name=None):
+    """
+    The model for an agents Agent: the name itself (None for the SDK default),
+    or in OFFLINE_MODE that model bound to the offline client, with tracing off.
+    """
+    if not OFFLINE_MODE:
+        return name
+    from agents import OpenAIResponsesModel, set_tracing_disabled
+    from agents.models import get_default_model
+
+    set_tracing_disabled(True)
+    return OpenAIResponsesModel(model=name or get_default_model(), openai_client=async_openai_client())
+
+
+def model_name(agent):
+    """The model name of an agents Agent, for span attributes."""
+    model = agent.model
+    if model is None or isinstance(model, str):
+        return model or 'default'
+    return str(getattr(model, 'model', type(model).__name__))
+
+
+def warm_up():
+    """Builds everything a first query needs, so it is paid at startup rather than by the first user."""
+    import our_agents.billing_agent as billing_agent
+    import our_agents.explanation_agent as explanation_agent
+    import our_agents.sentiment_agent as sentiment_agent
+
+    openai_client()
+    async_openai_client()
+    vector_index()
+    with startup_stage('agents'):
+        billing_agent.get_agent()
+        explanation_agent.get_agent()
+        sentiment_agent.get_agent()
+    with startup_stage('sentiment_models'):
+        sentiment_agent.classify_local('hello')
+
+
+if __name__ == '__main__':
+    # run as a script this file is __main__, so report through the imported module the app uses
+    import utility_functions.clients as clients
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    clients.PROCESS_START = PROCESS_START
+    with clients.startup_stage('imports'):
+        import our_agents.manager_agent  # noqa: F401
+    clients.warm_up()
+    clients.startup_report()
@@ -0,0 +1,207 @@
+"""
+Binary embedding snapshot.
+
+A snapshot is a directory holding
+    header.json   - {"version", "dim", "dtype", "count"}
+    vectors.bin   - `count` rows of `dim` float32/float16 values, row-major
+    records.jsonl - one {"id", "metadata"} line per row
+
+Vectors are stored L2-normalized so they can be memory-mapped and queried
+directly. Growth is append-only: rows and records are appended first and the
+header count is rewritten last, so a torn append is simply ignored on load.
+When an id is appended again, the later row wins.
+
+Usage:
+    python -m utility_functions.embed_snapshot convert data/embeds.csv data/embeds_snapshot [--float16]
+    python -m utility_functions.embed_snapshot compact data/embeds_snapshot
+"""
+import argparse
+import ast
+import csv
+import json
+import os
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+HEADER_FILE = 'header.json'
+VECTORS_FILE = 'vectors.bin'
+RECORDS_FILE = 'records.jsonl'
+DTYPES = {'float32': np.float32, 'float16': np.float16}
+
+
+def is_snapshot(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def read_header(path):
+    with open(os.path.join(path, HEADER_FILE), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_header(path, header):
+    tmp_path = os.path.join(path, HEADER_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(header, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(path, HEADER_FILE))
+
+
+def _unit_rows(values, dtype):
+    matrix = np.asarray(values, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(dtype)
+
+
+def create(path, dim, dtype='float32'):
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype '{dtype}', expected one of {list(DTYPES)}")
+    os.makedirs(path, exist_ok=True)
+    open(os.path.join(path, VECTORS_FILE), 'wb').close()
+    open(os.path.join(path, RECORDS_FILE), 'w').close()
+    _write_header(path, {'version': SNAPSHOT_VERSION, 'dim': dim, 'dtype': dtype, 'count': 0})
+
+
+def _truncate_to_header(path, header):
+    """Drops anything past the committed count left behind by an interrupted append."""
+    row_bytes = header['dim'] * np.dtype(DTYPES[header['dtype']]).itemsize
+    vectors_path = os.path.join(path, VECTORS_FILE)
+    if os.path.getsize(vectors_path) != header['count'] * row_bytes:
+        with open(vectors_path, 'r+b') as f:
+            f.truncate(header['count'] * row_bytes)
+
+    records_path = os.path.join(path, RECORDS_FILE)
+    with open(records_path, 'rb') as f:
+        lines = f.readlines()
+    if len(lines) != header['count']:
+        with open(records_path, 'wb') as f:
+            f.writelines(lines[:header['count']])
+
+
+def append(path, records):
+    """
+    Appends (id, values, metadata) records to an existing snapshot.
+    Returns the new row count.
+    """
+    records = list(records)
+    header = read_header(path)
+    if not records:
+        return header['count']
+
+    _truncate_to_header(path, header)
+    rows = _unit_rows([values for _, values, _ in records], DTYPES[header['dtype']])
+    if rows.shape[1] != header['dim']:
+        raise ValueError(f"Vector dimension {rows.shape[1]} does not match snapshot dimension {header['dim']}")
+
+    with open(os.path.join(path, VECTORS_FILE), 'ab') as f:
+        f.write(rows.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    with open(os.path.join(path, RECORDS_FILE), 'a', encoding='utf-8') as f:
+        for vector_id, _, metadata in records:
+            f.write(json.dumps({'id': vector_id, 'metadata': metadata or {}}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+    header['count'] += len(records)
+    _write_header(path, header)
+    return header['count']
+
+
+def load(path):
+    """
+    Maps a snapshot read-only. Returns (matrix, ids, metadata) where matrix is a
+    numpy memmap of shape (count, dim); no vector data is copied.
+    Rows superseded by a later append of the same id are dropped from the view.
+    """
+    header = read_header(path)
+    count, dim = header['count'], header['dim']
+    dtype = DTYPES[header['dtype']]
+
+    if count:
+        matrix = np.memmap(os.path.join(path, VECTORS_FILE), dtype=dtype, mode='r', shape=(count, dim))
+    else:
+        matrix = np.empty((0, dim), dtype=dtype)
+
+    ids, metadata = [], []
+    with open(os.path.join(path, RECORDS_FILE), encoding='utf-8') as f:
+        for _, line in zip(range(count), f):
+            record = json.loads(line)
+            ids.append(record['id'])
+            metadata.append(record['metadata'])
+
+    last_row = {vector_id: row for row, vector_id in enumerate(ids)}
+    if len(last_row) != len(ids):
+        keep = sorted(last_row.values())
+        matrix = matrix[keep]
+        ids = [ids[row] for row in keep]
+        metadata = [metadata[row] for row in keep]
+    return matrix, ids, metadata
+
+
+def compact(path):
+    """Rewrites a snapshot keeping only the live row of each id. Returns the new row count."""
+    matrix, ids, metadata = load(path)
+    header = read_header(path)
+    tmp_path = path.rstrip(os.sep) + '.compact'
+    create(tmp_path, header['dim'], header['dtype'])
+    count = append(tmp_path, zip(ids, np.asarray(matrix, dtype=np.float32), metadata))
+    del matrix
+    for name in (VECTORS_FILE, RECORDS_FILE, HEADER_FILE):
+        os.replace(os.path.join(tmp_path, name), os.path.join(path, name))
+    os.rmdir(tmp_path)
+    return count
+
+
+def _parse_metadata(text):
+    if not text:
+        return {}
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return ast.literal_eval(text)
+
+
+def read_csv_records(csv_path):
+    """Yields (id, values, metadata) from an id,values,metadata export such as data/embeds.csv."""
+    csv.field_size_limit(1 << 30)
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield row['id'], json.loads(row['values']), _parse_metadata(row.get('metadata'))
+
+
+def convert(csv_path, out_path, dtype='float32'):
+    records = list(read_csv_records(csv_path))
+    if not records:
+        raise ValueError(f"No records found in {csv_path}")
+    create(out_path, len(records[0][1]), dtype)
+    return append(out_path, records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage binary embedding snapshots.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = sub.add_parser('convert', help="Convert an embeds CSV export into a snapshot.")
+    convert_parser.add_argument('csv_path')
+    convert_parser.add_argument('out_path')
+    convert_parser.add_argument('--float16', action='store_true', help="Store vectors as float16.")
+
+    info_parser = sub.add_parser('info', help="Print a snapshot header.")
+    info_parser.add_argument('path')
+
+    compact_parser = sub.add_parser('compact', help="Drop rows superseded by later appends.")
+    compact_parser.add_argument('path')
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        count = convert(args.csv_path, args.out_path, 'float16' if args.float16 else 'float32')
+        print(f"Wrote {count} vectors to {args.out_path}")
+    elif args.command == 'compact':
+        print(f"Compacted {args.path} to {compact(args.path)} vectors")
+    else:
+        print(json.dumps(read_header(args.path), indent=2))
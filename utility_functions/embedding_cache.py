@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+
+from utility_functions import metrics
+from utility_functions.stages import stage
+
+load_dotenv()
+
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', os.path.join('data', 'cache', 'embeddings.sqlite'))
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '2048'))
+
+_lookups = metrics.counter('rag_cache_lookups_total', 'Cache lookups by cache and result.', ['cache', 'result'])
+
+
+def normalize_text(text):
+    """Cache key form of a query: case-folded with whitespace collapsed."""
+    return ' '.join(text.casefold().split())
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed on (model, normalized text).
+    Tier one is a bounded in-memory LRU, tier two a SQLite table that survives
+    restarts. Pass path=None for a memory-only cache.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings ('
+                'model TEXT NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL, '
+                'PRIMARY KEY (model, text))'
+            )
+            self._conn.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, text, model):
+        key = (model, normalize_text(text))
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                _lookups.inc(cache='embedding', result='memory_hit')
+                return vector
+
+            if self._conn is not None:
+                row = self._conn.execute('SELECT vector FROM embeddings WHERE model = ? AND text = ?', key).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    _lookups.inc(cache='embedding', result='disk_hit')
+                    return vector
+
+            self.misses += 1
+            _lookups.inc(cache='embedding', result='miss')
+            return None
+
+    def put(self, text, model, vector):
+        key = (model, normalize_text(text))
+        with self._lock:
+            self._remember(key, list(vector))
+            if self._conn is not None:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO embeddings (model, text, vector, created_at) VALUES (?, ?, ?, ?)',
+                    (*key, np.asarray(vector, dtype=np.float32).tobytes(), time.time())
+                )
+                self._conn.commit()
+
+    def embed(self, client, texts, model):
+        """
+        Returns embeddings for a string or a list of strings, sending only the
+        cache misses to client.embeddings.create in a single request.
+        """
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+
+        with stage('embedding', kind='embedding', model=model, texts=len(texts)) as current:
+            vectors = [self.get(text, model) for text in texts]
+            missing = {}
+            for i, vector in enumerate(vectors):
+                if vector is None:
+                    missing.setdefault(normalize_text(texts[i]), []).append(i)
+            current.set(cache_hits=len(texts) - sum(len(positions) for positions in missing.values()))
+
+            if missing:
+                inputs = [texts[positions[0]] for positions in missing.values()]
+                response = client.embeddings.create(input=inputs, model=model)
+                current.add_usage(response.usage)
+                for text, positions, item in zip(inputs, missing.values(), response.data):
+                    self.put(text, model, item.embedding)
+                    for i in positions:
+                        vectors[i] = item.embedding
+
+        return vectors[0] if single else vectors
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM embeddings')
+                self._conn.commit()
@@ -0,0 +1,286 @@
+"""
+Evaluation runner for the agent test sets.
+
+Answers every question of the given files with one of the agents, at most
+--concurrency at a time. A failed call is retried with exponential backoff
+and jitter up to --attempts times; a row that still fails is written with
+its error instead of stopping the run. Every finished row is appended to a
+JSONL checkpoint next to the output, so an interrupted run resumes where it
+stopped (failed rows are tried again) unless --fresh is given.
+
+Rows with a ground_truth (tests/billing_agent/ragas_ready.csv) are scored:
+  fact_recall  share of the ground truth's numbers, amounts, dates and
+               months that appear in the answer
+  token_f1     word overlap F1 between answer and ground truth
+  similarity   cosine similarity of their embeddings, with --embed-scores
+The output is CSV or Parquet by extension, with the columns the ragas
+notebook expects (question, ground_truth, answer, contexts) plus name,
+scores, seconds, attempts and error.
+
+Usage:
+    python -m utility_functions.evaluate --target billing|explanation|manager
+        [--questions FILE ...] [--output tests/billing_agent/answers.csv] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from utility_functions.benchmark import load_questions
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUESTIONS = [os.path.join('tests', 'billing_agent', 'questions.csv'),
+                     os.path.join('tests', 'billing_agent', 'ragas_ready.csv')]
+EVAL_CONCURRENCY = int(os.getenv('EVAL_CONCURRENCY', '8'))
+EVAL_ATTEMPTS = int(os.getenv('EVAL_ATTEMPTS', '4'))
+EVAL_TIMEOUT = float(os.getenv('EVAL_TIMEOUT', '120'))
+# first retry delay in seconds, doubled per attempt up to the cap
+EVAL_BACKOFF = 1.0
+EVAL_BACKOFF_CAP = 30.0
+# the manager target's conversations, recreated on every run
+EVAL_SESSION_DB = os.path.join('data', 'cache', 'eval_sessions.sqlite')
+COLUMNS = ['name', 'question', 'ground_truth', 'answer', 'contexts', 'fact_recall', 'token_f1', 'similarity',
+           'seconds', 'attempts', 'error']
+_MONTHS = {'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+           'november', 'december', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov',
+           'dec'}
+_WORD = re.compile(r"[a-z0-9$#./:'-]+")
+
+
+def _words(text):
+    return [word.strip(".,:;'\"$") for word in _WORD.findall((text or '').lower().replace(',', ''))]
+
+
+def facts(text):
+    """The checkable facts of a ground truth: tokens with digits (amounts, dates, ids) and month names."""
+    return {word for word in _words(text) if word and (any(ch.isdigit() for ch in word) or word in _MONTHS)}
+
+
+def fact_recall(answer, ground_truth):
+    expected = facts(ground_truth)
+    if not expected:
+        return None
+    found = set(_words(answer))
+    return len(expected & found) / len(expected)
+
+
+def token_f1(answer, ground_truth):
+    answer_words, truth_words = [w for w in _words(answer) if w], [w for w in _words(ground_truth) if w]
+    if not answer_words or not truth_words:
+        return 0.0
+    common = {}
+    for word in truth_words:
+        common[word] = common.get(word, 0) + 1
+    overlap = 0
+    for word in answer_words:
+        if common.get(word):
+            common[word] -= 1
+            overlap += 1
+    if not overlap:
+        return 0.0
+    precision, recall = overlap / len(answer_words), overlap / len(truth_words)
+    return 2 * precision * recall / (precision + recall)
+
+
+def embedding_similarity(answer, ground_truth):
+    import numpy as np
+
+    import utility_functions.rag as rag
+    from utility_functions.clients import openai_client
+
+    vectors = np.asarray(rag.embedding_cache.embed(openai_client(), [answer, ground_truth], rag.EMBEDDING_MODEL))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return float(vectors[0] @ vectors[1])
+
+
+def row_key(target, question, occurrence):
+    return hashlib.sha1(f"{target}\t{question['name']}\t{question['question']}\t{occurrence}".encode('utf-8')).hexdigest()
+
+
+def load_checkpoint(path):
+    """Finished rows by key; a later line for the same key wins."""
+    rows = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by an interrupted run
+                    continue
+                rows[row['key']] = row
+    return rows
+
+
+async def answer_with_retries(answer_fn, name, question, attempts=EVAL_ATTEMPTS, timeout=EVAL_TIMEOUT):
+    """(answer, attempts used, error) for one question."""
+    for attempt in range(1, attempts + 1):
+        try:
+            answer = await asyncio.wait_for(answer_fn(name, question), timeout)
+            return str(answer), attempt, None
+        except Exception as e:
+            if attempt == attempts:
+                return None, attempt, repr(e)
+            delay = min(EVAL_BACKOFF_CAP, EVAL_BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            log.warning('attempt %d for "%s" failed: %r, retrying in %.1fs', attempt, question[:40], e, delay)
+            await asyncio.sleep(delay)
+
+
+def score(row, embed_scores=False):
+    truth = row.get('ground_truth')
+    if not truth or row.get('answer') is None:
+        return row
+    row['fact_recall'] = fact_recall(row['answer'], truth)
+    row['token_f1'] = token_f1(row['answer'], truth)
+    if embed_scores:
+        try:
+            row['similarity'] = embedding_similarity(row['answer'], truth)
+        except Exception as e:
+            log.warning('similarity failed: %r', e)
+    return row
+
+
+async def evaluate(answer_fn, questions, checkpoint_path, target='agent', concurrency=EVAL_CONCURRENCY,
+                   attempts=EVAL_ATTEMPTS, timeout=EVAL_TIMEOUT, embed_scores=False):
+    """Answers and scores every question, skipping the ones already finished in the checkpoint."""
+    done = load_checkpoint(checkpoint_path)
+    occurrences, keyed = {}, []
+    for question in questions:
+        # repeated questions are separate rows
+        pair = (question['name'], question['question'])
+        occurrence = occurrences[pair] = occurrences.get(pair, -1) + 1
+        keyed.append((row_key(target, question, occurrence), question))
+    pending = [(key, question) for key, question in keyed if key not in done or done[key].get('error')]
+    log.info('%d questions, %d already answered, %d to run', len(keyed), len(keyed) - len(pending), len(pending))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    os.makedirs(os.path.dirname(checkpoint_path) or '.', exist_ok=True)
+    with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        async def one(key, question):
+            async with semaphore:
+                start = time.perf_counter()
+                answer, used, error = await answer_with_retries(answer_fn, question['name'], question['question'],
+                                                                attempts, timeout)
+            source = question['row']
+            row = {'key': key, 'name': question['name'], 'question': question['question'],
+                   'ground_truth': source.get('ground_truth'), 'contexts': source.get('contexts'), 'answer': answer,
+                   'seconds': time.perf_counter() - start, 'attempts': used, 'error': error}
+            row = await asyncio.to_thread(score, row, embed_scores)
+            # one complete line per row, so an interrupted run loses at most the rows in flight
+            checkpoint.write(json.dumps(row) + '\n')
+            checkpoint.flush()
+            done[key] = row
+
+        await asyncio.gather(*(one(key, question) for key, question in pending))
+    return [done[key] for key, _ in keyed]
+
+
+def write_rows(rows, path):
+    rows = [{column: row.get(column) for column in COLUMNS} for row in rows]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if path.endswith('.parquet'):
+        import pandas as pd
+
+        pd.DataFrame(rows, columns=COLUMNS).to_parquet(path, index=False)
+        return
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def summarize(rows):
+    def mean(column):
+        values = [row[column] for row in rows if row.get(column) is not None]
+        return sum(values) / len(values) if values else None
+
+    return {
+        'rows': len(rows),
+        'failed': sum(1 for row in rows if row.get('error')),
+        'scored': sum(1 for row in rows if row.get('fact_recall') is not None or row.get('token_f1') is not None),
+        'fact_recall': mean('fact_recall'),
+        'token_f1': mean('token_f1'),
+        'similarity': mean('similarity'),
+        'mean_seconds': mean('seconds'),
+    }
+
+
+def _manager_answer(session_db=EVAL_SESSION_DB):
+    from our_agents.manager_agent import Manager_Agent
+    from utility_functions.session_history import CompactingSession
+    from utility_functions.session_store import SessionStore
+
+    for path in (session_db, session_db + '-wal', session_db + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    store = SessionStore(session_db, shards=1)
+    manager = Manager_Agent()
+
+    async def answer(name, question):
+        # a conversation of its own per attempt, so rows and retries do not see each other's turns
+        session = await asyncio.to_thread(CompactingSession, store.session(f'eval:{uuid.uuid4().hex}'))
+        return (await manager.handle_query(question, name, has_bill=True, session=session))['response']
+    return answer
+
+
+def target_answer_fn(target):
+    if target == 'billing':
+        import our_agents.billing_agent as billing_agent
+        return billing_agent.get_info
+    if target == 'explanation':
+        import our_agents.explanation_agent as explanation_agent
+        return explanation_agent.get_explanation
+    if target == 'manager':
+        return _manager_answer()
+    raise ValueError(f"Unknown target '{target}', expected billing, explanation or manager")
+
+
+def main(answer_fn=None, target=None, default_output=None, default_questions=DEFAULT_QUESTIONS):
+    """Command line entry point; the agent modules call it with their own answer function."""
+    parser = argparse.ArgumentParser(description="Answer and score the agent test sets.")
+    if answer_fn is None:
+        parser.add_argument('--target', required=True, choices=['billing', 'explanation', 'manager'])
+    parser.add_argument('--questions', nargs='+', default=default_questions)
+    parser.add_argument('--output', default=default_output)
+    parser.add_argument('--concurrency', type=int, default=EVAL_CONCURRENCY)
+    parser.add_argument('--attempts', type=int, default=EVAL_ATTEMPTS)
+    parser.add_argument('--timeout', type=float, default=EVAL_TIMEOUT)
+    parser.add_argument('--embed-scores', action='store_true', help="Also score by embedding similarity.")
+    parser.add_argument('--fresh', action='store_true', help="Ignore and replace the checkpoint.")
+    args = parser.parse_args()
+    # progress from this module only, not the INFO records of the agents it runs
+    logging.basicConfig(format='[eval] %(message)s')
+    log.setLevel(logging.INFO)
+
+    target = target or args.target
+    output = args.output or os.path.join('tests', f'{target}_agent', 'answers.csv')
+    checkpoint_path = f'{os.path.splitext(output)[0]}.checkpoint.jsonl'
+    if args.fresh and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    questions = [question for path in args.questions if os.path.exists(path) for question in load_questions(path)]
+    start = time.perf_counter()
+    rows = asyncio.run(evaluate(answer_fn or target_answer_fn(target), questions, checkpoint_path, target,
+                                args.concurrency, args.attempts, args.timeout, args.embed_scores))
+    write_rows(rows, output)
+    summary = summarize(rows)
+    summary['wall_seconds'] = time.perf_counter() - start
+    log.info('wrote %s: %s', output, ', '.join(
+        f'{key}={value:.3f}' if isinstance(value, float) else f'{key}={value}' for key, value in summary.items()))
+    return summary
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Content-addressed cache of ingestion results.
+
+Rows are keyed on the SHA-256 of the rendered bill (the vector id from
+rag.hash_file) and hold the caption, its embedding and the vision file_id.
+A caption is stored as soon as it comes back, with an empty embedding until
+it has been embedded, so a failed embedding request does not lose it.
+Each row records the pipeline version it was produced with, a hash of the
+caption model, embedding model and caption prompt. Changing any of those
+makes old rows miss, and `purge-stale` deletes them.
+
+Usage:
+    python -m utility_functions.ingest_cache stats
+    python -m utility_functions.ingest_cache purge-stale
+    python -m utility_functions.ingest_cache clear
+    python -m utility_functions.ingest_cache cleanup-files
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INGEST_CACHE_PATH = os.getenv('INGEST_CACHE_PATH', os.path.join('data', 'cache', 'ingest.sqlite'))
+
+
+def pipeline_version(multi_modal_model, embedding_model, prompt):
+    key = '\x1f'.join([multi_modal_model, embedding_model, prompt])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+class IngestCache:
+    def __init__(self, path=INGEST_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS ingested ('
+            'content_hash TEXT PRIMARY KEY, version TEXT NOT NULL, caption TEXT NOT NULL, '
+            'embedding BLOB NOT NULL, file_id TEXT, created_at REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    def get(self, content_hash, version):
+        """
+        Returns the cached vision_embed_file result, or None on a miss or a
+        stale version. The embedding is None for a caption not yet embedded.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT caption, embedding, file_id FROM ingested WHERE content_hash = ? AND version = ?',
+                (content_hash, version)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'image_caption': row[0],
+            'embedding': np.frombuffer(row[1], dtype=np.float32).tolist() if row[1] else None,
+            'file_id': row[2],
+        }
+
+    def put(self, content_hash, version, embed_result):
+        embedding = embed_result['embedding']
+        embedding = b'' if embedding is None else np.asarray(embedding, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO ingested (content_hash, version, caption, embedding, file_id, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (content_hash, version, embed_result['image_caption'], embedding,
+                 embed_result.get('file_id'), time.time())
+            )
+            self._conn.commit()
+
+    def get_file_id(self, content_hash):
+        """Returns a kept vision file_id for this content under any version, so re-captioning can skip the upload."""
+        with self._lock:
+            row = self._conn.execute('SELECT file_id FROM ingested WHERE content_hash = ?', (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def file_ids(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT file_id FROM ingested WHERE file_id IS NOT NULL').fetchall()
+        return {row[0] for row in rows}
+
+    def invalidate(self, content_hash=None, keep_version=None):
+        """
+        Deletes one entry by hash, every entry not produced by keep_version,
+        or everything when neither is given. Returns the number of rows removed.
+        """
+        with self._lock:
+            if content_hash is not None:
+                cursor = self._conn.execute('DELETE FROM ingested WHERE content_hash = ?', (content_hash,))
+            elif keep_version is not None:
+                cursor = self._conn.execute('DELETE FROM ingested WHERE version != ?', (keep_version,))
+            else:
+                cursor = self._conn.execute('DELETE FROM ingested')
+            self._conn.commit()
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT version, COUNT(*) FROM ingested GROUP BY version').fetchall()
+        return {version: count for version, count in rows}
+
+
+if __name__ == '__main__':
+    import utility_functions.rag as rag
+
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the ingestion cache.")
+    parser.add_argument('command', choices=['stats', 'purge-stale', 'clear', 'cleanup-files'])
+    parser.add_argument('--max-age-hours', type=float, default=24,
+                        help="cleanup-files: only delete unreferenced vision files older than this.")
+    args = parser.parse_args()
+
+    cache = rag.ingest_cache
+    if args.command == 'stats':
+        print(json.dumps({'current_version': rag.INGEST_VERSION, 'entries': cache.stats()}, indent=2))
+    elif args.command == 'purge-stale':
+        print(f"Removed {cache.invalidate(keep_version=rag.INGEST_VERSION)} stale entries")
+    elif args.command == 'cleanup-files':
+        print(f"Deleted {len(rag.cleanup_vision_files(args.max_age_hours))} unreferenced vision files")
+    else:
+        print(f"Removed {cache.invalidate()} entries")
@@ -0,0 +1,138 @@
+"""
+Background ingestion of uploaded bills.
+
+Jobs are keyed by the SHA-256 of the uploaded PDF, so submitting the same
+file again (for example on every Streamlit rerun while it is attached)
+returns the existing job instead of doing the work twice. The PDF is
+written to INGEST_UPLOAD_DIR and the job row to a SQLite table, then a
+small thread pool runs rag.ingest_pdf and records each stage. Jobs left
+queued or running by a restart are picked up again by `resume`.
+
+Usage:
+    python -m utility_functions.ingest_jobs list
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+INGEST_JOBS_PATH = os.getenv('INGEST_JOBS_PATH', os.path.join('data', 'cache', 'ingest_jobs.sqlite'))
+INGEST_UPLOAD_DIR = os.getenv('INGEST_UPLOAD_DIR', os.path.join('data', 'cache', 'uploads'))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '2'))
+# states a job does not leave on its own; only 'failed' jobs are retried on resubmission
+FINISHED = ('done', 'duplicate', 'failed')
+COLUMNS = ['job_id', 'file_name', 'status', 'stage', 'vector_id', 'error', 'submitted_at', 'started_at',
+           'finished_at']
+
+
+class IngestJobQueue:
+    def __init__(self, path=INGEST_JOBS_PATH, upload_dir=INGEST_UPLOAD_DIR, workers=INGEST_WORKERS):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        os.makedirs(upload_dir, exist_ok=True)
+        self.upload_dir = upload_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS ingest_jobs ('
+            'job_id TEXT PRIMARY KEY, file_name TEXT, status TEXT NOT NULL, stage TEXT, vector_id TEXT, '
+            'error TEXT, submitted_at REAL NOT NULL, started_at REAL, finished_at REAL)'
+        )
+        self._conn.commit()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+
+    def _upload_path(self, job_id):
+        return os.path.join(self.upload_dir, f'{job_id}.pdf')
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._conn.execute(
+                f'UPDATE ingest_jobs SET {", ".join(f"{name} = ?" for name in fields)} WHERE job_id = ?',
+                (*fields.values(), job_id)
+            )
+            self._conn.commit()
+
+    def submit(self, pdf_bytes, file_name=None):
+        """Queues a bill unless the same file is already queued, running or ingested. Returns the job id."""
+        pdf_bytes = bytes(pdf_bytes)
+        job_id = hashlib.sha256(pdf_bytes).hexdigest()
+        with self._lock:
+            row = self._conn.execute('SELECT status FROM ingest_jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row and row['status'] != 'failed':
+                return job_id
+            with open(self._upload_path(job_id), 'wb') as f:
+                f.write(pdf_bytes)
+            self._conn.execute(
+                'INSERT OR REPLACE INTO ingest_jobs (job_id, file_name, status, stage, submitted_at) '
+                "VALUES (?, ?, 'queued', NULL, ?)",
+                (job_id, file_name, time.time())
+            )
+            self._conn.commit()
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def _run(self, job_id):
+        import utility_functions.rag as rag
+
+        self._update(job_id, status='running', started_at=time.time())
+        try:
+            with open(self._upload_path(job_id), 'rb') as f:
+                pdf_bytes = f.read()
+            vector_id, response = rag.ingest_pdf(pdf_bytes, progress=lambda stage: self._update(job_id, stage=stage))
+            self._update(job_id, status='done' if response is not None else 'duplicate', stage=None,
+                         vector_id=vector_id, finished_at=time.time())
+            os.remove(self._upload_path(job_id))
+        except Exception as e:
+            log.exception('job %s failed: %r', job_id[:12], e)
+            self._update(job_id, status='failed', error=repr(e), finished_at=time.time())
+
+    def status(self, job_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM ingest_jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def jobs(self, limit=50):
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM ingest_jobs ORDER BY submitted_at DESC LIMIT ?',
+                                      (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def resume(self):
+        """Requeues jobs interrupted by a restart. Returns how many were requeued."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM ingest_jobs WHERE status IN ('queued', 'running')").fetchall()
+        resumed = 0
+        for row in rows:
+            if os.path.exists(self._upload_path(row['job_id'])):
+                self._update(row['job_id'], status='queued', stage=None)
+                self._executor.submit(self._run, row['job_id'])
+                resumed += 1
+            else:
+                self._update(row['job_id'], status='failed', error='upload missing after restart',
+                             finished_at=time.time())
+        return resumed
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect the bill ingestion queue.")
+    parser.add_argument('command', choices=['list'])
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    for job in IngestJobQueue(workers=1).jobs(args.limit):
+        print(' '.join(f'{column}={job[column]}' for column in COLUMNS if job[column] is not None))
@@ -0,0 +1,82 @@
+"""
+Lightweight local intent model.
+
+Each intent is represented by the centroid of its labeled examples in
+data/intent_examples.csv, over unigram and bigram counts. A query is scored
+by cosine similarity against every centroid in one matrix-vector product,
+with features weighted by inverse document frequency over the examples.
+It has no network calls and no model downloads, and classification takes
+microseconds. The questions of tests/billing_agent are kept out of the
+examples, so benchmark and evaluation runs measure held-out accuracy.
+"""
+import csv
+import os
+import re
+
+import numpy as np
+
+INTENT_EXAMPLES_PATH = os.getenv('INTENT_EXAMPLES_PATH', os.path.join('data', 'intent_examples.csv'))
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+STOPWORDS = {'a', 'an', 'the', 'is', 'are', 'am', 'was', 'my', 'me', 'i', 'im', 'you', 'your', 'it', 'its',
+             'this', 'that', 'to', 'of', 'on', 'in', 'for', 'do', 'does', 'did', 'can', 'so', 'and', 'be'}
+
+
+def _features(text):
+    tokens = [t for t in _TOKEN_PATTERN.findall(text.lower().replace("'", '')) if t not in STOPWORDS]
+    return tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+
+
+class CentroidIntentClassifier:
+    def __init__(self, examples):
+        """examples: iterable of (text, intent) pairs."""
+        examples = list(examples)
+        self.intents = sorted({intent for _, intent in examples})
+        self.vocabulary = {}
+        document_frequency = {}
+        for text, _ in examples:
+            for feature in set(_features(text)):
+                self.vocabulary.setdefault(feature, len(self.vocabulary))
+                document_frequency[feature] = document_frequency.get(feature, 0) + 1
+        self.idf = np.ones(len(self.vocabulary), dtype=np.float32)
+        for feature, count in document_frequency.items():
+            self.idf[self.vocabulary[feature]] = np.log((1 + len(examples)) / (1 + count)) + 1
+
+        centroids = np.zeros((len(self.intents), len(self.vocabulary)), dtype=np.float32)
+        for text, intent in examples:
+            centroids[self.intents.index(intent)] += self._vectorize(text)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.centroids = centroids / norms
+
+    @classmethod
+    def from_csv(cls, path=INTENT_EXAMPLES_PATH):
+        with open(path, newline='', encoding='utf-8') as f:
+            return cls((row['text'], row['intent']) for row in csv.DictReader(f))
+
+    def _vectorize(self, text):
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for feature in _features(text):
+            position = self.vocabulary.get(feature)
+            if position is not None:
+                vector[position] += 1.0
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def scores(self, text):
+        """Cosine similarity of text to every intent centroid, as {intent: score}."""
+        return dict(zip(self.intents, (self.centroids @ self._vectorize(text)).tolist()))
+
+    def classify(self, text):
+        """
+        Returns (intent, score, margin), where margin is the gap to the second
+        best intent. Unknown vocabulary gives ('unknown', 0.0, 0.0).
+        """
+        scores = self.centroids @ self._vectorize(text)
+        order = np.argsort(-scores)
+        best = float(scores[order[0]])
+        if best == 0.0:
+            return 'unknown', 0.0, 0.0
+        runner_up = float(scores[order[1]]) if len(order) > 1 else 0.0
+        return self.intents[order[0]], best, best - runner_up
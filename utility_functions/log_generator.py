@@ -1,29 +1,252 @@
+"""
+Application logging: a queue-backed pipeline to rotating, compressed JSON-lines files.
+
+Code logs through the standard logging module. `setup` installs one
+QueueHandler on the root logger. The calling thread only stamps the record
+with the current trace id and puts it on a bounded queue without waiting;
+when the queue is full the record is dropped and counted in
+rag_log_records_dropped_total instead of slowing the turn down. A
+QueueListener thread does all the formatting and file I/O.
+
+The file handler writes one JSON object per line to LOG_DIR/<name>.log,
+with the time, level, logger, message and trace id, plus any `extra`
+fields (a turn's spans, for instance). It rotates when the file reaches
+LOG_MAX_MB or is LOG_ROTATE_HOURS old. A rotated file is gzipped to
+<name>.log.<timestamp>.gz on the listener thread. Afterwards at most
+LOG_BACKUP_COUNT archives per log are kept, and the oldest archives of
+any log in the directory are deleted until it holds at most
+LOG_MAX_TOTAL_MB.
+
+Levels: LOG_LEVEL for everything, and LOG_LEVELS for single loggers, e.g.
+"trace=DEBUG,httpx=WARNING". With LOG_CONSOLE the records also go to
+stderr as text.
+"""
+import atexit
+import copy
+import datetime
+import gzip
+import json
+import logging
+import logging.handlers
 import os
-import sys
+import queue
+import shutil
+import threading
 import time
-import streamlit as st
 
+from dotenv import load_dotenv
+
+from utility_functions import metrics
+from utility_functions.stages import TraceContextFilter
+
+load_dotenv()
+
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_MAX_MB = float(os.getenv('LOG_MAX_MB', '10'))
+LOG_ROTATE_HOURS = float(os.getenv('LOG_ROTATE_HOURS', '24'))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '10'))
+LOG_MAX_TOTAL_MB = float(os.getenv('LOG_MAX_TOTAL_MB', '200'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_CONSOLE = os.getenv('LOG_CONSOLE', 'false').lower() in ('1', 'true', 'yes')
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s'
+
+_dropped = metrics.counter('rag_log_records_dropped_total', 'Log records dropped because the log queue was full.')
+_rotations = metrics.counter('rag_log_rotations_total', 'Log files rotated and compressed.')
+
+# attributes every LogRecord has; anything else on a record came in through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'trace_id': getattr(record, 'trace_id', None),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class CompressingRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    Rotates on size or age, whichever comes first, gzips the rotated file and
+    prunes archives by count and by the total size of the log directory.
+    """
+
+    def __init__(self, filename, max_bytes, rotate_seconds, backup_count, max_total_bytes):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        super().__init__(filename, 'a', encoding='utf-8', delay=False)
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.max_total_bytes = max_total_bytes
+        # an existing file keeps the age it had before a restart
+        self.rollover_at = os.path.getmtime(self.baseFilename) + rotate_seconds
+        self._prune()
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            return False
+        size = self.stream.tell()
+        return size >= self.max_bytes or (size > 0 and time.time() >= self.rollover_at)
+
+    def doRollover(self):
+        self.stream.close()
+        self.stream = None
+        rotated = f"{self.baseFilename}.{time.strftime('%Y%m%d-%H%M%S')}"
+        suffix = 0
+        while os.path.exists(rotated + '.gz') or os.path.exists(rotated):
+            suffix += 1
+            rotated = f"{self.baseFilename}.{time.strftime('%Y%m%d-%H%M%S')}-{suffix}"
+        os.replace(self.baseFilename, rotated)
+        self.stream = self._open()
+        self.rollover_at = time.time() + self.rotate_seconds
+
+        with open(rotated, 'rb') as source, gzip.open(rotated + '.gz', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.remove(rotated)
+        _rotations.inc()
+        self._prune()
+
+    def _prune(self):
+        prefix = os.path.basename(self.baseFilename) + '.'
+        directory = os.path.dirname(self.baseFilename)
+        files = []
+        for entry in os.scandir(directory):
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.name, entry.path))
+            except FileNotFoundError:
+                # pruned by another process writing to the same directory
+                continue
+        files.sort()
+
+        archives = [file for file in files if file[2].startswith(prefix) and file[2].endswith('.gz')]
+        removed = set()
+        for _, _, _, path in archives[:max(len(archives) - self.backup_count, 0)]:
+            _remove(path)
+            removed.add(path)
+
+        # then the oldest archives of every log here, and the files of the old one-file-per-start logger
+        total = sum(size for _, size, _, path in files if path not in removed)
+        for _, size, name, path in files:
+            if total <= self.max_total_bytes:
+                break
+            if path not in removed and (name.endswith('.gz') or name.isdigit()):
+                _remove(path)
+                total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records instead of waiting when the queue is full."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped.inc()
+
+    def prepare(self, record):
+        # keeps the exception apart from the message so the JSON line has both fields
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # the queue may be full; wait for room rather than lose the shutdown signal
+        self.queue.put(self._sentinel, timeout=5)
+
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def _level(name):
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level '{name}'")
+    return level
+
+
+def setup(name='app', level=LOG_LEVEL, levels=LOG_LEVELS, console=LOG_CONSOLE, log_dir=LOG_DIR):
+    """
+    Routes the root logger through the queue to LOG_DIR/<name>.log. Processes
+    that run at the same time need different names. Only the first call in a
+    process does anything; returns the listener.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
 
-log_dir = os.path.join(os.getcwd(),'logs/')
-if not os.path.exists(log_dir):
-    os.mkdir(log_dir)
+        handlers = [CompressingRotatingFileHandler(
+            os.path.join(log_dir, f'{name}.log'), int(LOG_MAX_MB * 1024 * 1024), LOG_ROTATE_HOURS * 3600,
+            LOG_BACKUP_COUNT, int(LOG_MAX_TOTAL_MB * 1024 * 1024))]
+        handlers[0].setFormatter(JsonFormatter())
+        if console:
+            handlers.append(logging.StreamHandler())
+            handlers[-1].setFormatter(logging.Formatter(TEXT_FORMAT))
 
-def trim_logs():
-    logs = os.listdir(log_dir)
-    logs_sorted = sorted(logs, key=lambda x :int(x))
-    os.remove(os.path.join(log_dir, logs_sorted[0]))
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        queue_handler = NonBlockingQueueHandler(log_queue)
+        # the trace id lives in the caller's context, so it is read before the record is queued
+        queue_handler.addFilter(TraceContextFilter())
 
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(_level(level))
+        for pair in filter(None, (item.strip() for item in levels.split(','))):
+            logger_name, _, logger_level = pair.partition('=')
+            logging.getLogger(logger_name.strip()).setLevel(_level(logger_level))
 
+        _listener = _Listener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop)
+        return _listener
 
-@st.cache_resource
-def start_log():
-    time_stamp = str(time.time()).split('.')[0]
-    saved_stdout = sys.stdout
-    f = open(log_dir + time_stamp, "w", encoding='utf-8')
-    sys.stdout = f
 
-    if len(os.listdir(log_dir)) > 10:
-        trim_logs()
-    return saved_stdout
+def stop():
+    """Writes out what is still queued and closes the files."""
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
 
 
+def start_log(name='frontend'):
+    """Logging for the Streamlit app; safe to call on every rerun."""
+    return setup(name)
@@ -0,0 +1,477 @@
+"""
+Offline stand-ins for the OpenAI API and the vector index.
+
+With OFFLINE_MODE=true, utility_functions.clients hands out these instead of
+the real clients, so the whole pipeline (ingestion, router, agents, chat)
+runs without credentials or network and can be benchmarked reproducibly.
+
+- embeddings.create returns deterministic unit vectors: the sum of one
+  pseudo-random vector per word, so texts sharing words are similar.
+- responses.create and chat.completions.create answer from OFFLINE_SCRIPT,
+  a JSON list of {"match": regex, "response": text} tried against the last
+  user message, else from OFFLINE_RESPONSE_TEMPLATE. When the request
+  offers function tools and none has run since the user spoke, the first
+  tool is called once, with string arguments taken from the prompt, so the
+  agents exercise their tools. stream=True yields the text word by word.
+- files.create/list/delete keep files in memory.
+- The index is an in-memory LocalIndex, seeded from the local snapshot
+  when there is one and never written back.
+
+Each call sleeps for a latency drawn from OFFLINE_LATENCY and fails with
+probability OFFLINE_ERROR_RATE, per endpoint (embeddings, responses, chat,
+files, index). Both take "endpoint=value" pairs separated by commas, a
+value without an endpoint being the default:
+    OFFLINE_LATENCY=lognormal:0.05:0.3,responses=lognormal:0.8:0.4,index=uniform:0.005:0.02
+    OFFLINE_ERROR_RATE=0,responses=0.02
+Latencies are fixed:s, uniform:low:high, normal:mean:sd or
+lognormal:median:sigma, in seconds. OFFLINE_SEED fixes the random draws.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+import httpx
+import numpy as np
+import openai
+from dotenv import load_dotenv
+from openai.types import CreateEmbeddingResponse, FileDeleted, FileObject
+from openai.types.chat import ChatCompletion
+from openai.types.responses import Response, ResponseCompletedEvent, ResponseCreatedEvent, ResponseTextDeltaEvent
+from openai.types.responses.response_usage import InputTokensDetails, OutputTokensDetails
+
+load_dotenv()
+
+OFFLINE_LATENCY = os.getenv('OFFLINE_LATENCY', 'fixed:0')
+OFFLINE_ERROR_RATE = os.getenv('OFFLINE_ERROR_RATE', '0')
+OFFLINE_SEED = int(os.getenv('OFFLINE_SEED', '0'))
+OFFLINE_SCRIPT = os.getenv('OFFLINE_SCRIPT')
+OFFLINE_RESPONSE_TEMPLATE = os.getenv('OFFLINE_RESPONSE_TEMPLATE', 'Offline answer from {model}: {prompt}')
+OFFLINE_EMBEDDING_DIM = int(os.getenv('OFFLINE_EMBEDDING_DIM', '1536'))
+# seconds between streamed words
+OFFLINE_STREAM_DELAY = float(os.getenv('OFFLINE_STREAM_DELAY', '0'))
+ENDPOINTS = ['embeddings', 'responses', 'chat', 'files', 'index']
+_WORD_PATTERN = re.compile(r'\w+')
+_QUOTED_PATTERN = re.compile(r'"([^"]+)"')
+
+
+def _per_endpoint(spec):
+    """Parses 'default,endpoint=value,...' into {endpoint: value}."""
+    values = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        endpoint, _, value = part.rpartition('=')
+        values[endpoint or '*'] = value
+    return {endpoint: values.get(endpoint, values.get('*')) for endpoint in ENDPOINTS}
+
+
+def _sampler(spec):
+    kind, *params = (spec or 'fixed:0').split(':')
+    params = [float(param) for param in params]
+    if kind == 'fixed':
+        return lambda rng: params[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(params[0], params[1])
+    if kind == 'normal':
+        return lambda rng: max(0.0, rng.gauss(params[0], params[1]))
+    if kind == 'lognormal':
+        return lambda rng: params[0] * math.exp(rng.gauss(0.0, params[1])) if params[0] > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution '{kind}', expected fixed, uniform, normal or lognormal")
+
+
+class FaultInjector:
+    """Draws per-endpoint latencies and failures from one seeded generator."""
+
+    def __init__(self, latency=OFFLINE_LATENCY, error_rate=OFFLINE_ERROR_RATE, seed=OFFLINE_SEED):
+        self.latency = {endpoint: _sampler(spec) for endpoint, spec in _per_endpoint(latency).items()}
+        self.error_rate = {endpoint: float(rate or 0) for endpoint, rate in _per_endpoint(error_rate).items()}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+
+    def draw(self, endpoint):
+        """Returns (seconds to wait, whether the call fails)."""
+        with self._lock:
+            self.calls[endpoint] += 1
+            seconds = self.latency[endpoint](self._rng)
+            failed = self._rng.random() < self.error_rate[endpoint]
+            if failed:
+                self.errors[endpoint] += 1
+        return seconds, failed
+
+    def _error(self, endpoint):
+        if endpoint == 'index':
+            return ConnectionError('offline index: injected failure')
+        request = httpx.Request('POST', f'https://offline.invalid/v1/{endpoint}')
+        return openai.InternalServerError('offline: injected failure', response=httpx.Response(500, request=request),
+                                          body=None)
+
+    def wait(self, endpoint):
+        seconds, failed = self.draw(endpoint)
+        time.sleep(seconds)
+        if failed:
+            raise self._error(endpoint)
+
+    async def wait_async(self, endpoint):
+        seconds, failed = self.draw(endpoint)
+        await asyncio.sleep(seconds)
+        if failed:
+            raise self._error(endpoint)
+
+    def stats(self):
+        return {'calls': dict(self.calls), 'errors': dict(self.errors)}
+
+
+@lru_cache(maxsize=None)
+def faults():
+    """The process-wide injector shared by every stand-in."""
+    return FaultInjector()
+
+
+@lru_cache(maxsize=65536)
+def _word_vector(word, dim):
+    seed = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def embed_text(text, dim=OFFLINE_EMBEDDING_DIM):
+    words = _WORD_PATTERN.findall(text.lower()) or ['']
+    vector = np.sum([_word_vector(word, dim) for word in words], axis=0)
+    return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def _message_text(content):
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content or ''
+
+
+def _last_user_text(messages):
+    if isinstance(messages, str):
+        return messages
+    for message in reversed(messages):
+        if isinstance(message, dict) and message.get('role') == 'user':
+            return _message_text(message.get('content'))
+    return ''
+
+
+@lru_cache(maxsize=None)
+def _script(path):
+    if not path:
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [(re.compile(rule['match'], re.IGNORECASE), rule['response']) for rule in json.load(f)]
+
+
+def reply_text(model, prompt):
+    """The scripted reply for prompt, or the template when no rule matches."""
+    for pattern, response in _script(OFFLINE_SCRIPT):
+        if pattern.search(prompt):
+            return response.format(model=model, prompt=prompt)
+    return OFFLINE_RESPONSE_TEMPLATE.format(model=model, prompt=prompt[:200])
+
+
+def _tool_arguments(parameters, prompt):
+    """Arguments for a function tool: quoted text for *name* strings, the prompt for other strings."""
+    quoted = _QUOTED_PATTERN.search(prompt)
+    arguments = {}
+    for name, spec in (parameters or {}).get('properties', {}).items():
+        types = spec.get('type') or [option.get('type') for option in spec.get('anyOf', [])]
+        types = [types] if isinstance(types, str) else types
+        if 'string' in types:
+            arguments[name] = quoted.group(1) if quoted and 'name' in name else prompt
+        elif 'null' in types:
+            arguments[name] = None
+        elif 'array' in types:
+            arguments[name] = []
+        elif 'integer' in types or 'number' in types:
+            arguments[name] = 0
+        elif 'boolean' in types:
+            arguments[name] = False
+    return arguments
+
+
+def _pending_tool_call(input_items, tools, prompt):
+    """The first function tool, unless a tool already ran after the last user message."""
+    if not isinstance(input_items, str):
+        for item in reversed(input_items):
+            if not isinstance(item, dict):
+                continue
+            if item.get('role') == 'user':
+                break
+            if item.get('type') == 'function_call_output':
+                return None
+    for tool in tools or []:
+        # handoffs are tools too, but following one would just move the conversation
+        if tool.get('type') == 'function' and not tool.get('name', '').startswith('transfer_to_'):
+            return {'type': 'function_call', 'id': f'fc_{uuid.uuid4().hex}', 'call_id': f'call_{uuid.uuid4().hex}',
+                    'name': tool['name'], 'arguments': json.dumps(_tool_arguments(tool.get('parameters'), prompt)),
+                    'status': 'completed'}
+    return None
+
+
+def _zero_details(model):
+    # the detail fields differ between openai versions
+    return {name: 0 for name, field in model.model_fields.items() if field.is_required()}
+
+
+def _usage(prompt, text):
+    input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(text)
+    return {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens,
+            'input_tokens_details': _zero_details(InputTokensDetails),
+            'output_tokens_details': _zero_details(OutputTokensDetails)}
+
+
+def _response(model, input_items, tools=None, instructions=None):
+    # the agents SDK passes openai's NOT_GIVEN/omit sentinels for unset arguments
+    tools = tools if isinstance(tools, list) else []
+    instructions = instructions if isinstance(instructions, str) else ''
+    prompt = _last_user_text(input_items)
+    tool_call = _pending_tool_call(input_items, tools, prompt)
+    if tool_call is not None:
+        output, text = [tool_call], ''
+    else:
+        text = reply_text(model, prompt)
+        output = [{'type': 'message', 'id': f'msg_{uuid.uuid4().hex}', 'role': 'assistant', 'status': 'completed',
+                   'content': [{'type': 'output_text', 'text': text, 'annotations': []}]}]
+    return Response.model_validate({
+        'id': f'resp_{uuid.uuid4().hex}', 'object': 'response', 'created_at': time.time(), 'model': model,
+        'status': 'completed', 'output': output, 'parallel_tool_calls': False, 'tool_choice': 'auto',
+        'tools': tools, 'usage': _usage(f'{instructions} {prompt}', text),
+    })
+
+
+def _stream_chunks(response):
+    """Splits the reply into word-sized deltas."""
+    text = response.output_text
+    if not text:
+        return []
+    return re.findall(r'\S+\s*', text)
+
+
+class _Responses:
+    def create(self, model, input, tools=None, instructions=None, stream=False, **kwargs):
+        faults().wait('responses')
+        return _response(model, input, tools, instructions)
+
+
+class _AsyncResponses:
+    def create(self, model, input, tools=None, instructions=None, stream=False, **kwargs):
+        # a coroutine in both cases, like AsyncOpenAI; streams resolve to an async iterator of events
+        if stream:
+            return self._stream(model, input, tools, instructions)
+        return self._create(model, input, tools, instructions)
+
+    async def _create(self, model, input, tools, instructions):
+        await faults().wait_async('responses')
+        return _response(model, input, tools, instructions)
+
+    async def _stream(self, model, input, tools, instructions):
+        await faults().wait_async('responses')
+        response = _response(model, input, tools, instructions)
+        return self._events(response)
+
+    async def _events(self, response):
+        sequence = itertools.count()
+        yield ResponseCreatedEvent(type='response.created', sequence_number=next(sequence), response=response)
+        item_id = response.output[0].id
+        for chunk in _stream_chunks(response):
+            if OFFLINE_STREAM_DELAY:
+                await asyncio.sleep(OFFLINE_STREAM_DELAY)
+            yield ResponseTextDeltaEvent(type='response.output_text.delta', sequence_number=next(sequence),
+                                         item_id=item_id, output_index=0, content_index=0, delta=chunk, logprobs=[])
+        yield ResponseCompletedEvent(type='response.completed', sequence_number=next(sequence), response=response)
+
+
+def _chat_completion(model, messages, response_format=None, **kwargs):
+    prompt = _last_user_text(messages)
+    if isinstance(response_format, dict) and response_format.get('type') in ('json_object', 'json_schema'):
+        text = '{}'
+    else:
+        text = reply_text(model, prompt)
+    usage = _usage(prompt, text)
+    return ChatCompletion.model_validate({
+        'id': f'chatcmpl-{uuid.uuid4().hex}', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': text}}],
+        'usage': {'prompt_tokens': usage['input_tokens'], 'completion_tokens': usage['output_tokens'],
+                  'total_tokens': usage['total_tokens']},
+    })
+
+
+class _Completions:
+    def create(self, model, messages, **kwargs):
+        faults().wait('chat')
+        return _chat_completion(model, messages, **kwargs)
+
+
+class _AsyncCompletions:
+    async def create(self, model, messages, **kwargs):
+        await faults().wait_async('chat')
+        return _chat_completion(model, messages, **kwargs)
+
+
+def _embeddings(model, input, dimensions=None):
+    texts = [input] if isinstance(input, str) else list(input)
+    dim = dimensions or OFFLINE_EMBEDDING_DIM
+    tokens = sum(estimate_tokens(text) for text in texts)
+    return CreateEmbeddingResponse.model_validate({
+        'object': 'list', 'model': model,
+        'data': [{'object': 'embedding', 'index': i, 'embedding': embed_text(text, dim)} for i, text in enumerate(texts)],
+        'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+    })
+
+
+class _Embeddings:
+    def create(self, input, model, dimensions=None, **kwargs):
+        faults().wait('embeddings')
+        return _embeddings(model, input, dimensions)
+
+
+class _AsyncEmbeddings:
+    async def create(self, input, model, dimensions=None, **kwargs):
+        await faults().wait_async('embeddings')
+        return _embeddings(model, input, dimensions)
+
+
+class _FileStore:
+    """Uploaded files of both clients, metadata only."""
+
+    def __init__(self):
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def create(self, file, purpose):
+        if isinstance(file, tuple):
+            file_name, content = file[0], file[1]
+        else:
+            file_name, content = os.path.basename(getattr(file, 'name', 'upload')), file.read()
+        file_object = FileObject(id=f'file-{uuid.uuid4().hex}', object='file', bytes=len(content),
+                                 created_at=int(time.time()), filename=file_name, purpose=purpose, status='processed')
+        with self._lock:
+            self.files[file_object.id] = file_object
+        return file_object
+
+    def delete(self, file_id):
+        with self._lock:
+            deleted = self.files.pop(file_id, None) is not None
+        return FileDeleted(id=file_id, object='file', deleted=deleted)
+
+    def list(self, purpose=None):
+        with self._lock:
+            return [file for file in self.files.values() if purpose is None or file.purpose == purpose]
+
+
+_file_store = _FileStore()
+
+
+class _Files:
+    def create(self, file, purpose, **kwargs):
+        faults().wait('files')
+        return _file_store.create(file, purpose)
+
+    def delete(self, file_id):
+        faults().wait('files')
+        return _file_store.delete(file_id)
+
+    def list(self, purpose=None, **kwargs):
+        faults().wait('files')
+        return _file_store.list(purpose)
+
+
+class _AsyncFiles:
+    async def create(self, file, purpose, **kwargs):
+        await faults().wait_async('files')
+        return _file_store.create(file, purpose)
+
+    async def delete(self, file_id):
+        await faults().wait_async('files')
+        return _file_store.delete(file_id)
+
+    async def list(self, purpose=None, **kwargs):
+        await faults().wait_async('files')
+        return _file_store.list(purpose)
+
+
+class _Namespace:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class OfflineOpenAI:
+    """The subset of openai.OpenAI the app uses."""
+
+    def __init__(self):
+        self.responses = _Responses()
+        self.chat = _Namespace(completions=_Completions())
+        self.embeddings = _Embeddings()
+        self.files = _Files()
+
+
+class OfflineAsyncOpenAI:
+    """The subset of openai.AsyncOpenAI the app and the agents SDK use."""
+
+    base_url = httpx.URL('https://offline.invalid/v1/')
+
+    def __init__(self):
+        self.responses = _AsyncResponses()
+        self.chat = _Namespace(completions=_AsyncCompletions())
+        self.embeddings = _AsyncEmbeddings()
+        self.files = _AsyncFiles()
+
+
+class OfflineIndex:
+    """Wraps a LocalIndex with the injected index latency and failures."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def fetch(self, ids):
+        faults().wait('index')
+        return self.index.fetch(ids)
+
+    def query(self, vector, top_k=5, include_metadata=True, filter=None, **kwargs):
+        faults().wait('index')
+        return self.index.query(vector, top_k=top_k, include_metadata=include_metadata, filter=filter, **kwargs)
+
+    def upsert(self, vectors, **kwargs):
+        faults().wait('index')
+        return self.index.upsert(vectors, **kwargs)
+
+    def list(self, prefix=None, limit=100, **kwargs):
+        # one injected round trip per page, like paging through Pinecone
+        for page in self.index.list(prefix=prefix, limit=limit, **kwargs):
+            faults().wait('index')
+            yield page
+
+
+def offline_index():
+    """An in-memory index, seeded from the local snapshot or CSV export when there is one."""
+    import utility_functions.embed_snapshot as embed_snapshot
+    from utility_functions.vector_store import LOCAL_INDEX_PATH, LocalIndex
+
+    if embed_snapshot.is_snapshot(LOCAL_INDEX_PATH):
+        index = LocalIndex.from_snapshot(LOCAL_INDEX_PATH, persist=False)
+    elif os.path.isfile(LOCAL_INDEX_PATH):
+        index = LocalIndex.from_csv(LOCAL_INDEX_PATH)
+    else:
+        index = LocalIndex(dim=OFFLINE_EMBEDDING_DIM)
+    return OfflineIndex(index)
@@ -1,28 +1,61 @@
 import os
+import base64
+import functools
+import mimetypes
 import tempfile
 import zipfile
 import hashlib
 import time
 
 import numpy as np
-import pandas as pd
-import pymupdf
-import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
-from pinecone import Pinecone
+
+from utility_functions.clients import OFFLINE_MODE, openai_client, vector_index
+from utility_functions.embedding_cache import EmbeddingCache
+from utility_functions.ingest_cache import IngestCache, pipeline_version
+from utility_functions.render_profile import RenderProfile, render_page
+from utility_functions.bill_fields import extract_bill_fields, normalize_customer
+from utility_functions.bill_facts import BillFactStore
+from utility_functions.response_cache import ResponseCache
+from utility_functions.stages import stage
 
 load_dotenv()
 
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
-PINECONE_ENVIRONMENT = os.getenv('PINECONE_ENVIRONMENT')
-PINECONE_INDEX_NAME = "retrieval-augmented-generation"
+# the OpenAI client and the vector index are built on first use, see utility_functions.clients
+
+CAPTION_MODEL = 'gpt-4.1-mini'
+EMBEDDING_MODEL = 'text-embedding-3-small'
+if OFFLINE_MODE:
+    # keeps offline captions and embeddings apart from real ones in the caches keyed by model
+    CAPTION_MODEL, EMBEDDING_MODEL = f'offline/{CAPTION_MODEL}', f'offline/{EMBEDDING_MODEL}'
+CAPTION_PROMPT = "What's in this image?"
+# captions cached under another model or prompt are treated as misses
+INGEST_VERSION = pipeline_version(CAPTION_MODEL, EMBEDDING_MODEL, CAPTION_PROMPT)
+
+# The caches open their SQLite files when first used rather than at import; the
+# module __getattr__ below serves them as rag.embedding_cache, rag.ingest_cache, ...
+_SHARED = {
+    # query embeddings, keyed on (model, normalized text)
+    'embedding_cache': EmbeddingCache,
+    'ingest_cache': IngestCache,
+    # structured fields of every upserted bill, for the no-LLM answer path
+    'bill_facts': BillFactStore,
+    # final answers to repeated questions, scoped to the customer's current bills
+    'response_cache': ResponseCache,
+}
 
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-pc = Pinecone(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
-index = pc.Index(PINECONE_INDEX_NAME)
+@functools.lru_cache(maxsize=None)
+def _shared(name):
+    return _SHARED[name]()
+
+render_profile = RenderProfile.from_env()
+# 'upload' sends the image through client.files.create, 'inline' embeds it as a data URL
+VISION_UPLOAD_MODE = os.getenv('VISION_UPLOAD_MODE', 'upload').lower()
+# 'delete' removes uploaded vision files once captioned, 'keep' stores the file_id for reuse
+VISION_FILE_RETENTION = os.getenv('VISION_FILE_RETENTION', 'delete').lower()
+# retry a customer-scoped query unfiltered when it matches nothing, for vectors ingested before bill fields existed
+RETRIEVAL_UNFILTERED_FALLBACK = os.getenv('RETRIEVAL_UNFILTERED_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
 
 
 def hash_file(filepath):
@@ -30,71 +63,179 @@ def hash_file(filepath):
         return hashlib.sha256(f.read()).hexdigest()
 
 
-def vision_embed_file(file_path, multi_modal_model='gpt-4.1-mini', embedding_model='text-embedding-3-small'):
+def render_pdf_page(pdf_bytes, page=0, profile=None):
+    """Renders one page of a PDF to image bytes using the configured render profile."""
+    import pymupdf
+
+    with pymupdf.open(stream=bytes(pdf_bytes), filetype='pdf') as doc:
+        return render_page(doc[page], profile or render_profile)
+
+
+def make_record(vector_id, embed_result):
+    """Builds the upsert tuple, with structured bill fields alongside the caption in the metadata."""
+    metadata = {'caption': embed_result['image_caption']}
+    metadata.update(extract_bill_fields(embed_result['image_caption'], openai_client()))
+    return (vector_id, embed_result['embedding'], metadata)
+
+
+def record_bill_facts(records):
+    for vector_id, _, metadata in records:
+        _shared('bill_facts').add(vector_id, metadata)
+        if metadata.get('customer'):
+            _shared('response_cache').invalidate(metadata['customer'])
+
+
+def image_input(image_bytes, mime_type, file_id=None):
+    if file_id:
+        return {'type': 'input_image', 'file_id': file_id}
+    encoded = base64.b64encode(image_bytes).decode('utf-8')
+    return {'type': 'input_image', 'image_url': f'data:{mime_type};base64,{encoded}'}
+
+
+def caption_input(image_part):
+    return [{
+        'role': 'user',
+        'content': [
+            {'type': 'input_text', 'text': CAPTION_PROMPT},
+            image_part
+        ]
+    }]
+
+
+def vision_embed_file(file_path, multi_modal_model=CAPTION_MODEL, embedding_model=EMBEDDING_MODEL, file_id=None):
+    """
+    Captions an image and embeds the caption. An existing vision file_id is
+    reused when given; otherwise the image is uploaded or sent inline
+    according to VISION_UPLOAD_MODE.
+    """
     def create_file(file_path_inner):
         with open(file_path_inner, "rb") as file_content:
-            result = client.files.create(
+            result = openai_client().files.create(
                 file=file_content,
                 purpose="vision",
             )
             return result.id
 
-    file_id = create_file(file_path)
-    # st.write(f"Debug: created file_id: {file_id}")
+    with open(file_path, 'rb') as f:
+        image_bytes = f.read()
+    mime_type = mimetypes.guess_type(file_path)[0] or 'image/png'
 
+    uploaded = False
+    if file_id is None and VISION_UPLOAD_MODE == 'upload':
+        file_id = create_file(file_path)
+        uploaded = True
 
-    response = client.responses.create(
-        model=multi_modal_model,
-        input=[{
-            'role': 'user',
-            'content': [
-                {'type': 'input_text', 'text': "What's in this image?"},
-                {'type': 'input_image', 'file_id': file_id}
-            ]
-        }]
-    )
+    try:
+        with stage('caption', kind='llm', model=multi_modal_model, reused_file=not uploaded and file_id is not None) as current:
+            response = openai_client().responses.create(
+                model=multi_modal_model,
+                input=caption_input(image_input(image_bytes, mime_type, file_id))
+            )
+            current.add_usage(response.usage)
+    except Exception:
+        if uploaded or file_id is None:
+            raise
+        # the reused file may have been cleaned up; fall back to a fresh request
+        return vision_embed_file(file_path, multi_modal_model, embedding_model)
+    finally:
+        if uploaded and VISION_FILE_RETENTION == 'delete':
+            openai_client().files.delete(file_id)
+
+    if VISION_FILE_RETENTION == 'delete':
+        file_id = None
 
     caption = response.output_text
-    embedding = client.embeddings.create(input=caption, model=embedding_model).data[0].embedding
+    return {'image_caption': caption, 'file_id': file_id, 'embedding': embed_caption(caption, embedding_model)}
+
 
-    return {'image_caption': caption, 'file_id': file_id, 'embedding': embedding}
+def embed_caption(caption, embedding_model=EMBEDDING_MODEL):
+    with stage('embedding', kind='embedding', model=embedding_model, texts=1, cache_hits=0) as current:
+        embedding_response = openai_client().embeddings.create(input=caption, model=embedding_model)
+        current.add_usage(embedding_response.usage)
+    return embedding_response.data[0].embedding
 
 
-def file_to_upsert(file):        
+def cleanup_vision_files(max_age_hours=24):
+    """
+    Deletes vision files older than max_age_hours that the ingest cache does
+    not reference, such as uploads orphaned before files were cleaned up.
+    Returns the deleted file ids.
+    """
+    referenced = _shared('ingest_cache').file_ids()
+    cutoff = time.time() - max_age_hours * 3600
+    deleted = []
+    for file in openai_client().files.list(purpose='vision'):
+        if file.id not in referenced and file.created_at < cutoff:
+            openai_client().files.delete(file.id)
+            deleted.append(file.id)
+    return deleted
+
+
+def ingest_pdf(pdf_bytes, progress=None):
+    """
+    Renders, captions, embeds and upserts one bill. Returns (vector_id, upsert
+    response), with None as the response when the bill is already indexed.
+    progress, if given, is called with the name of each stage as it starts.
+    """
+    progress = progress or (lambda stage: None)
     with tempfile.TemporaryDirectory() as tmp_dir:
+        progress('rendering')
+        image_path = os.path.join(tmp_dir, f'uploaded.{render_profile.extension}')
+        with open(image_path, 'wb') as f:
+            f.write(render_pdf_page(pdf_bytes))
+
+        vector_id = hash_file(image_path)
 
-        file_path = os.path.join(tmp_dir, "uploaded.pdf")
-        with open(file_path, "wb") as f:
-            f.write(file.getbuffer())
+        embed_result = _shared('ingest_cache').get(vector_id, INGEST_VERSION)
+        if embed_result is not None and embed_result['embedding'] is None:
+            # captioned by a bulk run whose embedding request failed
+            embed_result['embedding'] = embed_caption(embed_result['image_caption'])
+            _shared('ingest_cache').put(vector_id, INGEST_VERSION, embed_result)
+        elif embed_result is not None:
+            res = vector_index().fetch(ids=[vector_id])
+            if vector_id in res.vectors:
+                return vector_id, None
+        else:
+            progress('captioning')
+            embed_result = vision_embed_file(image_path, file_id=_shared('ingest_cache').get_file_id(vector_id))
+            _shared('ingest_cache').put(vector_id, INGEST_VERSION, embed_result)
 
-        
-        doc = pymupdf.open(file_path)
-        pix = doc[0].get_pixmap(dpi=300)        
-        png_path = os.path.join(tmp_dir,'uploaded.png')  
-        pix.save(png_path)
-        doc.close()  
-      
-        vector_id = hash_file(png_path)
+    progress('indexing')
+    record = make_record(vector_id, embed_result)
+    response = vector_index().upsert([record])
+    record_bill_facts([record])
+    return vector_id, response
 
-        res = index.fetch(ids=[vector_id])
-        if vector_id in res.vectors:
-            st.warning(f"File already uploaded")
 
-        embed_result = vision_embed_file(png_path)
-        record = {
-            'id': vector_id,
-            'values': embed_result['embedding'],
-            'metadata': {'caption': embed_result['image_caption']}
-        }
-    
-    return index.upsert([tuple(record.values())])
+def file_to_upsert(file):
+    _, response = ingest_pdf(file.getbuffer())
+    if response is None:
+        import streamlit as st
 
+        st.warning(f"File already uploaded")
+    return response
 
 
-def retrieve_bill_embeddings(user_query, embed_model='text-embedding-3-small', k=5):
+def retrieve_bill_embeddings(user_query, embed_model=EMBEDDING_MODEL, k=5, customer=None, filter=None):
+    """
+    Returns the captions of the k bills closest to user_query. With customer,
+    only that customer's bills are ranked; filter takes any other metadata
+    filter in Pinecone syntax, e.g. {'period_start': {'$gte': '2021-01-01'}}.
+    """
     # print('QUERY:  ', user_query)
-    query_embedding = client.embeddings.create(input=user_query, model=embed_model).data[0].embedding
-    query_response = index.query(vector=query_embedding, top_k=k, include_metadata=True)
+    query_embedding = _shared('embedding_cache').embed(openai_client(), user_query, embed_model)
+
+    if customer:
+        customer_filter = {'customer': normalize_customer(customer)}
+        filter = {'$and': [customer_filter, filter]} if filter else customer_filter
+    with stage('vector_query', kind='vector', top_k=k, filtered=filter is not None) as current:
+        query_response = vector_index().query(vector=query_embedding, top_k=k, include_metadata=True, filter=filter)
+        current.add(requests=1)
+        if customer and not query_response.matches and RETRIEVAL_UNFILTERED_FALLBACK:
+            query_response = vector_index().query(vector=query_embedding, top_k=k, include_metadata=True)
+            current.add(requests=1)
+            current.set(unfiltered_fallback=True)
+        current.set(matches=len(query_response.matches))
 
     contexts = [match.metadata.get('caption', '') for match in query_response.matches]
     return contexts
@@ -109,6 +250,17 @@ def retrieve_bill_embeddings(user_query, embed_model='text-embedding-3-small', k
 #            "content":user_prompt}])
 #   return response.output_text
 
+def __getattr__(name):
+    if name in _SHARED:
+        return _shared(name)
+    # rag.client / rag.index, for callers written before the clients became lazy
+    if name == 'client':
+        return openai_client()
+    if name == 'index':
+        return vector_index()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def history_to_file(history):
     # Uploads history to pinecone DB
     # maybe, idk if we gonna use this yet
@@ -0,0 +1,114 @@
+import io
+import math
+import os
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FORMATS = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """
+    How a bill page is turned into the image sent for captioning.
+    The defaults reproduce the original 300 dpi full-page PNG, so vector ids
+    of already-ingested bills stay the same unless a profile is configured.
+    """
+    dpi: int = 300
+    grayscale: bool = False
+    image_format: str = 'png'
+    quality: int = 85
+    # upper bound on width * height; the dpi is lowered to fit
+    max_pixels: int | None = None
+    # (x0, y0, x1, y1) as fractions of the page, e.g. (0, 0, 1, 0.5) for the top half
+    crop: tuple[float, float, float, float] | None = None
+
+    def __post_init__(self):
+        if self.image_format not in FORMATS:
+            raise ValueError(f"Unsupported image format '{self.image_format}', expected one of {list(FORMATS)}")
+
+    @property
+    def mime_type(self):
+        return FORMATS[self.image_format]
+
+    @property
+    def extension(self):
+        return 'jpg' if self.image_format == 'jpeg' else self.image_format
+
+    @classmethod
+    def from_env(cls):
+        crop = os.getenv('RENDER_CROP')
+        max_pixels = os.getenv('RENDER_MAX_PIXELS')
+        return cls(
+            dpi=int(os.getenv('RENDER_DPI', '300')),
+            grayscale=os.getenv('RENDER_GRAYSCALE', 'false').lower() in ('1', 'true', 'yes'),
+            image_format=os.getenv('RENDER_FORMAT', 'png').lower(),
+            quality=int(os.getenv('RENDER_QUALITY', '85')),
+            max_pixels=int(max_pixels) if max_pixels else None,
+            crop=tuple(float(v) for v in crop.split(',')) if crop else None,
+        )
+
+
+def _clip(page, profile):
+    if not profile.crop:
+        return page.rect
+    import pymupdf
+
+    x0, y0, x1, y1 = profile.crop
+    rect = page.rect
+    return pymupdf.Rect(rect.x0 + x0 * rect.width, rect.y0 + y0 * rect.height,
+                        rect.x0 + x1 * rect.width, rect.y0 + y1 * rect.height)
+
+
+def _encode_pil(image, profile):
+    buffer = io.BytesIO()
+    if profile.image_format == 'png':
+        image.save(buffer, 'PNG')
+    else:
+        image.save(buffer, profile.image_format.upper(), quality=profile.quality)
+    return buffer.getvalue()
+
+
+def render_page(page, profile):
+    """Renders a pymupdf page to encoded image bytes according to profile."""
+    import pymupdf
+
+    clip = _clip(page, profile)
+    dpi = profile.dpi
+    if profile.max_pixels:
+        pixels = (clip.width / 72 * dpi) * (clip.height / 72 * dpi)
+        if pixels > profile.max_pixels:
+            dpi = int(dpi * math.sqrt(profile.max_pixels / pixels))
+
+    colorspace = pymupdf.csGRAY if profile.grayscale else pymupdf.csRGB
+    pix = page.get_pixmap(dpi=dpi, colorspace=colorspace, clip=None if clip == page.rect else clip)
+
+    if profile.image_format == 'png':
+        return pix.tobytes('png')
+    if profile.image_format == 'jpeg':
+        return pix.tobytes('jpeg', jpg_quality=profile.quality)
+
+    # pymupdf cannot write WebP, Pillow (a Streamlit dependency) can
+    from PIL import Image
+
+    mode = 'L' if profile.grayscale else 'RGB'
+    return _encode_pil(Image.frombytes(mode, (pix.width, pix.height), pix.samples), profile)
+
+
+def reencode_image(image_bytes, profile):
+    """Applies a profile to an already-rasterized bill such as data/jpeg/*.jpeg."""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_bytes))
+    if profile.crop:
+        x0, y0, x1, y1 = profile.crop
+        image = image.crop((int(x0 * image.width), int(y0 * image.height),
+                            int(x1 * image.width), int(y1 * image.height)))
+    if profile.max_pixels and image.width * image.height > profile.max_pixels:
+        scale = math.sqrt(profile.max_pixels / (image.width * image.height))
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+    image = image.convert('L' if profile.grayscale else 'RGB')
+    return _encode_pil(image, profile)
@@ -0,0 +1,142 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from dotenv import load_dotenv
+
+from utility_functions import metrics
+
+load_dotenv()
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '512'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+# cosine similarity a new query needs to a cached one to reuse its answer
+RESPONSE_CACHE_THRESHOLD = float(os.getenv('RESPONSE_CACHE_THRESHOLD', '0.92'))
+
+_lookups = metrics.counter('rag_cache_lookups_total', 'Cache lookups by cache and result.', ['cache', 'result'])
+
+_MONTHS = {'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+           'november', 'december', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov',
+           'dec'}
+# words that pick a different bill for the same question
+_REFERENCES = {'last', 'previous', 'prior', 'this', 'current', 'next', 'latest', 'first', 'earlier', 'ago'}
+_WORD = re.compile(r"[a-z0-9$./-]+")
+
+
+def query_entities(text):
+    """
+    The words of a query that tie it to particular bills or amounts: numbers,
+    dates, month names and relative references, sorted. They are part of the
+    cache scope, so "amount due in March" never answers "amount due in April".
+    """
+    words = {word.strip('.,$/-') for word in _WORD.findall(text.lower())}
+    return tuple(sorted(word for word in words
+                        if word and (any(ch.isdigit() for ch in word) or word in _MONTHS or word in _REFERENCES)))
+
+
+@dataclass
+class CachedResponse:
+    scope: tuple
+    vector: np.ndarray
+    response: str
+    source: str
+    seconds: float
+    created_at: float
+
+
+class ResponseCache:
+    """
+    In-memory semantic cache of final answers.
+
+    Entries live under a scope of (customer, bill fingerprint, has_bill, query
+    entities) and match a new query when the cosine similarity of their query
+    embeddings is at least `threshold`. The bill fingerprint changes whenever a bill
+    is added for the customer, so stale answers are never served; `invalidate`
+    also drops them eagerly. Eviction is LRU over all scopes, plus a TTL.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, threshold=RESPONSE_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _drop(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._scopes[entry.scope]
+        ids.discard(entry_id)
+        if not ids:
+            del self._scopes[entry.scope]
+
+    def get(self, scope, vector):
+        """Returns the closest live CachedResponse in scope above the threshold, or None."""
+        vector = self._unit(vector)
+        now = time.time()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._scopes.get(scope, ())):
+                entry = self._entries[entry_id]
+                if now - entry.created_at > self.ttl:
+                    self._drop(entry_id)
+                    continue
+                score = float(entry.vector @ vector)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                _lookups.inc(cache='response', result='miss')
+                return None
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            self.hits += 1
+            self.saved_seconds += entry.seconds
+            _lookups.inc(cache='response', result='hit')
+            return entry
+
+    def put(self, scope, vector, response, source, seconds):
+        """seconds is how long the uncached answer took, credited to saved_seconds on each hit."""
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = CachedResponse(scope, self._unit(vector), response, source, seconds, time.time())
+            self._scopes.setdefault(scope, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, customer=None):
+        """Drops every entry for a normalized customer name, or everything when customer is None."""
+        with self._lock:
+            stale = [entry_id for entry_id, entry in self._entries.items()
+                     if customer is None or entry.scope[0] == customer]
+            for entry_id in stale:
+                self._drop(entry_id)
+            self.invalidations += len(stale)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'saved_seconds': self.saved_seconds,
+            'invalidations': self.invalidations,
+            'entries': len(self._entries),
+        }
@@ -0,0 +1,177 @@
+"""
+Running sentiment statistics per chat session.
+
+Each session keeps a count, mean, exponentially weighted moving average and
+the last few scores, updated in O(1) per turn. They are persisted in a
+session_sentiment table inside the session's own SQLite file, next to
+the conversation history. A SessionStore session lends its shared
+connection and tells the store when maintenance deletes sessions, so no
+stale stats stay cached.
+
+Usage:
+    python -m utility_functions.sentiment_stats [--db session_history.sqlite] [--limit 20]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SENTIMENT_EWMA_ALPHA = float(os.getenv('SENTIMENT_EWMA_ALPHA', '0.3'))
+SENTIMENT_WINDOW = int(os.getenv('SENTIMENT_WINDOW', '10'))
+# sessions whose stats are kept in memory between turns
+SENTIMENT_STATS_CACHE_SIZE = 1024
+
+
+@dataclass
+class SentimentStats:
+    count: int = 0
+    mean: float = 0.0
+    ewma: float = 0.0
+    window: deque = field(default_factory=lambda: deque(maxlen=SENTIMENT_WINDOW))
+    updated_at: float = 0.0
+
+    def update(self, score, alpha=SENTIMENT_EWMA_ALPHA):
+        self.count += 1
+        self.mean += (score - self.mean) / self.count
+        self.ewma = score if self.count == 1 else alpha * score + (1 - alpha) * self.ewma
+        self.window.append(score)
+        self.updated_at = time.time()
+        return self
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'ewma': self.ewma,
+                'window': list(self.window), 'updated_at': self.updated_at}
+
+
+class SentimentStatsStore:
+    def __init__(self, path, cache_size=SENTIMENT_STATS_CACHE_SIZE, execute=None):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # a SessionStore session lends its shared connection, anything else gets one of our own
+        self._execute = execute
+        if self._execute is None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._execute = self._own_execute
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS session_sentiment ('
+            'session_id TEXT PRIMARY KEY, count INTEGER NOT NULL, mean REAL NOT NULL, ewma REAL NOT NULL, '
+            'recent_scores TEXT NOT NULL, updated_at REAL NOT NULL)',
+            commit=True
+        )
+
+    def _own_execute(self, sql, params=(), commit=False):
+        rows = self._conn.execute(sql, params).fetchall()
+        if commit:
+            self._conn.commit()
+        return rows
+
+    def _load(self, session_id):
+        stats = self._cache.get(session_id)
+        if stats is None:
+            rows = self._execute(
+                'SELECT count, mean, ewma, recent_scores, updated_at FROM session_sentiment WHERE session_id = ?',
+                (session_id,)
+            )
+            row = rows[0] if rows else None
+            stats = SentimentStats()
+            if row:
+                stats.count, stats.mean, stats.ewma = row[0], row[1], row[2]
+                stats.window.extend(json.loads(row[3]))
+                stats.updated_at = row[4]
+            self._cache[session_id] = stats
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return stats
+
+    def record(self, session_id, score):
+        """Adds one turn's score and returns a snapshot of the updated stats."""
+        with self._lock:
+            stats = self._load(session_id).update(score)
+            self._execute(
+                'INSERT OR REPLACE INTO session_sentiment (session_id, count, mean, ewma, recent_scores, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (session_id, stats.count, stats.mean, stats.ewma, json.dumps(list(stats.window)), stats.updated_at),
+                commit=True
+            )
+            return stats.as_dict()
+
+    def get(self, session_id):
+        with self._lock:
+            return self._load(session_id).as_dict()
+
+    def sessions(self, limit=20, order_by='ewma'):
+        """Stats for many sessions, e.g. the most negative ones first, for dashboards."""
+        if order_by not in ('ewma', 'mean', 'count', 'updated_at'):
+            raise ValueError(f"Cannot order sessions by '{order_by}'")
+        direction = 'DESC' if order_by in ('count', 'updated_at') else 'ASC'
+        with self._lock:
+            rows = self._execute(
+                f'SELECT session_id, count, mean, ewma, recent_scores, updated_at FROM session_sentiment '
+                f'ORDER BY {order_by} {direction} LIMIT ?',
+                (limit,)
+            )
+        return [{'session_id': row[0], 'count': row[1], 'mean': row[2], 'ewma': row[3],
+                 'window': json.loads(row[4]), 'updated_at': row[5]} for row in rows]
+
+    def delete(self, session_id):
+        with self._lock:
+            self._cache.pop(session_id, None)
+            self._execute('DELETE FROM session_sentiment WHERE session_id = ?', (session_id,), commit=True)
+
+    def forget(self, session_ids):
+        """Drops cached stats of sessions whose rows were deleted elsewhere."""
+        with self._lock:
+            for session_id in session_ids:
+                self._cache.pop(session_id, None)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_for(db_path, session=None):
+    """
+    One store per session database file. The first session seen for a file
+    decides whether the store shares its connection (SessionStore) or opens one.
+    """
+    db_path = str(db_path)
+    with _stores_lock:
+        store = _stores.get(db_path)
+        if store is None:
+            store = _stores[db_path] = SentimentStatsStore(db_path, execute=getattr(session, 'execute', None))
+            if hasattr(session, 'add_deletion_listener'):
+                session.add_deletion_listener(store.forget)
+        return store
+
+
+def for_session(session):
+    """The store for an agents session (anything with session_id and db_path)."""
+    return store_for(getattr(session, 'db_path', ':memory:'), session)
+
+
+def record(session, score):
+    """Records a score for an agents SQLiteSession (or anything with session_id and db_path)."""
+    return for_session(session).record(session.session_id, score)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show per-session sentiment statistics.")
+    parser.add_argument('--db', default='session_history.sqlite')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--order-by', default='ewma', choices=['ewma', 'mean', 'count', 'updated_at'])
+    args = parser.parse_args()
+
+    for row in store_for(args.db).sessions(args.limit, args.order_by):
+        print(f"{row['session_id']:<30} turns={row['count']:<5} mean={row['mean']:+.3f} ewma={row['ewma']:+.3f} "
+              f"recent={[round(score, 2) for score in row['window']]}")
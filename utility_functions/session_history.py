@@ -0,0 +1,232 @@
+"""
+Bounded conversation history for agent sessions.
+
+CompactingSession wraps an agents SQLiteSession or a SessionStore session. Reads without a limit, which
+is how Runner builds the prompt, return a rolling summary of older turns
+followed by the most recent turns that fit in SESSION_HISTORY_ITEMS and
+SESSION_TOKEN_BUDGET. Reads with a limit, which is how Runner checks what it
+has just written, go straight to the stored tail. Writes are unchanged, so
+the full history stays on disk.
+
+The summary is stored in a session_summaries table in the session's SQLite
+file, together with the id of the last message it covers. `compact` folds
+newly overflowed messages into it, normally from a background thread at the
+start of a turn, so prompt building never waits on the summarization call.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from agents.memory.session import SessionABC  # type: ignore
+from dotenv import load_dotenv
+
+from utility_functions.clients import openai_client
+from utility_functions.stages import stage
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+SESSION_HISTORY_ITEMS = int(os.getenv('SESSION_HISTORY_ITEMS', '12'))
+SESSION_TOKEN_BUDGET = int(os.getenv('SESSION_TOKEN_BUDGET', '3000'))
+SESSION_SUMMARY_MODEL = os.getenv('SESSION_SUMMARY_MODEL', 'gpt-4o-mini')
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between an electricity customer and a billing "
+    "assistant. Update the summary with the new messages. Keep names, amounts, dates, billing periods, "
+    "the customer's concerns and any open questions. Answer with the summary only, at most 150 words."
+)
+# how many of the newest rows are read when building the window
+_READ_FACTOR = 4
+
+# one worker: compactions are rare, short, and must not pile up behind each other
+_compaction_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-compaction')
+
+
+def _encoder():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding('o200k_base')
+    except Exception:
+        return None
+
+
+_ENCODER = _encoder()
+
+
+def estimate_tokens(text):
+    if _ENCODER is not None:
+        return len(_ENCODER.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def item_text(item):
+    """Plain-text form of one input item, for token counting and summarization."""
+    if item.get('type') == 'function_call':
+        return f"[tool call] {item.get('name')}({item.get('arguments', '')})"
+    if item.get('type') == 'function_call_output':
+        return f"[tool result] {item.get('output', '')}"
+    content = item.get('content', '')
+    if isinstance(content, list):
+        content = ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return f"{item.get('role', item.get('type', 'item'))}: {content}"
+
+
+def _is_user_message(item):
+    return item.get('role') == 'user' and item.get('type', 'message') == 'message'
+
+
+class CompactingSession(SessionABC):
+    def __init__(self, inner, max_items=SESSION_HISTORY_ITEMS, token_budget=SESSION_TOKEN_BUDGET,
+                 summary_model=SESSION_SUMMARY_MODEL):
+        self.inner = inner
+        self.session_id = inner.session_id
+        self.max_items = max_items
+        self.token_budget = token_budget
+        self.summary_model = summary_model
+        self._messages_table = getattr(inner, 'messages_table', 'agent_messages')
+        self._lock = threading.Lock()
+        self._pending = None
+        # a SessionStore session lends its shared connection, a plain SQLiteSession gets one of our own
+        self._execute = getattr(inner, 'execute', None)
+        if self._execute is None:
+            self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._execute = self._own_execute
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS session_summaries ('
+            'session_id TEXT PRIMARY KEY, summary TEXT NOT NULL, covered_id INTEGER NOT NULL, updated_at REAL NOT NULL)',
+            commit=True
+        )
+
+    def _own_execute(self, sql, params=(), commit=False):
+        rows = self._conn.execute(sql, params).fetchall()
+        if commit:
+            self._conn.commit()
+        return rows
+
+    @property
+    def db_path(self):
+        return getattr(self.inner, 'db_path', ':memory:')
+
+    def __getattr__(self, name):
+        # batch(), flush() and friends of the wrapped session
+        if name == 'inner':
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def _summary(self):
+        rows = self._execute('SELECT summary, covered_id FROM session_summaries WHERE session_id = ?',
+                             (self.session_id,))
+        return rows[0] if rows else ('', 0)
+
+    def _window(self, covered_id):
+        """
+        Newest messages after covered_id that fit the item and token budgets, as
+        (rows, first_kept_id). The window always starts at a user message, so a
+        tool call is never separated from its output; a single turn larger than
+        the budget is kept whole.
+        """
+        rows = self._execute(
+            f'SELECT id, message_data FROM {self._messages_table} WHERE session_id = ? AND id > ? '
+            f'ORDER BY id DESC LIMIT ?',
+            (self.session_id, covered_id, self.max_items * _READ_FACTOR)
+        )
+        items = []
+        for row_id, data in rows:
+            try:
+                items.append((row_id, json.loads(data)))
+            except (json.JSONDecodeError, TypeError):
+                continue
+
+        tokens, start = 0, None
+        for position, (_, item) in enumerate(items):
+            tokens += estimate_tokens(item_text(item))
+            within_budget = position < self.max_items and tokens <= self.token_budget
+            if _is_user_message(item) and (within_budget or start is None):
+                start = position
+            if not within_budget and start is not None:
+                break
+        if start is None:
+            start = len(items) - 1
+        window = list(reversed(items[:start + 1]))
+        return window, (window[0][0] if window else None)
+
+    def compacted_items(self):
+        with self._lock:
+            summary, covered_id = self._summary()
+            window, _ = self._window(covered_id)
+        # items of the current turn not yet flushed by a batching session
+        history = [item for _, item in window] + getattr(self.inner, 'pending_items', list)()
+        if summary:
+            history.insert(0, {'role': 'system', 'content': f'Summary of the earlier conversation: {summary}'})
+        return history
+
+    async def get_items(self, limit=None):
+        if limit is not None:
+            return await self.inner.get_items(limit)
+        return await asyncio.to_thread(self.compacted_items)
+
+    async def add_items(self, items):
+        await self.inner.add_items(items)
+
+    async def pop_item(self):
+        return await self.inner.pop_item()
+
+    async def clear_session(self):
+        await self.inner.clear_session()
+        with self._lock:
+            self._execute('DELETE FROM session_summaries WHERE session_id = ?', (self.session_id,), commit=True)
+
+    def compact(self):
+        """Folds messages that fell out of the window into the stored summary. Returns True if it changed."""
+        with self._lock:
+            summary, covered_id = self._summary()
+            _, first_kept_id = self._window(covered_id)
+            if first_kept_id is None:
+                return False
+            overflow = self._execute(
+                f'SELECT id, message_data FROM {self._messages_table} WHERE session_id = ? AND id > ? AND id < ? '
+                f'ORDER BY id',
+                (self.session_id, covered_id, first_kept_id)
+            )
+        if not overflow:
+            return False
+
+        transcript = '\n'.join(item_text(json.loads(data))[:1000] for _, data in overflow)
+        try:
+            with stage('session_summary', kind='llm', model=self.summary_model, messages=len(overflow)) as current:
+                response = openai_client().chat.completions.create(
+                    model=self.summary_model,
+                    temperature=0,
+                    messages=[
+                        {'role': 'system', 'content': SUMMARY_PROMPT},
+                        {'role': 'user', 'content': f'Summary so far:\n{summary or "(none)"}\n\nNew messages:\n{transcript}'},
+                    ]
+                )
+                current.add_usage(response.usage)
+            new_summary = response.choices[0].message.content.strip()
+        except Exception as e:
+            log.warning('summarization failed for %s: %r', self.session_id, e)
+            return False
+
+        with self._lock:
+            self._execute(
+                'INSERT OR REPLACE INTO session_summaries (session_id, summary, covered_id, updated_at) '
+                'VALUES (?, ?, ?, ?)',
+                (self.session_id, new_summary, overflow[-1][0], time.time()),
+                commit=True
+            )
+        log.info('folded %d messages into the summary of %s', len(overflow), self.session_id)
+        return True
+
+    def compact_in_background(self):
+        """Schedules compact() unless one is already queued for this session."""
+        if self._pending is None or self._pending.done():
+            self._pending = _compaction_executor.submit(self.compact)
+        return self._pending
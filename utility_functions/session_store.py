@@ -0,0 +1,424 @@
+"""
+Session storage for agent conversations.
+
+SessionStore keeps one tuned SQLite connection per database file and hands
+out StoreSession objects that share it, instead of every session opening
+its own thread-local connections. The tables are the ones SQLiteSession
+creates (agent_sessions, agent_messages), so existing history files keep
+working and can still be opened with SQLiteSession.
+
+- Inside `async with session.batch():` writes are buffered in memory and
+  written in one transaction when the block exits. Reads, including the
+  SDK's tail checks, see the buffered items.
+- WAL with synchronous=NORMAL, a bounded WAL size and periodic
+  TRUNCATE checkpoints keep the -wal file from outgrowing the database.
+- `maintain` deletes sessions idle for SESSION_RETENTION_DAYS, then the
+  oldest sessions while their live pages exceed SESSION_MAX_DB_MB, and returns
+  freed pages to the filesystem. `start_maintenance` runs it periodically
+  on a daemon thread.
+- With SESSION_SHARDS > 1, sessions are spread over that many files by a
+  hash of the session id, so concurrent users do not share one write lock.
+- `async with session.exclusive(timeout):` holds a lease row on the
+  session in its file, so turns of one conversation run one at a time even
+  when they are served by different processes.
+
+Usage:
+    python -m utility_functions.session_store stats|maintain
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from agents.memory.session import SessionABC  # type: ignore
+from dotenv import load_dotenv
+
+from utility_functions.stages import stage
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'session_history.sqlite')
+SESSION_SHARDS = int(os.getenv('SESSION_SHARDS', '1'))
+SESSION_RETENTION_DAYS = float(os.getenv('SESSION_RETENTION_DAYS', '30'))
+SESSION_MAX_DB_MB = float(os.getenv('SESSION_MAX_DB_MB', '256'))
+SESSION_MAINTENANCE_SECONDS = float(os.getenv('SESSION_MAINTENANCE_SECONDS', '600'))
+# a lease left by a crashed process expires after this; live holders renew it every third of it
+SESSION_LEASE_SECONDS = float(os.getenv('SESSION_LEASE_SECONDS', '60'))
+# pages written before SQLite checkpoints the WAL by itself, and the size the WAL is truncated to afterwards
+SESSION_WAL_AUTOCHECKPOINT = 1000
+SESSION_WAL_SIZE_LIMIT = 16 * 1024 * 1024
+SESSIONS_TABLE = 'agent_sessions'
+MESSAGES_TABLE = 'agent_messages'
+LEASES_TABLE = 'session_leases'
+# tables other modules keep per session in the same file, cleared together with the messages
+SESSION_SIDE_TABLES = ['session_summaries', 'session_sentiment']
+_EVICTION_BATCH = 50
+_LEASE_POLL_SECONDS = 0.05
+
+
+class SessionBusy(Exception):
+    """Another turn held the session for longer than the caller was willing to wait."""
+
+
+class _Database:
+    """One shared connection to one SQLite file; every statement runs under its lock."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.RLock()
+        # called with the deleted session ids, outside the lock, so in-memory state kept per session can follow
+        self.deletion_listeners = []
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # only takes effect on a new file; existing files are converted by the first maintain()
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.conn.execute(f'PRAGMA wal_autocheckpoint={SESSION_WAL_AUTOCHECKPOINT}')
+        self.conn.execute(f'PRAGMA journal_size_limit={SESSION_WAL_SIZE_LIMIT}')
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {SESSIONS_TABLE} ('
+            'session_id TEXT PRIMARY KEY, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, '
+            'updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'
+        )
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {MESSAGES_TABLE} ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, message_data TEXT NOT NULL, '
+            'created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, '
+            f'FOREIGN KEY (session_id) REFERENCES {SESSIONS_TABLE} (session_id) ON DELETE CASCADE)'
+        )
+        self.conn.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_{MESSAGES_TABLE}_session_id ON {MESSAGES_TABLE} (session_id, id)'
+        )
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{SESSIONS_TABLE}_updated_at ON {SESSIONS_TABLE} (updated_at)')
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {LEASES_TABLE} ('
+            'session_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self.conn.commit()
+
+    def execute(self, sql, params=(), commit=False):
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+            if commit:
+                self.conn.commit()
+            return rows
+
+    def used_bytes(self):
+        """
+        Bytes held by live pages, as this connection sees them. Unlike the file
+        sizes it counts neither free pages nor a WAL that is not checkpointed yet.
+        """
+        with self.lock:
+            page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+            pages = self.conn.execute('PRAGMA page_count').fetchone()[0]
+            free = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return (pages - free) * page_size
+
+    def delete_sessions(self, session_ids):
+        if not session_ids:
+            return
+        placeholders = ', '.join('?' * len(session_ids))
+        with self.lock:
+            tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for table in [MESSAGES_TABLE, SESSIONS_TABLE] + [t for t in SESSION_SIDE_TABLES if t in tables]:
+                self.conn.execute(f'DELETE FROM {table} WHERE session_id IN ({placeholders})', session_ids)
+            self.conn.commit()
+            listeners = list(self.deletion_listeners)
+        for listener in listeners:
+            listener(session_ids)
+
+    def reclaim(self):
+        """Returns free pages to the filesystem and truncates the WAL."""
+        with self.lock:
+            if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                # through execute() the pragma stops after one page; executescript runs it to completion
+                self.conn.executescript('PRAGMA incremental_vacuum;')
+            elif self.conn.execute('PRAGMA freelist_count').fetchone()[0]:
+                # a full VACUUM also switches older files to incremental auto-vacuum
+                self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self.conn.execute('VACUUM')
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+
+class StoreSession(SessionABC):
+    """A Session backed by a SessionStore file. Use `batch()` to write a whole turn at once."""
+
+    sessions_table = SESSIONS_TABLE
+    messages_table = MESSAGES_TABLE
+
+    def __init__(self, session_id, database):
+        self.session_id = session_id
+        self._db = database
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._batch_depth = 0
+
+    @property
+    def db_path(self):
+        return self._db.path
+
+    def execute(self, sql, params=(), commit=False):
+        """Runs a statement on the shared connection, for tables kept next to the session."""
+        return self._db.execute(sql, params, commit)
+
+    def add_deletion_listener(self, listener):
+        """Calls listener(session_ids) whenever sessions are deleted from this session's file, e.g. by maintain()."""
+        with self._db.lock:
+            if listener not in self._db.deletion_listeners:
+                self._db.deletion_listeners.append(listener)
+
+    def pending_items(self):
+        with self._pending_lock:
+            return list(self._pending)
+
+    def _write(self, items):
+        rows = [(self.session_id, json.dumps(item)) for item in items]
+        with self._db.lock, stage('session_write', kind='session', items=len(rows)) as current:
+            current.add(requests=1)
+            try:
+                self._db.conn.execute(f'INSERT OR IGNORE INTO {SESSIONS_TABLE} (session_id) VALUES (?)',
+                                      (self.session_id,))
+                self._db.conn.executemany(
+                    f'INSERT INTO {MESSAGES_TABLE} (session_id, message_data) VALUES (?, ?)', rows)
+                self._db.conn.execute(
+                    f'UPDATE {SESSIONS_TABLE} SET updated_at = CURRENT_TIMESTAMP WHERE session_id = ?',
+                    (self.session_id,))
+                self._db.conn.commit()
+            except BaseException:
+                self._db.conn.rollback()
+                raise
+
+    def _read(self, limit):
+        pending = self.pending_items()
+        if limit is not None and limit <= len(pending):
+            return pending[len(pending) - limit:] if limit > 0 else []
+        if limit is None:
+            rows = self._db.execute(
+                f'SELECT message_data FROM {MESSAGES_TABLE} WHERE session_id = ? ORDER BY id',
+                (self.session_id,))
+        else:
+            rows = self._db.execute(
+                f'SELECT message_data FROM {MESSAGES_TABLE} WHERE session_id = ? ORDER BY id DESC LIMIT ?',
+                (self.session_id, limit - len(pending)))[::-1]
+        items = []
+        for (data,) in rows:
+            try:
+                items.append(json.loads(data))
+            except (json.JSONDecodeError, TypeError):
+                continue
+        return items + pending
+
+    async def get_items(self, limit=None):
+        return await asyncio.to_thread(self._read, limit)
+
+    async def add_items(self, items):
+        if not items:
+            return
+        if self._batch_depth:
+            with self._pending_lock:
+                self._pending.extend(items)
+            return
+        await asyncio.to_thread(self._write, list(items))
+
+    async def flush(self):
+        """Writes buffered items in one transaction."""
+        with self._pending_lock:
+            items, self._pending = self._pending, []
+        if not items:
+            return
+        try:
+            await asyncio.to_thread(self._write, items)
+        except BaseException:
+            with self._pending_lock:
+                self._pending[:0] = items
+            raise
+
+    @asynccontextmanager
+    async def batch(self):
+        """Buffers every write made inside the block and flushes them together on exit."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                await self.flush()
+
+    def _pop(self):
+        with self._pending_lock:
+            if self._pending:
+                return self._pending.pop()
+        with self._db.lock:
+            row = self._db.conn.execute(
+                f'DELETE FROM {MESSAGES_TABLE} WHERE id = (SELECT id FROM {MESSAGES_TABLE} WHERE session_id = ? '
+                f'ORDER BY id DESC LIMIT 1) RETURNING message_data',
+                (self.session_id,)).fetchone()
+            self._db.conn.commit()
+        return json.loads(row[0]) if row else None
+
+    async def pop_item(self):
+        return await asyncio.to_thread(self._pop)
+
+    def _try_lease(self, owner, seconds):
+        """Takes or renews the lease unless another owner holds an unexpired one. One statement, so atomic."""
+        now = time.time()
+        with self._db.lock:
+            cursor = self._db.conn.execute(
+                f'INSERT INTO {LEASES_TABLE} (session_id, owner, expires_at) VALUES (?, ?, ?) '
+                f'ON CONFLICT (session_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                f'WHERE {LEASES_TABLE}.expires_at < ? OR {LEASES_TABLE}.owner = excluded.owner',
+                (self.session_id, owner, now + seconds, now))
+            self._db.conn.commit()
+            return cursor.rowcount > 0
+
+    def _release_lease(self, owner):
+        self._db.execute(f'DELETE FROM {LEASES_TABLE} WHERE session_id = ? AND owner = ?',
+                         (self.session_id, owner), commit=True)
+
+    @asynccontextmanager
+    async def exclusive(self, timeout, seconds=SESSION_LEASE_SECONDS):
+        """
+        Holds the session's lease for the block, across every process using the
+        file. Raises SessionBusy when it cannot be taken within timeout seconds.
+        """
+        owner = f'{os.getpid()}:{uuid.uuid4().hex}'
+        deadline = time.monotonic() + timeout
+        while not await asyncio.to_thread(self._try_lease, owner, seconds):
+            if time.monotonic() >= deadline:
+                raise SessionBusy(self.session_id)
+            await asyncio.sleep(_LEASE_POLL_SECONDS)
+
+        async def renew():
+            while True:
+                await asyncio.sleep(seconds / 3)
+                await asyncio.to_thread(self._try_lease, owner, seconds)
+
+        renewal = asyncio.create_task(renew())
+        try:
+            yield self
+        finally:
+            renewal.cancel()
+            await asyncio.to_thread(self._release_lease, owner)
+
+    async def clear_session(self):
+        with self._pending_lock:
+            self._pending = []
+        await asyncio.to_thread(self._db.delete_sessions, [self.session_id])
+
+
+class SessionStore:
+    def __init__(self, path=SESSION_DB_PATH, shards=SESSION_SHARDS):
+        self.path = path
+        self.shards = max(1, shards)
+        self._databases = {}
+        self._lock = threading.Lock()
+        self._maintenance = None
+        self._stop = threading.Event()
+
+    def shard_path(self, session_id):
+        if self.shards == 1:
+            return self.path
+        root, ext = os.path.splitext(self.path)
+        shard = int(hashlib.sha1(session_id.encode('utf-8')).hexdigest(), 16) % self.shards
+        return f'{root}.{shard}{ext or ".sqlite"}'
+
+    def _database(self, path):
+        with self._lock:
+            database = self._databases.get(path)
+            if database is None:
+                database = self._databases[path] = _Database(path)
+            return database
+
+    def _all_databases(self):
+        if self.shards == 1:
+            return [self._database(self.path)]
+        root, ext = os.path.splitext(self.path)
+        return [self._database(f'{root}.{shard}{ext or ".sqlite"}') for shard in range(self.shards)]
+
+    def session(self, session_id):
+        return StoreSession(session_id, self._database(self.shard_path(session_id)))
+
+    def maintain(self, retention_days=SESSION_RETENTION_DAYS, max_db_mb=SESSION_MAX_DB_MB):
+        """Applies retention and the size cap to every shard. Returns the number of sessions deleted."""
+        deleted = 0
+        max_bytes = max_db_mb * 1024 * 1024 / self.shards
+        for database in self._all_databases():
+            expired = [row[0] for row in database.execute(
+                f"SELECT session_id FROM {SESSIONS_TABLE} WHERE updated_at < datetime('now', ?)",
+                (f'-{retention_days} days',))]
+            database.delete_sessions(expired)
+            deleted += len(expired)
+
+            # live pages rather than file sizes, so an unchanged WAL or free pages cannot keep the loop
+            # going; and at most one pass over the sessions there were
+            sessions = database.execute(f'SELECT COUNT(*) FROM {SESSIONS_TABLE}')[0][0]
+            for _ in range(-(-sessions // _EVICTION_BATCH)):
+                if database.used_bytes() <= max_bytes:
+                    break
+                oldest = [row[0] for row in database.execute(
+                    f'SELECT session_id FROM {SESSIONS_TABLE} ORDER BY updated_at LIMIT ?', (_EVICTION_BATCH,))]
+                if not oldest:
+                    break
+                database.delete_sessions(oldest)
+                deleted += len(oldest)
+            database.reclaim()
+        if deleted:
+            log.info('deleted %d sessions', deleted)
+        return deleted
+
+    def start_maintenance(self, interval=SESSION_MAINTENANCE_SECONDS):
+        """Runs maintain() every `interval` seconds on a daemon thread; calling it again is a no-op."""
+        if self._maintenance and self._maintenance.is_alive():
+            return self._maintenance
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.maintain()
+                except Exception as e:
+                    log.exception('maintenance failed: %r', e)
+
+        self._maintenance = threading.Thread(target=loop, name='session-store-maintenance', daemon=True)
+        self._maintenance.start()
+        return self._maintenance
+
+    def stop_maintenance(self):
+        self._stop.set()
+
+    def stats(self):
+        shards = []
+        for database in self._all_databases():
+            sessions, messages = database.execute(
+                f'SELECT (SELECT COUNT(*) FROM {SESSIONS_TABLE}), (SELECT COUNT(*) FROM {MESSAGES_TABLE})')[0]
+            wal = database.path + '-wal'
+            shards.append({
+                'path': database.path,
+                'sessions': sessions,
+                'messages': messages,
+                'db_bytes': os.path.getsize(database.path),
+                'wal_bytes': os.path.getsize(wal) if os.path.exists(wal) else 0,
+            })
+        return shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect or maintain the session store.")
+    parser.add_argument('command', choices=['stats', 'maintain'])
+    args = parser.parse_args()
+
+    store = SessionStore()
+    if args.command == 'maintain':
+        print(f"Deleted {store.maintain()} sessions")
+    for shard in store.stats():
+        print(shard)
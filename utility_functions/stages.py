@@ -0,0 +1,221 @@
+"""
+Spans: per-stage timings, request and token counts, traced per user turn.
+
+Code on the query path wraps its expensive steps in `stage(name, **attributes)`.
+Each stage is a span with its own id, the id of the span it runs in and the
+trace id of the outermost one, so every LLM call, embedding, vector query,
+tool invocation and session write of a turn shares the turn's trace id.
+The current span travels with the context, so steps run in asyncio tasks or
+through asyncio.to_thread are attributed to the turn that started them.
+
+    with stages.stage('vector_query', kind='vector', top_k=5) as current:
+        response = index.query(...)
+        current.add(requests=1)
+        current.set(matches=len(response.matches))
+
+When a stage finishes:
+  - its duration, errors, requests and tokens go to the metrics registry
+    (rag_stage_seconds, rag_stage_errors_total, rag_stage_requests_total,
+    rag_tokens_total), labelled with the stage name;
+  - it is logged to the 'trace' logger at DEBUG with its ids and attributes;
+  - a root span logs the whole trace, every span with its parent, in one
+    record: at INFO for turns, at DEBUG otherwise;
+  - a StageRecorder active in the context (see `recording`) gets it too,
+    which is how the benchmark sums stages per turn.
+
+Stages can nest (an agent run contains its tool's vector query); each one
+reports its own inclusive time.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from utility_functions import metrics
+
+_recorder = contextvars.ContextVar('stage_recorder', default=None)
+_current = contextvars.ContextVar('current_span', default=None)
+
+trace_log = logging.getLogger('trace')
+
+_stage_seconds = metrics.histogram('rag_stage_seconds', 'Wall-clock seconds per stage.', ['stage'])
+_stage_errors = metrics.counter('rag_stage_errors_total', 'Stages that ended with an exception.', ['stage'])
+_stage_requests = metrics.counter('rag_stage_requests_total', 'API requests made by each stage.', ['stage'])
+_tokens = metrics.counter('rag_tokens_total', 'LLM and embedding tokens by stage.', ['stage', 'direction'])
+
+
+def _new_id(size):
+    return os.urandom(size).hex()
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'root', 'started_at', 'start', 'seconds',
+                 'requests', 'input_tokens', 'output_tokens', 'attributes', 'error', 'children')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent.span_id if parent else None
+        self.root = parent.root if parent else self
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+        self.requests = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.attributes = dict(attributes or {})
+        self.error = None
+        # finished descendants, only kept on the root
+        self.children = [] if parent is None else None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, requests=0, input_tokens=0, output_tokens=0):
+        self.requests += requests
+        self.input_tokens += input_tokens or 0
+        self.output_tokens += output_tokens or 0
+
+    def add_usage(self, usage, requests=None):
+        """
+        Adds an OpenAI usage object (chat, responses or embeddings) or the agents
+        SDK run usage, which carries its own request count.
+        """
+        if usage is None:
+            self.add(requests=1 if requests is None else requests)
+            return
+        input_tokens = getattr(usage, 'input_tokens', None) or getattr(usage, 'prompt_tokens', 0)
+        output_tokens = getattr(usage, 'output_tokens', None) or getattr(usage, 'completion_tokens', 0)
+        if requests is None:
+            requests = getattr(usage, 'requests', 1)
+        self.add(requests, input_tokens, output_tokens)
+
+    def to_dict(self):
+        record = {'name': self.name, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                  'started_at': self.started_at, 'seconds': round(self.seconds, 6)}
+        if self.requests:
+            record.update(requests=self.requests, input_tokens=self.input_tokens, output_tokens=self.output_tokens)
+        if self.error:
+            record['error'] = self.error
+        record.update(self.attributes)
+        return record
+
+
+_root_lock = threading.Lock()
+
+
+def _finish(current):
+    current.seconds = time.perf_counter() - current.start
+    _stage_seconds.observe(current.seconds, stage=current.name)
+    if current.error:
+        _stage_errors.inc(stage=current.name)
+    if current.requests:
+        _stage_requests.inc(current.requests, stage=current.name)
+    if current.input_tokens:
+        _tokens.inc(current.input_tokens, stage=current.name, direction='input')
+    if current.output_tokens:
+        _tokens.inc(current.output_tokens, stage=current.name, direction='output')
+
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder._add(current)
+
+    if current.root is not current:
+        with _root_lock:
+            current.root.children.append(current)
+        if trace_log.isEnabledFor(logging.DEBUG):
+            trace_log.debug('span %s %.3fs', current.name, current.seconds,
+                            extra={'trace_id': current.trace_id, 'span': current.to_dict()})
+        return
+
+    level = logging.INFO if current.attributes.get('kind') == 'turn' else logging.DEBUG
+    if trace_log.isEnabledFor(level):
+        with _root_lock:
+            spans = [current.to_dict()] + [child.to_dict() for child in current.children]
+        trace_log.log(level, '%s %.3fs, %d spans', current.name, current.seconds, len(spans),
+                      extra={'trace_id': current.trace_id, 'spans': spans})
+
+
+def current_span():
+    return _current.get()
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace_id if current else None
+
+
+class TraceContextFilter(logging.Filter):
+    """Stamps log records with the current trace id ('-' outside a trace), for formats using %(trace_id)s."""
+
+    def filter(self, record):
+        if not hasattr(record, 'trace_id'):
+            record.trace_id = current_trace_id() or '-'
+        return True
+
+
+class StageRecorder:
+    """Collects the stages of one turn."""
+
+    def __init__(self):
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def _add(self, current):
+        with self._lock:
+            self.stages.append(current)
+
+    def summary(self):
+        """{stage: {'count', 'seconds', 'requests', 'input_tokens', 'output_tokens'}} summed over the turn."""
+        totals = {}
+        with self._lock:
+            stages = list(self.stages)
+        for current in stages:
+            total = totals.setdefault(current.name, {'count': 0, 'seconds': 0.0, 'requests': 0,
+                                                     'input_tokens': 0, 'output_tokens': 0})
+            total['count'] += 1
+            total['seconds'] += current.seconds
+            total['requests'] += current.requests
+            total['input_tokens'] += current.input_tokens
+            total['output_tokens'] += current.output_tokens
+        return totals
+
+
+@contextmanager
+def stage(name, **attributes):
+    """
+    Runs the block as a span named name, a child of the current span if there
+    is one and the root of a new trace otherwise. Yields the Span.
+    """
+    current = Span(name, _current.get(), attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = type(e).__name__
+        raise
+    except BaseException:
+        # cancelled, or a stream closed by its consumer
+        current.set(cancelled=True)
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # an async generator closed from another context (e.g. garbage collected mid-stream)
+            pass
+        _finish(current)
+
+
+@contextmanager
+def recording():
+    """Makes a new StageRecorder current for the block and yields it."""
+    recorder = StageRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
@@ -0,0 +1,279 @@
+import os
+import shutil
+from types import SimpleNamespace
+
+import numpy as np
+from dotenv import load_dotenv
+
+import utility_functions.embed_snapshot as embed_snapshot
+
+load_dotenv()
+
+# 'pinecone' (default) or 'local'
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'pinecone').lower()
+# A snapshot directory (see embed_snapshot.py) or an id,values,metadata CSV export.
+# Defaults to data/embeds_snapshot when it exists, else data/embeds.csv.
+LOCAL_INDEX_PATH = os.getenv('LOCAL_INDEX_PATH') or (
+    os.path.join('data', 'embeds_snapshot') if embed_snapshot.is_snapshot(os.path.join('data', 'embeds_snapshot'))
+    else os.path.join('data', 'embeds.csv'))
+# Upserts to the local index only last for the process unless LOCAL_INDEX_PERSIST is set; then they
+# go to LOCAL_INDEX_CACHE_PATH, a snapshot seeded from LOCAL_INDEX_PATH on first use, never to the seed.
+LOCAL_INDEX_PERSIST = os.getenv('LOCAL_INDEX_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+LOCAL_INDEX_CACHE_PATH = os.getenv('LOCAL_INDEX_CACHE_PATH', os.path.join('data', 'cache', 'index_snapshot'))
+PINECONE_INDEX_NAME = "retrieval-augmented-generation"
+
+
+class VectorIndex:
+    """
+    Interface used by rag.py. It mirrors the subset of the Pinecone Index API
+    the app relies on, so a Pinecone index can be used as-is.
+    """
+
+    def fetch(self, ids):
+        """Returns an object whose `vectors` dict holds the ids that exist."""
+        raise NotImplementedError
+
+    def query(self, vector, top_k=5, include_metadata=True, filter=None, **kwargs):
+        """
+        Returns an object whose `matches` list has `id`, `score` and `metadata`.
+        `filter` uses Pinecone's metadata filter syntax.
+        """
+        raise NotImplementedError
+
+    def upsert(self, vectors, **kwargs):
+        """Accepts (id, values, metadata) tuples or {'id', 'values', 'metadata'} dicts."""
+        raise NotImplementedError
+
+    def list(self, prefix=None, limit=100, **kwargs):
+        """Yields the vector ids in pages of up to `limit`, as Pinecone's serverless list does."""
+        raise NotImplementedError
+
+
+def _normalize_record(record):
+    if isinstance(record, dict):
+        return record['id'], record['values'], record.get('metadata') or {}
+    vector_id, values, *rest = record
+    return vector_id, values, (rest[0] if rest else None) or {}
+
+
+_COMPARISONS = {
+    '$eq': lambda value, target: value == target,
+    '$ne': lambda value, target: value != target,
+    '$gt': lambda value, target: value is not None and value > target,
+    '$gte': lambda value, target: value is not None and value >= target,
+    '$lt': lambda value, target: value is not None and value < target,
+    '$lte': lambda value, target: value is not None and value <= target,
+    '$in': lambda value, target: value in target,
+    '$nin': lambda value, target: value not in target,
+    '$exists': lambda value, target: (value is not None) == target,
+}
+
+
+def matches_filter(metadata, filter):
+    """Evaluates a Pinecone-style metadata filter ($eq, $in, $gte, $and, $or, ...) against one record."""
+    for key, condition in filter.items():
+        if key == '$and':
+            if not all(matches_filter(metadata, sub) for sub in condition):
+                return False
+        elif key == '$or':
+            if not any(matches_filter(metadata, sub) for sub in condition):
+                return False
+        else:
+            value = metadata.get(key)
+            if not isinstance(condition, dict):
+                condition = {'$eq': condition}
+            for op, target in condition.items():
+                if op not in _COMPARISONS:
+                    raise ValueError(f"Unsupported filter operator '{op}'")
+                try:
+                    if not _COMPARISONS[op](value, target):
+                        return False
+                except TypeError:
+                    return False
+    return True
+
+
+class LocalIndex(VectorIndex):
+    """
+    In-process exact cosine index. Vectors are kept L2-normalized in a single
+    float32 matrix, so a query is one matrix-vector product plus a partial sort.
+    The matrix is a view of a buffer that grows by doubling, so upserts copy
+    the existing rows only when the buffer is full (or, once, off a mapped
+    snapshot).
+    """
+
+    def __init__(self, dim=None, snapshot_path=None):
+        self.dim = dim
+        self.ids = []
+        self.metadata = []
+        self._positions = {}
+        self._matrix = np.empty((0, dim or 0), dtype=np.float32)
+        # writable rows backing _matrix; None while _matrix is a read-only snapshot mapping
+        self._buffer = None
+        # when set, upserts are also appended to this snapshot directory
+        self.snapshot_path = snapshot_path
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_csv(cls, path):
+        """Seeds an index from an id,values,metadata export such as data/embeds.csv."""
+        index = cls()
+        index.upsert(list(embed_snapshot.read_csv_records(path)))
+        return index
+
+    @classmethod
+    def from_snapshot(cls, path, persist=False):
+        """
+        Maps a binary snapshot without copying or parsing vector data.
+        With persist=True later upserts are appended to the snapshot.
+        """
+        matrix, ids, metadata = embed_snapshot.load(path)
+        index = cls(dim=matrix.shape[1], snapshot_path=path if persist else None)
+        index._matrix = matrix
+        index.ids = ids
+        index.metadata = metadata
+        index._positions = {vector_id: pos for pos, vector_id in enumerate(ids)}
+        return index
+
+    @staticmethod
+    def _unit_rows(values):
+        matrix = np.asarray(values, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix[None, :]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def _reserve(self, count):
+        """Makes room for `count` more rows in the writable buffer."""
+        needed = len(self.ids) + count
+        if self._buffer is not None and len(self._buffer) >= needed:
+            return
+        capacity = max(needed, 2 * len(self._buffer) if self._buffer is not None else 0, 64)
+        buffer = np.empty((capacity, self.dim), dtype=np.float32)
+        buffer[:len(self.ids)] = self._matrix
+        self._buffer = buffer
+        self._matrix = buffer[:len(self.ids)]
+
+    def fetch(self, ids):
+        vectors = {}
+        for vector_id in ids:
+            pos = self._positions.get(vector_id)
+            if pos is not None:
+                vectors[vector_id] = SimpleNamespace(id=vector_id,
+                                                     values=self._matrix[pos].tolist(),
+                                                     metadata=self.metadata[pos])
+        return SimpleNamespace(vectors=vectors)
+
+    def upsert(self, vectors, **kwargs):
+        records = [_normalize_record(r) for r in vectors]
+        if not records:
+            return {'upserted_count': 0}
+
+        rows = self._unit_rows([values for _, values, _ in records])
+        if self.dim is None or len(self) == 0:
+            self.dim = rows.shape[1]
+            self._matrix = np.empty((0, self.dim), dtype=np.float32)
+            self._buffer = None
+        if rows.shape[1] != self.dim:
+            raise ValueError(f"Vector dimension {rows.shape[1]} does not match index dimension {self.dim}")
+
+        if self.snapshot_path:
+            if not embed_snapshot.is_snapshot(self.snapshot_path):
+                embed_snapshot.create(self.snapshot_path, self.dim)
+            embed_snapshot.append(self.snapshot_path, records)
+
+        # also detaches from a read-only snapshot mapping before the first in-place update
+        self._reserve(len({vector_id for vector_id, _, _ in records if vector_id not in self._positions}))
+        count = len(self.ids)
+        new_ids, new_metadata = [], []
+        for row, (vector_id, _, metadata) in zip(rows, records):
+            pos = self._positions.get(vector_id)
+            if pos is None:
+                pos = self._positions[vector_id] = count + len(new_ids)
+                new_ids.append(vector_id)
+                new_metadata.append(dict(metadata))
+            elif pos < count:
+                self.metadata[pos] = dict(metadata)
+            else:
+                new_metadata[pos - count] = dict(metadata)
+            self._buffer[pos] = row
+
+        self._matrix = self._buffer[:count + len(new_ids)]
+        self.ids.extend(new_ids)
+        self.metadata.extend(new_metadata)
+        return {'upserted_count': len(records)}
+
+    def query(self, vector, top_k=5, include_metadata=True, filter=None, **kwargs):
+        if len(self) == 0:
+            return SimpleNamespace(matches=[])
+
+        query_row = self._unit_rows(vector)[0]
+        if filter:
+            # filter exactly first, then rank only the surviving rows
+            rows = np.fromiter((i for i, metadata in enumerate(self.metadata) if matches_filter(metadata, filter)),
+                               dtype=np.intp)
+            if len(rows) == 0:
+                return SimpleNamespace(matches=[])
+            scores = self._matrix[rows] @ query_row
+        else:
+            rows = np.arange(len(self))
+            scores = self._matrix @ query_row
+
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        matches = [SimpleNamespace(id=self.ids[rows[i]],
+                                   score=float(scores[i]),
+                                   metadata=self.metadata[rows[i]] if include_metadata else {})
+                   for i in top]
+        return SimpleNamespace(matches=matches)
+
+    def list(self, prefix=None, limit=100, **kwargs):
+        ids = [vector_id for vector_id in self.ids if not prefix or vector_id.startswith(prefix)]
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+
+def list_ids(index):
+    """Every vector id in a local, offline or Pinecone (serverless) index."""
+    return [vector_id for page in index.list() for vector_id in page]
+
+
+def _seed_snapshot(source, path):
+    """Copies the seed snapshot, or converts the seed CSV, to the writable snapshot at path."""
+    tmp_path = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    if embed_snapshot.is_snapshot(source):
+        shutil.copytree(source, tmp_path)
+    elif os.path.isfile(source):
+        embed_snapshot.convert(source, tmp_path)
+    else:
+        return
+    os.replace(tmp_path, path)
+
+
+def get_index(backend=None):
+    """Builds the vector index selected by VECTOR_BACKEND."""
+    backend = (backend or VECTOR_BACKEND).lower()
+    if backend == 'local':
+        if LOCAL_INDEX_PERSIST:
+            if not embed_snapshot.is_snapshot(LOCAL_INDEX_CACHE_PATH):
+                _seed_snapshot(LOCAL_INDEX_PATH, LOCAL_INDEX_CACHE_PATH)
+            if embed_snapshot.is_snapshot(LOCAL_INDEX_CACHE_PATH):
+                return LocalIndex.from_snapshot(LOCAL_INDEX_CACHE_PATH, persist=True)
+            return LocalIndex(snapshot_path=LOCAL_INDEX_CACHE_PATH)
+        if embed_snapshot.is_snapshot(LOCAL_INDEX_PATH):
+            return LocalIndex.from_snapshot(LOCAL_INDEX_PATH)
+        if os.path.isfile(LOCAL_INDEX_PATH):
+            return LocalIndex.from_csv(LOCAL_INDEX_PATH)
+        return LocalIndex()
+    if backend == 'pinecone':
+        from pinecone import Pinecone
+
+        pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'), environment=os.getenv('PINECONE_ENVIRONMENT'))
+        return pc.Index(PINECONE_INDEX_NAME)
+    raise ValueError(f"Unknown VECTOR_BACKEND '{backend}', expected 'pinecone' or 'local'")